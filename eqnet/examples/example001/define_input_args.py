@@ -34,6 +34,30 @@ hp.num_h =  7             #  number of hidden layers
 hp.h_dim = 800            #  dimension of each hidden layer
 hp.hidden_dims = [hp.h_dim for i in range(hp.num_h)]  # dimensions of each hidden layer in list format. This is what actually gets used by NN
 
+# learning rate schedule options (defaults reproduce a fixed learning rate)
+hp.lr_schedule = 'constant'  #  lr schedule (implemented: 'constant', 'cosine', 'onecycle')
+hp.warmup_epochs = 0         #  epochs of linear lr warmup at the start of training
+hp.max_lr = None             #  peak lr of the schedule, None to use learn_rate
+hp.lr_find = False           #  run an lr range test before training and use its suggested lr as max_lr
+hp.lr_scaling = None         #  None, 'linear' or 'sqrt': scale learn_rate from base_batch_size to batch_size
+hp.base_batch_size = 50      #  batch size that learn_rate was tuned for (used with lr_scaling)
+
+# optimizer: 'adam' (minibatch) or 'lbfgs' (full-batch L-BFGS over the whole training set, 
+# num_epochs is then the number of L-BFGS steps and the lr schedule options are not used)
+hp.optimizer = 'adam'
+hp.chunk_size = 10000        #  samples per chunk when evaluating the full-batch loss (lbfgs)
+
+# fine-tuning: continue training the model saved in finetune_from (net.pth, preprocess.dat)
+# on the shots >= finetune_first_new_shot, replaying replay_ratio old samples per new sample.
+# retrain_dir optionally points to a model fully retrained on all shots, for the forgetting report
+hp.finetune = False
+hp.finetune_from = None
+hp.finetune_first_new_shot = None
+hp.finetune_epochs = 20
+hp.finetune_learn_rate = 3e-6       #  learning rate used for fine-tuning
+hp.replay_ratio = 1.0
+hp.retrain_dir = None
+
 
 ''' GENERAL JOB SETTINGS '''
 settings = EasyDict()
@@ -42,6 +66,9 @@ settings.print_every = 1000
 settings.savefigs = True
 settings.savemodel = False
 settings.use_pretrained_model = False
+settings.checkpoint_every = 10     # save a resumable checkpoint every N epochs (0 to disable)
+settings.log_every = 100          # append training metrics to metrics.jsonl every N steps (0 to disable)
+settings.benchmark_latency = True  # write latency.json of the trained net (see nntools/latency.py)
 settings.dataset_dir = '/eqnet/data/datasets/'
 settings.data_pca_fn = '/data_pca_017.dat'
 settings.rawdata_dir = '/data/rawdata/data_by_shot'
@@ -64,7 +91,13 @@ SELECT MODE OF OPERATION: RECONSTRUCTION, FORWARD, ETC.
 DATA INPUTS AND OUTPUTS DEPEND ON THE MODE
 '''
 
-nn_mode = 'reconstruction'   # choose forward, forward-control, reconstruction or reconstruction-control
+nn_mode = 'reconstruction'   # choose forward, forward-control, reconstruction, reconstruction-control 
+                             # or reconstruction-joint
+
+# reconstruction-joint: one net with a shared trunk and two heads, predicting the flux pca 
+# coefficients and the shape control parameters. Loss is the weighted mean of the head losses
+head_loss_weights = [1.0, 1.0]     # [flux, shape]
+head_hidden_dims = []              # hidden layers of each head, after the shared trunk
 
 
 
@@ -104,6 +137,18 @@ elif nn_mode == 'reconstruction-control':
         'gap1', 'gap2', 'a', 'b', 'kappa', 'delta', 'R0', 'rmax', 'rx_lo_filtered', 'zx_lo_filtered', 
         'rx_up_filtered', 'zx_up_filtered', 'islimited']]
 
+elif nn_mode == 'reconstruction-joint':
+
+    settings.shape_control_mode = False
+    settings.multitask = True
+    settings.xnames = ['coil_currents_meas', 'ip', 'bpsignals', 'ivsignals', 'flsignals', 'vloop']
+    settings.ynames = ['psizr_pla_iv'] + ['shape_' + x for x in ['rx_lo', 'zx_lo', 'rx_up', 'zx_up', 'rcur', 'zcur', 
+        'gap1', 'gap2', 'a', 'b', 'kappa', 'delta', 'R0', 'rmax', 'rx_lo_filtered', 'zx_lo_filtered', 
+        'rx_up_filtered', 'zx_up_filtered', 'islimited']]
+    settings.head_names = ['flux', 'shape']
+    settings.head_loss_weights = head_loss_weights
+    settings.head_hidden_dims = head_hidden_dims
+
 
 settings.pretrained_model_fn  = jobdir + '/results_cached/net.pth'
 
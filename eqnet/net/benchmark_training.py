@@ -0,0 +1,138 @@
+'''
+Benchmarks the wall-clock time to reach a target validation loss for several 
+training recipes (learning rate schedules, lr range test, scaled batch sizes, 
+full-batch L-BFGS), using the dataset and network defined in args.json of the current directory. 
+
+The baseline is the fixed learning rate setup from args.json, trained for 
+num_epochs. Its best validation loss (times target_factor) is the target for 
+the other recipes, which stop as soon as they reach it. The baseline is then 
+rerun with the same seed up to the target, so speedups compare times to the 
+same target. Results are printed and written to benchmark.txt.
+'''
+
+import os
+ROOT = os.environ['NN_ROOT']
+import sys
+sys.path.append(ROOT)
+import numpy as np
+from easydict import EasyDict
+import torch
+import json
+import time
+import copy
+from torch.utils.data import TensorDataset, DataLoader
+from eqnet.data.data_utils import load_data
+from eqnet.net.eqnet_utils import (train, MLP, DataPreProcess, train_val_test_split,
+                                   make_optimizer, make_lr_scheduler, lr_range_test)
+
+target_factor = 1.0     # target val loss = target_factor * best baseline val loss
+print_every = 100       # val loss is checked every print_every batches
+
+
+# load parameters
+fn = os.getcwd() + '/args.json'
+with open(fn) as infile:
+    hp = EasyDict(json.load(infile))
+hp.root = ROOT
+hp.print_every = print_every
+hp.checkpoint_every = 0
+hp.lr_find = False
+hp.lr_schedule = 'constant'
+hp.warmup_epochs = 0
+hp.max_lr = None
+hp.lr_scaling = None
+
+
+# recipes to compare, as overrides of the args.json settings
+recipes = {}
+recipes['baseline (fixed lr)'] = {}
+recipes['cosine + warmup'] = {'lr_schedule': 'cosine', 'warmup_epochs': 5, 'max_lr': 10 * hp.learn_rate}
+recipes['onecycle'] = {'lr_schedule': 'onecycle', 'max_lr': 10 * hp.learn_rate}
+recipes['onecycle, 1/3 epochs'] = {'lr_schedule': 'onecycle', 'max_lr': 10 * hp.learn_rate, 
+                                   'num_epochs': hp.num_epochs // 3}
+recipes['lr_find + onecycle, 1/3 epochs'] = {'lr_schedule': 'onecycle', 'lr_find': True, 
+                                             'num_epochs': hp.num_epochs // 3}
+recipes['batch x8, sqrt lr scaling + onecycle'] = {'lr_schedule': 'onecycle', 'batch_size': 8 * hp.batch_size, 
+                                                  'lr_scaling': 'sqrt', 'base_batch_size': hp.batch_size}
+recipes['full-batch L-BFGS'] = {'optimizer': 'lbfgs', 'num_epochs': 300}
+
+
+# load and process data
+print('Loading data...')
+data_pca = load_data(ROOT + hp.dataset_dir + hp.data_pca_fn)
+traindata, valdata, testdata = train_val_test_split(data_pca, ftrain=0.8, fval=0.1, mix=True)
+
+preprocess = DataPreProcess(traindata, hp.xnames, hp.ynames, t_thresh=None)
+trainX, trainY,_,_ = preprocess.transform(traindata, randomize=True, holdback_fraction=0, by_shot=True)
+valX, valY,_,_ = preprocess.transform(valdata, randomize=True, holdback_fraction=0)
+train_dataset = TensorDataset(trainX, trainY)
+val_dataset = TensorDataset(valX, valY)
+
+
+def run_recipe(hp):
+
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    train_dataloader = DataLoader(train_dataset, batch_size=hp.batch_size, shuffle=True)
+    val_dataloader = DataLoader(val_dataset, batch_size=len(val_dataset), shuffle=True)
+
+    net = MLP(trainX.shape[1], trainY.shape[1], hp.hidden_dims, nonlinearity=hp.nonlinearity,
+              p_dropout_in=hp.p_dropout_in, p_dropout_hidden=hp.p_dropout_hidden)
+    
+    if hp.lossfun=='L1':
+        loss_fcn = torch.nn.L1Loss()
+    else: 
+        loss_fcn = torch.nn.MSELoss()
+
+    t0 = time.time()
+    optimizer = make_optimizer(net, hp)
+    scheduler = None
+    if hp.get('optimizer', 'adam') == 'adam':
+        if hp.lr_find:
+            _, _, hp.max_lr = lr_range_test(net, loss_fcn, optimizer, train_dataloader)
+        scheduler = make_lr_scheduler(optimizer, hp, len(train_dataloader))
+    
+    net, training_loss, validation_loss = train(
+        net, loss_fcn, optimizer, train_dataloader, val_dataloader, hp, scheduler=scheduler)
+    
+    return time.time() - t0, np.min(validation_loss)
+
+
+results = []
+for name, overrides in recipes.items():
+
+    print('\nRecipe: ' + name)
+    hp_r = copy.deepcopy(hp)
+    hp_r.update(overrides)
+    if name != 'baseline (fixed lr)':
+        hp_r.target_val_loss = target_val_loss
+
+    elapsed, best_val_loss = run_recipe(hp_r)
+    results.append((name, elapsed, best_val_loss))
+    
+    if name == 'baseline (fixed lr)':
+        target_val_loss = target_factor * best_val_loss
+
+        # time for the baseline to first reach the target, not its full num_epochs
+        print('\nRecipe: baseline (fixed lr), to target')
+        hp_r = copy.deepcopy(hp)
+        hp_r.target_val_loss = target_val_loss
+        baseline_time, _ = run_recipe(hp_r)
+        results.append(('baseline (fixed lr), to target', baseline_time, best_val_loss))
+
+
+# report
+lines = ['Target validation loss: %3e' % target_val_loss, '',
+         '%-40s %12s %10s %14s' % ('recipe', 'wall time[s]', 'speedup', 'best val loss')]
+for name, elapsed, best_val_loss in results:
+    if best_val_loss <= target_val_loss:
+        speedup = '%.2f' % (baseline_time / elapsed)
+    else:
+        speedup = 'not reached'
+    lines.append('%-40s %12.1f %10s %14.4e' % (name, elapsed, speedup, best_val_loss))
+report = '\n'.join(lines)
+print('\n' + report)
+
+with open(os.getcwd() + '/benchmark.txt', 'w') as outfile:
+    outfile.write(report + '\n')
@@ -0,0 +1,142 @@
+'''
+K-fold cross-validation grouped by shot, using the dataset and network defined
+in args.json of the current directory.
+
+The shots of the full dataset are shuffled and split into nfolds groups. Fold k
+is tested on the shots of group k, validated (for the val loss curve and early
+stopping) on the shots of group k+1 and trained on the remaining shots, so every
+shot is tested exactly once and never seen by the model or its normalization
+before. The normalization of each fold is fit on its training shots only. The
+unscaled data (the PCA coefficients of the data set, common to all folds) is 
+published once in shared memory (nntools.shared_data) together with the scaler
+statistics of each fold, each batch is standardized with its fold's statistics
+as it is sampled (see train_on_shared_data), and the folds are trained 
+concurrently in a process pool.
+
+Per-fold results are written to crossval/fold<k>/, the per-fold and aggregated
+(mean, std) test metrics are printed and written to crossval.txt and
+crossval.json. The test losses are of the de-scaled predictions, in the units
+of the data set, so they are comparable between folds.
+'''
+
+import os
+ROOT = os.environ['NN_ROOT']
+import sys
+sys.path.append(ROOT)
+import numpy as np
+import torch
+from easydict import EasyDict
+import json
+import copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from eqnet.data.data_utils import load_data
+from eqnet.net.eqnet_utils import DataPreProcess, select_samples, train_on_shared_data
+from nntools.shared_data import SharedArrays
+
+nfolds = 5               # number of folds, at least 3 (one test, one val and training folds)
+nworkers = 5             # number of folds trained concurrently
+nthreads = 1             # torch threads per worker
+seed = 0                 # seed of the shot to fold assignment
+
+
+def main():
+
+    # load parameters
+    fn = os.getcwd() + '/args.json'
+    with open(fn) as infile:
+        hp = EasyDict(json.load(infile))
+    hp.root = ROOT
+    hp.checkpoint_every = 0
+
+    # load data
+    print('Loading data...')
+    data_pca = load_data(ROOT + hp.dataset_dir + hp.data_pca_fn)
+
+    # assign shots to folds
+    shots = data_pca['shot'].reshape(-1)
+    shotlist = np.unique(shots)
+    np.random.default_rng(seed).shuffle(shotlist)
+    fold_shots = np.array_split(shotlist, nfolds)
+
+    # normalization fit on the training shots of each fold
+    print('Normalizing data...')
+    arrays = {}
+    for k in range(nfolds):
+        intrain = ~np.isin(shots, fold_shots[k]) & ~np.isin(shots, fold_shots[(k + 1) % nfolds])
+        preprocess = DataPreProcess(select_samples(data_pca, np.where(intrain)[0]), hp.xnames, hp.ynames, 
+                                    t_thresh=None)
+        arrays['X_mean%d' % k] = torch.Tensor(preprocess.X_scaler.mean_)
+        arrays['X_scale%d' % k] = torch.Tensor(preprocess.X_scaler.scale_)
+        arrays['Y_mean%d' % k] = torch.Tensor(preprocess.Y_scaler.mean_)
+        arrays['Y_scale%d' % k] = torch.Tensor(preprocess.Y_scaler.scale_)
+
+    # unscaled data of all folds, without the samples with nans
+    X = preprocess.makeX(data_pca, hp.xnames)
+    Y = preprocess.makeX(data_pca, hp.ynames)
+    keep = ~np.isnan(X).any(axis=1) & ~np.isnan(Y).any(axis=1)
+    arrays['X'] = torch.Tensor(X[keep])
+    arrays['Y'] = torch.Tensor(Y[keep])
+    shots = shots[keep]
+    del data_pca, X, Y
+
+    name = 'eqnet_cv_%d' % os.getpid()
+    shared = SharedArrays.create(name, arrays)
+    del arrays
+    print('Published %.1f MB of data as %s' % (shared.nbytes() / 1e6, name))
+
+    try:
+        ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=nworkers, mp_context=ctx) as pool:
+            futures = []
+            for k in range(nfolds):
+                hp_k = copy.deepcopy(hp)
+                hp_k.save_results_dir = os.getcwd() + '/crossval/fold%d/' % k
+                os.makedirs(hp_k.save_results_dir, exist_ok=True)
+                intest = np.isin(shots, fold_shots[k])
+                inval = np.isin(shots, fold_shots[(k + 1) % nfolds])
+                futures.append(pool.submit(train_on_shared_data, name, hp_k, train_idx=np.where(~intest & ~inval)[0],
+                                           val_idx=np.where(inval)[0], train_keys=('X', 'Y'), val_keys=('X', 'Y'),
+                                           test_keys=('X', 'Y'), test_idx=np.where(intest)[0],
+                                           scaler_keys=('X_mean%d' % k, 'X_scale%d' % k, 
+                                                        'Y_mean%d' % k, 'Y_scale%d' % k),
+                                           nthreads=nthreads, seed=seed + k))
+
+            results = []
+            for k, future in enumerate(futures):
+                r = future.result()
+                results.append(r)
+                print('Fold %d done, test L1 loss %.4e' % (k, r['test_l1_loss']))
+    finally:
+        shared.unlink()
+
+    # per-fold and aggregated metrics
+    metrics = ['test_l1_loss', 'test_l2_loss']
+    out = {'nfolds': nfolds, 'folds': [], 'mean': {}, 'std': {}}
+    for k, r in enumerate(results):
+        fold = {'fold': k, 'shots': [int(s) for s in fold_shots[k]], 'ntrain': int(r['ntrain']),
+                'wall_time': r['wall_time']}
+        fold.update({m: r[m] for m in metrics})
+        out['folds'].append(fold)
+    for m in metrics:
+        values = np.array([r[m] for r in results])
+        out['mean'][m] = float(values.mean())
+        out['std'][m] = float(values.std(ddof=1)) if nfolds > 1 else 0.0
+
+    lines = ['%6s %8s %10s %14s %14s %12s' % ('fold', 'nshots', 'ntrain', 'test L1 loss', 'test L2 loss', 'wall time[s]')]
+    for fold in out['folds']:
+        lines.append('%6d %8d %10d %14.4e %14.4e %12.1f' % (fold['fold'], len(fold['shots']), fold['ntrain'],
+                     fold['test_l1_loss'], fold['test_l2_loss'], fold['wall_time']))
+    lines.append('%6s %8s %10s %14.4e %14.4e' % ('mean', '', '', out['mean']['test_l1_loss'], out['mean']['test_l2_loss']))
+    lines.append('%6s %8s %10s %14.4e %14.4e' % ('std', '', '', out['std']['test_l1_loss'], out['std']['test_l2_loss']))
+    report = '\n'.join(lines)
+    print('\n' + report)
+
+    with open(os.getcwd() + '/crossval.txt', 'w') as outfile:
+        outfile.write(report + '\n')
+    with open(os.getcwd() + '/crossval.json', 'w') as outfile:
+        json.dump(out, outfile, indent=4)
+
+
+if __name__ == '__main__':
+    main()
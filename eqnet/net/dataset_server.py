@@ -0,0 +1,64 @@
+'''
+Shared-memory dataset server. Loads the dataset defined in args.json of the
+current directory, transforms it once and publishes the train/val/test tensors
+and the fitted preprocessing in shared memory (see publish_dataset in eqnet_utils),
+then waits until stopped with Ctrl-C or SIGTERM and removes the shared memory.
+
+Training jobs on the same node attach to it by name instead of loading their own
+copy of the data, by setting the environment variable NN_SHARED_DATASET (or
+shared_dataset in args.json) before running eqnet_batch.py, so node memory does
+not grow with the number of concurrent jobs. The jobs must use the same
+dataset_dir, data_pca_fn, xnames and ynames.
+
+usage: python dataset_server.py [name]
+'''
+
+import os
+ROOT = os.environ['NN_ROOT']
+import sys
+sys.path.append(ROOT)
+from easydict import EasyDict
+import json
+import signal
+import time
+from eqnet.data.data_utils import load_data
+from eqnet.net.eqnet_utils import train_val_test_split, publish_dataset
+
+
+def serve(name, hp):
+
+    print('Loading data...')
+    data_pca = load_data(ROOT + hp.dataset_dir + hp.data_pca_fn)
+    traindata, valdata, testdata = train_val_test_split(data_pca, ftrain=0.8, fval=0.1, mix=True)
+    del data_pca
+
+    print('Normalizing data...')
+    shared = publish_dataset(name, hp, traindata, valdata, testdata)
+    del traindata, valdata, testdata
+    print('Serving %.1f MB as %s' % (shared.nbytes() / 1e6, name))
+
+    return shared
+
+
+if __name__ == '__main__':
+
+    name = sys.argv[1] if len(sys.argv) > 1 else 'eqnet_data'
+
+    fn = os.getcwd() + '/args.json'
+    with open(fn) as infile:
+        hp = EasyDict(json.load(infile))
+
+    # stop on SIGTERM as on Ctrl-C, so the shared memory is always removed
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+
+    shared = serve(name, hp)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shared.unlink()
+        print('Stopped serving %s' % name)
@@ -0,0 +1,135 @@
+'''
+Trains several eqnet jobs together as one vectorized ensemble. The job directories
+are listed in ensemble.json (written by submit_jobs.py with ensemble=True). The 
+jobs may only differ in learning rate and dropout, must train plain MLPs with Adam at
+a constant lr (see ENSEMBLE_DEFAULTS in nntools/jobs.py), and each one gets the same 
+loss.txt, net.pth, preprocess.dat, test_shots.txt, model_bundle.npz, latency.json,
+out.mat and figures that eqnet_batch.py would have written.
+'''
+
+import os
+ROOT = os.environ['NN_ROOT']
+import sys
+sys.path.append(ROOT)
+import numpy as np
+from easydict import EasyDict
+import torch
+# import matplotlib
+# matplotlib.use('agg')
+import matplotlib.pyplot as plt
+import json
+from torch.utils.data import TensorDataset, DataLoader
+from eqnet.data.data_utils import load_data
+import scipy.io as sio
+from eqnet.net.eqnet_utils import (plot_response_coeffs, plot_loss_curve, train_ensemble, 
+                                   MLP, EnsembleMLP, EnsembleAdam, DataPreProcess, plot_shape_timetraces, 
+                                   gen_output_preds, train_val_test_split, plot_flux_preds,
+                                   scaled_learn_rate, save_preprocess, save_bundle)
+from nntools.jobs import ENSEMBLE_MEMBER_KEYS, ensemble_unsupported
+from nntools.latency import write_latency
+
+
+print('Loading parameters...')
+
+# load parameters of each member
+fn = os.getcwd() + '/ensemble.json'
+with open(fn) as infile:
+    jobdirs = json.load(infile)['jobdirs']
+
+hps = []
+for jobdir in jobdirs:
+    with open(jobdir + '/args.json') as infile:
+        hps.append(EasyDict(json.load(infile)))
+
+hp = hps[0]
+hp.root = ROOT
+for hp_k in hps:
+    for key in set(hp.keys()) | set(hp_k.keys()):
+        if key not in ENSEMBLE_MEMBER_KEYS + ['root'] and hp.get(key) != hp_k.get(key):
+            raise ValueError('Ensemble members have different values of ' + key)
+    unsupported = ensemble_unsupported(hp_k)
+    if unsupported:
+        raise ValueError('Ensemble members do not support ' + ', '.join(unsupported))
+
+
+# load data
+print('Loading data...')
+data_pca = load_data(ROOT + hp.dataset_dir + hp.data_pca_fn)
+
+traindata, valdata, testdata = train_val_test_split(data_pca, ftrain=0.8, fval=0.1, mix=True)
+test_shots = testdata['shot'].reshape(-1)
+
+
+# process data
+print('Normalizing data...')
+preprocess = DataPreProcess(traindata, hp.xnames, hp.ynames, t_thresh=None)
+trainX, trainY,_,_ = preprocess.transform(traindata, randomize=True, holdback_fraction=0, by_shot=True)
+valX, valY,_,_ = preprocess.transform(valdata, randomize=True, holdback_fraction=0)
+
+# dataloaders
+train_dataset = TensorDataset(trainX, trainY)
+train_dataloader = DataLoader(train_dataset, batch_size=hp.batch_size, shuffle=True)
+val_dataset = TensorDataset(valX, valY)
+val_dataloader = DataLoader(val_dataset, batch_size=len(val_dataset), shuffle=True)
+
+# initialize NNs
+in_dim = trainX.shape[1]
+out_dim = trainY.shape[1]
+nets = [MLP(in_dim, out_dim, hp_k.hidden_dims, nonlinearity=hp_k.nonlinearity,
+            p_dropout_in=hp_k.p_dropout_in, p_dropout_hidden=hp_k.p_dropout_hidden) for hp_k in hps]
+net = EnsembleMLP(nets)
+
+optimizer = EnsembleAdam(net.parameters(), lr=[scaled_learn_rate(hp_k) for hp_k in hps])
+
+
+# train
+print('Training %d ensemble members...' % len(hps))
+net, training_loss, validation_loss = train_ensemble(
+    net, hp.lossfun, optimizer, train_dataloader, val_dataloader, hp)
+print('Training complete.')
+
+
+# write the outputs of each member, as eqnet_batch.py does
+for k, hp_k in enumerate(hps):
+
+    print('Saving results for ' + jobdirs[k] + '...')
+    hp_k.root = ROOT
+    net_k = nets[k]
+    net_k.load_state_dict(net.member_state_dict(k))
+    net_k.eval()
+
+    # write loss to file
+    np.savetxt(hp_k.save_results_dir + '/loss.txt', (training_loss[k], validation_loss[k]))
+
+    # save model
+    if hp_k.savemodel:
+        pth = hp_k.save_results_dir + '/net.pth'
+        torch.save(net_k.state_dict(), pth)
+        save_preprocess(preprocess, hp_k.save_results_dir + '/preprocess.dat')
+        np.savetxt(hp_k.save_results_dir + '/test_shots.txt', np.unique(test_shots), fmt='%d')
+        save_bundle(hp_k.save_results_dir + '/model_bundle.npz', net_k, preprocess, traindata, hp_k)
+
+    plot_loss_curve(training_loss[k], validation_loss[k], hp_k)
+
+    # inference latency of the member on this cpu, see nntools/latency.py
+    if hp_k.get('benchmark_latency', False):
+        write_latency(net_k, in_dim, hp_k)
+
+    # save predictions
+    out = {}
+    out['test'] = gen_output_preds(testdata, preprocess, net_k, hp_k)
+    out['val']  = gen_output_preds(valdata, preprocess, net_k, hp_k)
+    sio.savemat(hp_k.save_results_dir + '/out.mat', {'out':out})
+
+    # plot various predictions
+    if hp_k.shape_control_mode:
+        plot_shape_timetraces(hp_k.shots2plot, net_k, data_pca, preprocess, hp_k)
+    else:
+        plot_response_coeffs(hp_k.shots2plot, data_pca, preprocess, net_k, hp_k, ncoeffs=2)    
+        tok_data = sio.loadmat(ROOT + hp_k.obj_dir + 'tok_data.mat')['tok_data']
+        for shot in hp_k.shots2plot:
+            plot_flux_preds(shot, hp_k.times2plot, net_k, data_pca, preprocess, tok_data, hp_k)
+    
+    plt.close('all')
+
+print('Done.')
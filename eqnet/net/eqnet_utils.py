@@ -5,8 +5,21 @@ import matplotlib.pyplot as plt
 from sklearn.preprocessing import StandardScaler
 import torch.nn as nn
 import torch
+from torch.utils.data import TensorDataset, DataLoader
 import scipy.io as sio
 import copy
+import pickle
+import json
+from nntools.models import MLP, MultiHeadMLP, MultiHeadLoss
+from nntools.training import (predict, train, chunked_loss, train_full_batch, make_optimizer, save_checkpoint,
+                              load_checkpoint, warm_start, scaled_learn_rate, make_lr_scheduler, lr_range_test,
+                              select_samples, split_by_shot, strip_preprocess, save_preprocess, load_preprocess,
+                              eval_loss, forgetting_report)
+from nntools.preprocess import DataPreProcess
+from nntools.bundle import pca_basis, save_bundle, ModelBundle, load_bundle, random_bundle
+from nntools.shared_data import SharedArrays
+import math
+import time
 import mat73
 
 # ====================
@@ -48,7 +61,6 @@ def train_val_test_split(data_pca, ftrain=0.8, fval=0.1, ftest=0.1, mix=False):
     '''
 
 
-
     trainshots = uniqshots[0:ntrain]
     valshots = uniqshots[ntrain:ntrain+nval]
     testshots = uniqshots[ntrain+nval:]
@@ -79,15 +91,15 @@ def train_val_test_split(data_pca, ftrain=0.8, fval=0.1, ftest=0.1, mix=False):
     return traindata, valdata, testdata
 
 
-
 # =====================================
 # Visualize Response Predictions
 # =====================================
 def visualize_response_prediction(data, preprocess, net, loss_fcn, hp, ishot=0, nsamples=10):
 
     def inverse_transform(y):
-        y = y.detach().numpy()
+        y = y.detach().numpy().reshape(1, -1)
         y = preprocess.Y_scaler.inverse_transform(y)
+        y = y[:, :preprocess.ydims[0]]   # multi-task nets: flux target only
         y = preprocess.Y_pca.inverse_transform(y)
         y = y.reshape(65, 65).T
         return y
@@ -100,7 +112,7 @@ def visualize_response_prediction(data, preprocess, net, loss_fcn, hp, ishot=0,
     times = data['time'][iuse]
     X = X[iuse, :]
     Y = Y[iuse, :]
-    Ypreds = net(X)
+    Ypreds = predict(net, X)
 
     fig = plt.figure(figsize=(20, 10))
     ax = list(range(nsamples))
@@ -150,7 +162,7 @@ def plot_response_coeffs(shotlist, data, preprocess, net, hp, ncoeffs='all'):
             X, Y,_,_ = preprocess.transform(data, randomize=False)
             X = X[i, :]
             Y = Y[i, :]
-            Ypred = net(X).detach().numpy()
+            Ypred = predict(net, X).numpy()
 
             ax[ishot] = fig.add_subplot(4, int(np.ceil(nshots / 4)), ishot + 1)
             ax[ishot].plot(t, Y[:, icoeff], linestyle='dashed')
@@ -186,8 +198,9 @@ def plot_loss_curve(training_loss, validation_loss, hp):
 def make_shot_response_movie(data, preprocess, net, loss_fcn, hp, ishot=0):
 
     def inverse_transform(y):
-        y = y.detach().numpy()
+        y = y.detach().numpy().reshape(1, -1)
         y = preprocess.Y_scaler.inverse_transform(y)
+        y = y[:, :preprocess.ydims[0]]   # multi-task nets: flux target only
         y = preprocess.Y_pca.inverse_transform(y)
         y = y.reshape(65, 65).T
         return y
@@ -201,7 +214,7 @@ def make_shot_response_movie(data, preprocess, net, loss_fcn, hp, ishot=0):
     times = data['time'][iuse]
     X = X[iuse, :]
     Y = Y[iuse, :]
-    Ypreds = net(X)
+    Ypreds = predict(net, X)
 
     fig, ax = plt.subplots(1, 2, figsize=(6, 6))
     div = make_axes_locatable(ax[1])
@@ -245,56 +258,227 @@ def make_shot_response_movie(data, preprocess, net, loss_fcn, hp, ishot=0):
     return anim
 
 
-# ========
-# TRAINING
-# ========
-def train(net, loss_fcn, optimizer, train_dataloader, val_dataloader, hp):
+# =================
+# ENSEMBLE TRAINING
+# =================
+def train_ensemble(net, lossfun, optimizer, train_dataloader, val_dataloader, hp):
+    '''
+    Same as train(), for an EnsembleMLP. All members see the same batches and 
+    each member is optimized on its own loss. Returns the training and validation
+    loss histories with one list per member.
+    '''
 
-    training_loss = []
-    validation_loss = []
+    nmembers = net.nmembers
+    training_loss = [[] for k in range(nmembers)]
+    validation_loss = [[] for k in range(nmembers)]
     val_dataiter = iter(val_dataloader)
 
+    def member_loss(input, target):
+        # input is (nmembers, batch, out_dim), target is (batch, out_dim)
+        if lossfun == 'L1':
+            e = torch.abs(input - target)
+        else:
+            e = (input - target) ** 2
+        return e.mean(dim=(1, 2))
+
     for epoch in range(hp.num_epochs):
         for i, data in enumerate(train_dataloader):
 
             x_batch, y_batch = data
             y_pred = net(x_batch)
 
-            # compute loss
-            loss = loss_fcn(y_pred, y_batch)
+            # compute loss, members are independent so the sum gives each its own gradient
+            loss = member_loss(y_pred, y_batch)
 
             # update parameters
             optimizer.zero_grad()
-            loss.backward()
+            loss.sum().backward()
             optimizer.step()
 
-            batch_loss = loss.item()
-
             if i % hp.print_every == 0:
 
-                # save training loss
-                training_loss.append(batch_loss)
+                batch_loss = loss.detach().numpy()
 
                 # calculate and save validation loss
                 try:
-                    x, y = val_dataiter.next()
+                    x, y = next(val_dataiter)
                 except StopIteration:
                     val_dataiter = iter(val_dataloader)
-                    x, y = val_dataiter.next()
-                
+                    x, y = next(val_dataiter)
+
                 net.eval()
                 with torch.no_grad():
-                    ypred = net(x)
-                    val_loss = loss_fcn(ypred, y).item()
-                    validation_loss.append(val_loss)
+                    val_loss = member_loss(net(x), y).numpy()
                 net.train()
 
-                print('Epoch: %d of %d, train_loss: %3e, val_loss: %3e' %
-                      (epoch + 1, hp.num_epochs, batch_loss, val_loss))
+                for k in range(nmembers):
+                    training_loss[k].append(batch_loss[k])
+                    validation_loss[k].append(val_loss[k])
+
+                print('Epoch: %d of %d, train_loss: %3e-%3e, val_loss: %3e-%3e' %
+                      (epoch + 1, hp.num_epochs, batch_loss.min(), batch_loss.max(), 
+                       val_loss.min(), val_loss.max()))
 
     return net, training_loss, validation_loss
 
 
+# ================================
+# PARALLEL TRAINING ON SHARED DATA
+# ================================
+class ScaledBatches(torch.utils.data.Dataset):
+    '''
+    Rows of X and Y, standardized with the given scaler statistics as they are 
+    fetched. Indexed with a list of rows (e.g. by a BatchSampler), so a whole 
+    batch is scaled at once and X and Y are never copied.
+    '''
+    def __init__(self, X, Y, X_mean, X_scale, Y_mean, Y_scale):
+        self.X, self.Y = X, Y
+        self.X_mean, self.X_scale = X_mean, X_scale
+        self.Y_mean, self.Y_scale = Y_mean, Y_scale
+
+    def __len__(self):
+        return self.X.shape[0]
+
+    def __getitem__(self, idx):
+        return (self.X[idx] - self.X_mean) / self.X_scale, (self.Y[idx] - self.Y_mean) / self.Y_scale
+
+
+def train_on_shared_data(name, hp, train_idx=None, val_idx=None, train_keys=('X', 'Y'), 
+                         val_keys=('valX', 'valY'), test_keys=None, test_idx=None, scaler_keys=None, 
+                         nthreads=1, seed=0):
+    '''
+    Trains an MLP on the rows train_idx of the arrays published under name with
+    nntools.shared_data, validating on the rows val_idx of the val_keys arrays 
+    (None for all rows). Meant to run in a worker process: batches are sampled 
+    from the shared arrays, so the dataset is not copied per worker. 
+    
+    With scaler_keys (the keys of X_mean, X_scale, Y_mean, Y_scale) the arrays 
+    hold unscaled data and each batch is standardized when it is sampled, so 
+    several normalizations (e.g. one per cross-validation fold) can share one 
+    copy of the data. The test losses on the rows test_idx of the test_keys 
+    arrays are then in the unscaled units, comparable between normalizations. 
+    
+    Writes loss.txt (and net.pth if hp.savemodel) to hp.save_results_dir and 
+    returns a dict with the loss histories, final val losses (and test losses, 
+    if test_keys are given) and wall time.
+    '''
+    if hp.get('optimizer', 'adam') != 'adam':
+        raise ValueError('train_on_shared_data samples minibatches, optimizer %s is not supported' % hp.optimizer)
+
+    torch.set_num_threads(nthreads)
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    t0 = time.time()
+
+    data = SharedArrays.attach(name)
+    tensors = data.tensors()
+    X, Y = [tensors[key] for key in train_keys]
+    valX, valY = [tensors[key] for key in val_keys]
+    if train_idx is None:
+        train_idx = np.arange(X.shape[0])
+    if val_idx is None:
+        val_idx = np.arange(valX.shape[0])
+
+    if scaler_keys is None:
+        scalers = None
+        train_dataset, val_dataset = TensorDataset(X, Y), TensorDataset(valX, valY)
+    else:
+        scalers = [tensors[key] for key in scaler_keys]
+        train_dataset, val_dataset = ScaledBatches(X, Y, *scalers), ScaledBatches(valX, valY, *scalers)
+    
+    train_sampler = torch.utils.data.BatchSampler(torch.utils.data.SubsetRandomSampler(train_idx), hp.batch_size, 
+                                                  drop_last=False)
+    val_sampler = torch.utils.data.BatchSampler(torch.utils.data.SubsetRandomSampler(val_idx), len(val_idx), 
+                                                drop_last=False)
+    train_dataloader = DataLoader(train_dataset, batch_size=None, sampler=train_sampler)
+    val_dataloader = DataLoader(val_dataset, batch_size=None, sampler=val_sampler)
+
+    net = MLP(X.shape[1], Y.shape[1], hp.hidden_dims, nonlinearity=hp.nonlinearity,
+              p_dropout_in=hp.p_dropout_in, p_dropout_hidden=hp.p_dropout_hidden)
+    if hp.lossfun=='L1':
+        loss_fcn = torch.nn.L1Loss()
+    else: 
+        loss_fcn = torch.nn.MSELoss()
+    optimizer = make_optimizer(net, hp)
+
+    net, training_loss, validation_loss = train(net, loss_fcn, optimizer, train_dataloader, val_dataloader, hp)
+    net.eval()
+
+    x, y = val_dataset[val_idx]
+    results = {
+        'training_loss': np.asarray(training_loss),
+        'validation_loss': np.asarray(validation_loss),
+        'val_l1_loss': chunked_loss(net, torch.nn.L1Loss(), x, y, hp.get('chunk_size', 10000)),
+        'val_l2_loss': chunked_loss(net, torch.nn.MSELoss(), x, y, hp.get('chunk_size', 10000)),
+        'ntrain': len(train_idx),
+        'wall_time': time.time() - t0,
+    }
+
+    if test_keys is not None:
+        testX, testY = [tensors[key] for key in test_keys]
+        if test_idx is None:
+            test_idx = np.arange(testX.shape[0])
+        testX, testY = testX[test_idx], testY[test_idx]
+        if scalers is None:
+            pred = predict(net, testX, hp.get('chunk_size', 10000))
+        else:
+            # test losses of the de-scaled predictions, in the units of the published data
+            X_mean, X_scale, Y_mean, Y_scale = scalers
+            pred = predict(net, (testX - X_mean) / X_scale, hp.get('chunk_size', 10000)) * Y_scale + Y_mean
+        results['test_l1_loss'] = torch.nn.functional.l1_loss(pred, testY).item()
+        results['test_l2_loss'] = torch.nn.functional.mse_loss(pred, testY).item()
+        del testX, testY, pred
+
+    np.savetxt(hp.save_results_dir + '/loss.txt', (training_loss, validation_loss))
+    if hp.savemodel:
+        torch.save(net.state_dict(), hp.save_results_dir + '/net.pth')
+
+    del X, Y, valX, valY, x, y, tensors, scalers, train_dataset, val_dataset, train_dataloader, val_dataloader
+    data.close()
+
+    return results
+
+
+def dataset_settings(hp):
+    # the settings that define a transformed dataset, jobs sharing one must agree on these
+    return {key: hp[key] for key in ['dataset_dir', 'data_pca_fn', 'xnames', 'ynames']}
+
+
+def publish_dataset(name, hp, traindata, valdata, testdata):
+    '''
+    Fits the preprocessing on traindata and publishes the transformed train, val 
+    and test tensors, the preprocessing and the dataset settings of hp in shared 
+    memory under name. Training processes on the same node attach to it with 
+    attach_dataset instead of each loading and transforming their own copy. 
+    The caller owns the returned SharedArrays and unlinks it when done.
+    '''
+    preprocess = DataPreProcess(traindata, hp.xnames, hp.ynames, t_thresh=None)
+    trainX, trainY,_,_ = preprocess.transform(traindata, randomize=True, holdback_fraction=0, by_shot=True)
+    valX, valY,_,_ = preprocess.transform(valdata, randomize=True, holdback_fraction=0)
+    testX, testY, testshots, testtimes = preprocess.transform(testdata, randomize=False, holdback_fraction=0)
+
+    arrays = {'trainX': trainX, 'trainY': trainY, 'valX': valX, 'valY': valY, 'testX': testX, 'testY': testY,
+              'testshots': testshots, 'testtimes': testtimes}
+    arrays['preprocess'] = np.frombuffer(pickle.dumps(strip_preprocess(preprocess)), dtype=np.uint8)
+    arrays['settings'] = np.frombuffer(json.dumps(dataset_settings(hp)).encode(), dtype=np.uint8)
+
+    return SharedArrays.create(name, arrays)
+
+
+def attach_dataset(name, hp):
+    '''
+    Attaches to a dataset published with publish_dataset. Returns the SharedArrays
+    (keep it alive while its tensors are in use) and the fitted preprocessing.
+    '''
+    shared = SharedArrays.attach(name)
+    settings = json.loads(bytes(shared['settings']).decode())
+    if settings != dataset_settings(hp):
+        shared.close()
+        raise ValueError('Shared dataset %s was published with different data settings: %s' % (name, settings))
+    preprocess = pickle.loads(bytes(shared['preprocess']))
+    return shared, preprocess
+
+
 # ==============
 # LOSS FUNCTIONS
 # ==============
@@ -324,157 +508,97 @@ class PLoss():
         loss = torch.mean(e**self.p)
         return loss
 
-# ===========================
-# MULTILAYER PERCEPTRON CLASS
-# ===========================
-class MLP(nn.Module):
+# ==================================
+# ENSEMBLE OF MULTILAYER PERCEPTRONS
+# ==================================
+class EnsembleMLP(nn.Module):
     '''
-    Multilayer Perceptron.
+    Stack of same-shaped MLPs that are evaluated together with batched matmuls. 
+    Weights are stored as (nmembers, in_dim, out_dim) and each member keeps its
+    own dropout rates. Input is (batch, in_dim) shared by all members, output 
+    is (nmembers, batch, out_dim).
     '''
 
-    def __init__(self, in_dim, out_dim, hidden_dims, nonlinearity='RELU', p_dropout_in=0, p_dropout_hidden=0.2):
+    def __init__(self, mlps):
         super().__init__()
-        
-        if nonlinearity.upper() == 'RELU':
-            nonlinearity = nn.ReLU()
-        elif nonlinearity.upper() == 'TANH':
-            nonlinearity = nn.Tanh()
-        elif nonlinearity.upper() == 'LEAKYRELU':
-            nonlinearity = nn.LeakyReLU()
-        elif nonlinearity.upper() == 'ELU':
-            nonlinearity = nn.ELU()
-        
-        dims = [in_dim]
-        dims.extend(hidden_dims)
-        dims.extend([out_dim])
 
-        nlayers = len(dims) - 1
-        layers = []
+        linears = [[m for m in mlp.net if isinstance(m, nn.Linear)] for mlp in mlps]
+        dropouts = [[m.p for m in mlp.net if isinstance(m, nn.Dropout)] for mlp in mlps]
+        nlayers = len(linears[0])
 
-        for i in range(nlayers):
-            if i == 0:
-                p = p_dropout_in
-            else:
-                p = p_dropout_hidden
-            layers.append(nn.Dropout(p=p))
-            layers.append(nn.Linear(dims[i], dims[i + 1]))
-            layers.append(nonlinearity)
+        for lin in linears:
+            if [l.weight.shape for l in lin] != [l.weight.shape for l in linears[0]]:
+                raise ValueError('Ensemble members must have the same layer shapes.')
 
-        layers.pop()
-        self.net = nn.Sequential(*layers)
+        self.nmembers = len(mlps)
+        self.nonlinearity = [m for m in mlps[0].net if not isinstance(m, (nn.Linear, nn.Dropout))][0] \
+            if nlayers > 1 else None
+        self.weights = nn.ParameterList([nn.Parameter(torch.stack([lin[i].weight.detach().t() for lin in linears]))
+                                         for i in range(nlayers)])
+        self.biases = nn.ParameterList([nn.Parameter(torch.stack([lin[i].bias.detach()[None, :] for lin in linears]))
+                                        for i in range(nlayers)])
+        self.register_buffer('p_dropout', torch.Tensor(dropouts))
 
     def forward(self, x):
-        return self.net(x)
-
-
-# ==================
-# DATA PREPROCESSING
-# ==================
-class DataPreProcess():
-    def __init__(self, datadict, xnames, ynames, t_thresh=None):
-        super().__init__()
-
-        X = self.makeX(datadict, xnames)
-        X_scaler = StandardScaler()
-        X_scaler.fit(X)
-
-        Y = self.makeX(datadict, ynames)
-        Y_scaler = StandardScaler()
-        Y_scaler.fit(Y)
-
-        # write to class object
-        self.X_scaler = X_scaler
-        self.Y_scaler = Y_scaler
-        self.Y_pca = datadict[ynames[0]]
-        self.t_thresh = t_thresh        
-        self.xnames = xnames
-        self.ynames = ynames
-
-    def makeX(self, datadict, xnames):
-
-        for i, key in enumerate(xnames):
-
-            try:
-                x = datadict[key].coeff_
-            except:
-                x = datadict[key]
-
-            if i == 0:
-                Xdata = np.copy(x)
-            else:
-                Xdata = np.hstack([Xdata, x])
-
-        return Xdata
-
-    def transform(self, datadict, randomize=True, holdback_fraction=0.0, by_shot=False):
 
-        X = self.makeX(datadict, self.xnames)
-        Y = self.makeX(datadict, self.ynames)
+        x = x.expand(self.nmembers, *x.shape)
+        nlayers = len(self.weights)
 
-        X = self.X_scaler.transform(X)
-        Y = self.Y_scaler.transform(Y)
-
-        time = datadict['time']
-        shot = datadict['shot']
+        for i in range(nlayers):
+            p = self.p_dropout[:, i]
+            if self.training and p.max() > 0:
+                p = p.view(-1, 1, 1)
+                x = x * (torch.rand_like(x) >= p) / (1 - p)
+            x = torch.baddbmm(self.biases[i], x, self.weights[i])
+            if i < nlayers - 1:
+                x = self.nonlinearity(x)
+        return x
+
+    def member_state_dict(self, k):
+        # state dict of member k, loadable by an MLP of the same shape
+        state_dict = {}
+        for i in range(len(self.weights)):
+            state_dict['net.%d.weight' % (3*i + 1)] = self.weights[i][k].detach().t().clone()
+            state_dict['net.%d.bias' % (3*i + 1)] = self.biases[i][k, 0].detach().clone()
+        return state_dict
+
+
+class EnsembleAdam(torch.optim.Optimizer):
+    '''
+    Adam for EnsembleMLP parameters, with one learning rate per ensemble member
+    (the leading dimension of every parameter).
+    '''
 
-        # use only certain times
-        if self.t_thresh is not None:
-            t = datadict['time']
-            iuse = np.where(t > self.t_thresh)[0]
-            X = X[iuse, :]
-            Y = Y[iuse, :]
-            time = time[iuse]
-            shot = shot[iuse]
-        
-        # remove samples with nans
-        i = ~np.isnan(X).any(axis=1) & ~np.isnan(Y).any(axis=1)
-        X = X[i,:]
-        Y = Y[i,:]
-        time = time[i]
-        shot = shot[i]
-
-        if holdback_fraction > 0 and by_shot:
-            uniqshots = np.unique(shot)
-            sz = int( (1.0-holdback_fraction)*len(uniqshots))
-            select_shots = np.random.choice(uniqshots, sz, replace=False)
-            
-            for ishot, select_shot in enumerate(select_shots):
-                
-                k = np.where(shot == select_shot)[0]
-                if ishot==0:
-                    idx = k
-                else:
-                    idx = np.hstack((idx,k))
-            
-            X = X[idx,:]
-            Y = Y[idx,:]
-            time = time[idx]
-            shot = shot[idx]
+    def __init__(self, params, lr, betas=(0.9, 0.999), eps=1e-8):
+        defaults = dict(lr=torch.Tensor(lr), betas=betas, eps=eps)
+        super().__init__(params, defaults)
 
-        # convert to torch data types
-        X = torch.Tensor(X)
-        Y = torch.Tensor(Y)
+    @torch.no_grad()
+    def step(self, closure=None):
 
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
 
-        # randomize order
-        if randomize:
-            idx = torch.randperm(X.shape[0])
-            X = X[idx, :]
-            Y = Y[idx, :]
-            time = time[idx]
-            shot = shot[idx]
+            for p in group['params']:
+                if p.grad is None:
+                    continue
 
+                state = self.state[p]
+                if len(state) == 0:
+                    state['step'] = 0
+                    state['exp_avg'] = torch.zeros_like(p)
+                    state['exp_avg_sq'] = torch.zeros_like(p)
 
-        # hold back some samples
-        if holdback_fraction > 0 and not by_shot:
-            nsamples = X.shape[0]
-            nkeep = int((1.0 - holdback_fraction)*nsamples)
-            X = X[:nkeep,:]
-            Y = Y[:nkeep,:]
-            time = time[:nkeep]
-            shot = shot[:nkeep]
+                state['step'] += 1
+                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+                exp_avg.mul_(beta1).add_(p.grad, alpha=1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(p.grad, p.grad, value=1 - beta2)
 
-        return X, Y, shot, time
+                bias_correction1 = 1 - beta1 ** state['step']
+                bias_correction2 = 1 - beta2 ** state['step']
+                denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(group['eps'])
+                step_size = (group['lr'] / bias_correction1).view(-1, *[1] * (p.dim() - 1))
+                p.sub_(step_size * exp_avg / denom)
 
 
 # ==================
@@ -514,10 +638,16 @@ class GrowthRate():
 # plot shape timetraces
 # ======================
 
-def plot_shape_timetraces(shotlist, net, valdata, preprocess,hp):
+def plot_shape_timetraces(shotlist, net, valdata, preprocess,hp, ynames=None):
     
+    # ynames: scalar targets to plot, default all of hp.ynames
+    if ynames is None:
+        ynames = hp.ynames
+    icols = [preprocess.ynames.index(yname) for yname in ynames]
+    icols = [int(np.sum(preprocess.ydims[:k])) for k in icols]
+
     X,Y,shots,times = preprocess.transform(valdata, randomize=False, holdback_fraction=0)
-    Ypred = net(X).detach().numpy()    
+    Ypred = predict(net, X).numpy()    
 
     Y = preprocess.Y_scaler.inverse_transform(Y)
     Ypred = preprocess.Y_scaler.inverse_transform(Ypred)
@@ -527,13 +657,13 @@ def plot_shape_timetraces(shotlist, net, valdata, preprocess,hp):
         
         i = np.where(shots==shot)[0]
         fig = plt.figure(figsize=(16, 10))
-        ax = list(range(len(hp.ynames)))
+        ax = list(range(len(ynames)))
         
-        for k, yname in enumerate(hp.ynames):
+        for k, yname in enumerate(ynames):
 
             ax[k] = fig.add_subplot(4, 5, k+1)
-            ax[k].plot( times[i], Y[i,k], c='r', linestyle='dashed')
-            ax[k].plot( times[i], Ypred[i,k], c='b', linestyle='dashed')    
+            ax[k].plot( times[i], Y[i,icols[k]], c='r', linestyle='dashed')
+            ax[k].plot( times[i], Ypred[i,icols[k]], c='b', linestyle='dashed')    
             ax[k].set_ylabel(yname)
             ax[k].set_xlabel('Time [s]')
 
@@ -551,8 +681,7 @@ def gen_output_preds(data, preprocess, net, hp):
     
 
     X, Y, shots, times = preprocess.transform(data, randomize=False, holdback_fraction=0)
-    Ypred = net(X)    
-    Ypred = Ypred.detach().numpy()
+    Ypred = predict(net, X).numpy()
     Y = Y.detach().numpy()
     X = X.detach().numpy()
 
@@ -565,6 +694,21 @@ def gen_output_preds(data, preprocess, net, hp):
     out['shots'] = shots
     out['times'] = times
 
+    # per-head outputs and losses (normalized units) of multi-head nets
+    if isinstance(net, MultiHeadMLP):
+        out['head_l1_loss'] = {}
+        out['head_l2_loss'] = {}
+        istart = 0
+        head_names = hp.get('head_names') or ['flux', 'shape']
+        for head_name, head_dim in zip(head_names, net.head_dims):
+            istop = istart + head_dim
+            err = Ypred[:, istart:istop] - Y[:, istart:istop]
+            out[head_name + '_coeff'] = out['Y_coeff'][:, istart:istop]
+            out[head_name + '_pred_coeff'] = out['Ypred_coeff'][:, istart:istop]
+            out['head_l1_loss'][head_name] = float(np.mean(np.abs(err)))
+            out['head_l2_loss'][head_name] = float(np.mean(err**2))
+            istart = istop
+
     for tag in hp.xnames + hp.ynames:
 
         pca = data[tag]
@@ -604,6 +748,7 @@ def plot_flux_preds(shot, plot_times, net, testdata, preprocess, tok_data, hp):
     def inverse_transform(y):
         y = y.detach().numpy()
         y = preprocess.Y_scaler.inverse_transform(y)
+        y = y[:, :preprocess.ydims[0]]   # multi-task nets: flux target only
         y = preprocess.Y_pca.inverse_transform(y)
         y = y.reshape(-1, 65, 65)
         # y = np.transpose(y, (0,2,1))
@@ -620,7 +765,7 @@ def plot_flux_preds(shot, plot_times, net, testdata, preprocess, tok_data, hp):
     X = X[iuse,:]
     Y = Y[iuse,:]    
 
-    Ypred = net(X)
+    Ypred = predict(net, X)
     flux_efit_projected = inverse_transform(Y)
     flux_pred = inverse_transform(Ypred)
 
@@ -680,17 +825,6 @@ def plot_flux_preds(shot, plot_times, net, testdata, preprocess, tok_data, hp):
     
 
 
-
-
-
-
-
-
-
-
-
-
-
     
     
     
@@ -0,0 +1,106 @@
+'''
+Learning curve: validation loss versus the number of training shots, using the
+dataset and network defined in args.json of the current directory.
+
+The data is loaded and transformed once and published in shared memory
+(nntools.shared_data). Nested subsets of the training shots (the first 10%, 20%,
+... of one random shot ordering) are then trained in parallel worker processes,
+which all sample their batches from the same shared copy of the data. All subsets
+use the normalization fit on the full training set and are validated on the full
+validation set.
+
+Each subset writes loss.txt (and metrics.jsonl) to learning_curve/nshots<n>/ and
+the summary table is printed and written to learning_curve.txt.
+'''
+
+import os
+ROOT = os.environ['NN_ROOT']
+import sys
+sys.path.append(ROOT)
+import numpy as np
+from easydict import EasyDict
+import json
+import copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from eqnet.data.data_utils import load_data
+from eqnet.net.eqnet_utils import DataPreProcess, train_val_test_split, train_on_shared_data
+from nntools.shared_data import SharedArrays
+
+fractions = [0.1, 0.2, 0.3, 0.5, 0.7, 1.0]   # fractions of the training shots
+nworkers = 4             # number of subsets trained concurrently
+nthreads = 1             # torch threads per worker
+seed = 0                 # seed of the shot ordering
+
+
+def main():
+
+    # load parameters
+    fn = os.getcwd() + '/args.json'
+    with open(fn) as infile:
+        hp = EasyDict(json.load(infile))
+    hp.root = ROOT
+    hp.checkpoint_every = 0
+
+    # load and process data, once
+    print('Loading data...')
+    data_pca = load_data(ROOT + hp.dataset_dir + hp.data_pca_fn)
+    traindata, valdata, testdata = train_val_test_split(data_pca, ftrain=0.8, fval=0.1, mix=True)
+    del data_pca, testdata
+
+    print('Normalizing data...')
+    preprocess = DataPreProcess(traindata, hp.xnames, hp.ynames, t_thresh=None)
+    trainX, trainY, trainshots, _ = preprocess.transform(traindata, randomize=True, holdback_fraction=0)
+    valX, valY, _, _ = preprocess.transform(valdata, randomize=True, holdback_fraction=0)
+    trainshots = np.asarray(trainshots).reshape(-1)
+    del traindata, valdata
+
+    # nested shot subsets
+    shotlist = np.unique(trainshots)
+    np.random.default_rng(seed).shuffle(shotlist)
+    subsets = []
+    for fraction in fractions:
+        nshots = max(int(round(fraction * len(shotlist))), 1)
+        idx = np.where(np.isin(trainshots, shotlist[:nshots]))[0]
+        subsets.append((fraction, nshots, idx))
+
+    name = 'eqnet_lc_%d' % os.getpid()
+    shared = SharedArrays.create(name, {'X': trainX, 'Y': trainY, 'valX': valX, 'valY': valY})
+    del trainX, trainY, valX, valY
+    print('Published %.1f MB of training data as %s' % (shared.nbytes() / 1e6, name))
+
+    try:
+        # largest subsets first, for better load balancing
+        ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=nworkers, mp_context=ctx) as pool:
+            futures = {}
+            for fraction, nshots, idx in sorted(subsets, key=lambda s: -len(s[2])):
+                hp_k = copy.deepcopy(hp)
+                hp_k.save_results_dir = os.getcwd() + '/learning_curve/nshots%03d/' % nshots
+                os.makedirs(hp_k.save_results_dir, exist_ok=True)
+                futures[nshots] = pool.submit(train_on_shared_data, name, hp_k, train_idx=idx,
+                                              nthreads=nthreads, seed=seed)
+
+            results = []
+            for fraction, nshots, idx in subsets:
+                r = futures[nshots].result()
+                results.append((fraction, nshots, r))
+                print('%d shots done, val loss %.4e' % (nshots, np.min(r['validation_loss'])))
+    finally:
+        shared.unlink()
+
+    # report
+    lines = ['%10s %8s %10s %14s %14s %14s %12s' % ('fraction', 'nshots', 'nsamples', 'best val loss',
+                                                    'val L1 loss', 'val L2 loss', 'wall time[s]')]
+    for fraction, nshots, r in results:
+        lines.append('%10.2f %8d %10d %14.4e %14.4e %14.4e %12.1f' % (fraction, nshots, r['ntrain'],
+                     np.min(r['validation_loss']), r['val_l1_loss'], r['val_l2_loss'], r['wall_time']))
+    report = '\n'.join(lines)
+    print('\n' + report)
+
+    with open(os.getcwd() + '/learning_curve.txt', 'w') as outfile:
+        outfile.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
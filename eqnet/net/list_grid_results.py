@@ -1,19 +1,24 @@
 from easydict import EasyDict
 import numpy as np
 import os
+import sys
 import matplotlib.pyplot as plt
 
 ROOT = os.environ['NN_ROOT']
 job_topdir = ROOT + 'eqnet/jobs/forward-profiles/jobs016a/'
+sys.path.append(ROOT)
+from nntools.jobs import list_jobdirs
+from nntools.latency import latency_report
 
 
-N = len(os.listdir(job_topdir))
+jobdirs = list_jobdirs(job_topdir)
+N = len(jobdirs)
 
 loss = []
 
 for i in range(N):
     try:
-        loss_fn = job_topdir + 'job' + str(i) + '/loss.txt'
+        loss_fn = jobdirs[i] + 'loss.txt'
         l = np.loadtxt(loss_fn)[1,-1]
         loss.append(l)
     except:
@@ -25,26 +30,29 @@ idx = loss.argsort()[:10]
 best_loss = loss[idx]
 
 print('\nBest jobs:')
-print(idx)
+print([jobdirs[i] for i in idx])
 print('\nLoss of best jobs:')
 print(best_loss)
 
+# loss vs inference latency of the jobs that were benchmarked
+print('\n' + latency_report(job_topdir))
+
 
 plt.plot(loss)
 plt.show()
 
 
-cmd = 'xdg-open ' + job_topdir + 'job' + str(idx[0]) + '/eq203172.png'
+cmd = 'xdg-open ' + jobdirs[idx[0]] + 'eq203172.png'
 os.system(cmd)
 
-cmd = 'xdg-open ' + job_topdir + 'job' + str(idx[0]) + '/eq204155.png'
+cmd = 'xdg-open ' + jobdirs[idx[0]] + 'eq204155.png'
 os.system(cmd)
 
-cmd = 'xdg-open ' + job_topdir + 'job' + str(idx[0]) + '/eq204069.png'
+cmd = 'xdg-open ' + jobdirs[idx[0]] + 'eq204069.png'
 os.system(cmd)
 
-cmd = 'xdg-open ' + job_topdir + 'job' + str(idx[0]) + '/eq203942.png'
+cmd = 'xdg-open ' + jobdirs[idx[0]] + 'eq203942.png'
 os.system(cmd)
 
-cmd = 'xdg-open ' + job_topdir + 'job' + str(idx[0]) + '/loss_curve.png'
+cmd = 'xdg-open ' + jobdirs[idx[0]] + 'loss_curve.png'
 os.system(cmd)
@@ -0,0 +1,192 @@
+'''
+Local prediction server. Loads eqnet or pertnet model bundles (model_bundle.npz,
+see save_bundle in nntools/bundle.py) once and serves predictions over HTTP on
+localhost. Concurrent requests to the same model are coalesced into 
+micro-batches of at most max_batch_size samples, waiting at most max_wait_ms for
+a batch to fill (see nntools/microbatch.py), so many clients querying one time
+slice at a time share the torch dispatch cost.
+
+    POST /predict/<model>   {"inputs": {xname: [[...], ...], ...}}  ->  {"outputs": {yname: [[...], ...]}}
+    GET  /models            xnames/ynames and raw input dims of each model
+    GET  /stats             throughput and latency counters of each model
+
+Inputs are the raw variables (one row per sample, or a single sample as a flat
+list), outputs the raw predictions, e.g. the flattened 65x65 flux.
+
+usage: python prediction_server.py name=path/model_bundle.npz [...] [--port 8765]
+       python prediction_server.py [name=path/model_bundle.npz ...] --selftest
+
+--selftest runs the server on a free port of this machine, checks concurrent
+requests against direct bundle predictions and prints the counters. Without
+bundles it serves random-weight eqnet and pertnet test bundles (see random_bundle
+in nntools/bundle.py).
+'''
+
+import os
+ROOT = os.environ['NN_ROOT']
+import sys
+sys.path.append(ROOT)
+import json
+import time
+import argparse
+import threading
+import urllib.request
+import numpy as np
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from nntools.training import predict
+from nntools.bundle import load_bundle, random_bundle
+from nntools.microbatch import MicroBatcher
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+
+    def reply(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.reply(200, {name: batcher.stats() for name, batcher in self.server.batchers.items()})
+        elif self.path == '/models':
+            self.reply(200, {name: {'xnames': b.xnames, 'ynames': b.ynames, 'xdims': dict(zip(b.xnames, b.xraw_dims))}
+                             for name, b in self.server.bundles.items()})
+        else:
+            self.reply(404, {'error': 'unknown path ' + self.path})
+
+    def do_POST(self):
+        name = self.path[len('/predict/'):] if self.path.startswith('/predict/') else None
+        if name not in self.server.bundles:
+            self.reply(404, {'error': 'unknown model %s' % name})
+            return
+        bundle = self.server.bundles[name]
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            X = bundle.encode(request['inputs'])
+        except Exception as e:
+            self.reply(400, {'error': repr(e)})
+            return
+        try:
+            Y = self.server.batchers[name](X)
+        except Exception as e:
+            self.reply(500, {'error': repr(e)})
+            return
+        outputs = bundle.decode(Y)
+        self.reply(200, {'outputs': {yname: y.tolist() for yname, y in outputs.items()}})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PredictionServer(ThreadingHTTPServer):
+    '''
+    HTTP server for the model bundles in bundles (name -> ModelBundle), with one
+    micro-batcher per model. port=0 picks a free port (see server_address).
+    '''
+    daemon_threads = True
+
+    def __init__(self, bundles, host='127.0.0.1', port=8765, max_batch_size=256, max_wait_ms=2.0):
+        super().__init__((host, port), PredictionHandler)
+        self.bundles = bundles
+        self.batchers = {}
+        for name, bundle in bundles.items():
+            fn = lambda X, net=bundle.net: predict(net, X, chunk_size=max_batch_size).numpy().astype(np.float64)
+            self.batchers[name] = MicroBatcher(fn, max_batch_size, max_wait_ms)
+
+    def server_close(self):
+        super().server_close()
+        for batcher in self.batchers.values():
+            batcher.close()
+
+
+def request(url, model, inputs):
+    # predictions of model on the server at url, as a dict of arrays
+    body = json.dumps({'inputs': {k: np.asarray(v).tolist() for k, v in inputs.items()}}).encode()
+    req = urllib.request.Request(url + '/predict/' + model, data=body, headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req) as response:
+        return {k: np.asarray(v) for k, v in json.loads(response.read())['outputs'].items()}
+
+
+def get(url, path):
+    with urllib.request.urlopen(url + path) as response:
+        return json.loads(response.read())
+
+
+def selftest(server, nclients=16, nrequests=50):
+    '''
+    Sends nclients x nrequests single-sample requests from concurrent threads
+    to each model and compares them with the direct bundle predictions.
+    '''
+    url = 'http://%s:%d' % server.server_address[:2]
+    rng = np.random.default_rng(0)
+
+    for name, bundle in server.bundles.items():
+        dims = dict(zip(bundle.xnames, bundle.xraw_dims))
+        samples = [{x: rng.normal(size=dim) for x, dim in dims.items()} for i in range(nclients * nrequests)]
+        server.batchers[name].reset_stats()
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(nclients) as pool:
+            results = list(pool.map(lambda s: request(url, name, s), samples))
+        elapsed = time.perf_counter() - t0
+
+        err = 0.0
+        for sample, result in zip(samples[:100], results[:100]):
+            ref = bundle.predict(sample)
+            err = max(err, max(np.abs(result[y] - ref[y]).max() / (np.abs(ref[y]).max() + 1e-12) for y in ref))
+
+        print('%s: %d requests from %d clients in %.2f s (%.0f requests/s), max relative error %.1e' %
+              (name, len(samples), nclients, elapsed, len(samples) / elapsed, err))
+        print(json.dumps(get(url, '/stats')[name], indent=4))
+        if err > 1e-4:
+            raise AssertionError('server predictions differ from the bundle predictions')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Serve model bundles on localhost with micro-batching.')
+    parser.add_argument('bundles', nargs='*', help='name=path/model_bundle.npz')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max_batch_size', type=int, default=256)
+    parser.add_argument('--max_wait_ms', type=float, default=2.0, help='latency budget for filling a batch')
+    parser.add_argument('--selftest', action='store_true', help='check concurrent requests on a free port and exit')
+    args = parser.parse_args()
+
+    bundles = {}
+    for spec in args.bundles:
+        name, fn = spec.split('=', 1)
+        t0 = time.perf_counter()
+        bundles[name] = load_bundle(fn)
+        print('Loaded %s from %s in %.1f ms' % (name, fn, (time.perf_counter() - t0) * 1000))
+    if not bundles:
+        if not args.selftest:
+            parser.error('no bundles given')
+        print('No bundles given, serving random-weight test bundles')
+        bundles['eqnet'] = random_bundle('eqnet')
+        bundles['pertnet'] = random_bundle('pertnet', multihead=True)
+
+    server = PredictionServer(bundles, args.host, 0 if args.selftest else args.port,
+                              args.max_batch_size, args.max_wait_ms)
+
+    if args.selftest:
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            selftest(server)
+        finally:
+            server.shutdown()
+            server.server_close()
+        sys.exit()
+
+    print('Serving %s on http://%s:%d' % (', '.join(bundles), *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,436 @@
+'''
+Realtime predictor for control loops. A RealtimePredictor is built from a model
+bundle (see save_bundle in nntools/bundle.py, written by eqnet_batch.py and
+pertnet_batch.py) and holds the input PCA projections,
+the X/Y scaler statistics, the net weights and the output PCA bases as
+contiguous float32 arrays. One call maps one sample of raw inputs to the raw
+outputs without sklearn or torch, writing every intermediate result into
+buffers allocated once in the constructor:
+
+    predictor = RealtimePredictor(load_bundle('model_bundle.npz'))
+    predictor.inputs['ip'][:] = ...       # views into predictor.x, or fill predictor.x directly
+    predictor.run()
+    psi = predictor.outputs['psizr']      # views into predictor.out, overwritten by the next run
+
+With fold_input=True the input PCA projections and the X scaler, which are
+affine, are folded into the first layer (see fold_input_layer), so the net
+takes the concatenated raw inputs directly. Likewise fold_output=yname folds the
+Y de-scaling and the PCA reconstruction of output yname into the last layer
+(see fold_output_layer), so that the net emits the flattened field (e.g. the
+65x65 psizr or dpsidix) in one product, or only the grid rows and columns
+selected by rows and cols. The other outputs are dropped then. export_net gives
+the folded net as a torch MLP, e.g. for predict() in nntools/training.py, and
+check_export tests it against the unfolded bundle.
+
+The benchmark runs the predictor ncalls times on one thread and prints the
+p50/p99/p99.9/max latency of a call, after checking it (and the exported net)
+against the bundle to a relative error of tol. Without a bundle, selftest first
+checks every folding on random-weight eqnet and pertnet bundles (see random_bundle
+in nntools/bundle.py).
+
+usage: python realtime_predictor.py [path/model_bundle.npz] [--ncalls 1000000] [--fold_input]
+                                    [--fold_output yname] [--rows 0 1 ...] [--cols 0 1 ...]
+                                    [--export folded_net.pth] [--tol 1e-4]
+'''
+
+import os
+# single-sample products are far too small to gain from BLAS threads
+for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+    os.environ.setdefault(var, '1')
+ROOT = os.environ['NN_ROOT']
+import sys
+sys.path.append(ROOT)
+import gc
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+from scipy.linalg import block_diag
+from nntools.models import MLP, MultiHeadMLP
+from nntools.training import predict
+from nntools.bundle import load_bundle, random_bundle
+
+
+def linear_layers(net):
+    '''
+    (W, b) of each layer of an MLP or MultiHeadMLP in evaluation mode, as the
+    layers of one plain MLP with the nonlinearity between consecutive layers.
+    The heads of a MultiHeadMLP are stacked: their first layers on top of each
+    other, their later layers block-diagonally.
+    '''
+    def weights(mlp):
+        return [(m.weight.detach().cpu().numpy().astype(np.float64), m.bias.detach().cpu().numpy().astype(np.float64))
+                for m in mlp.net if isinstance(m, nn.Linear)]
+
+    if not isinstance(net, MultiHeadMLP):
+        return weights(net)
+
+    heads = [weights(head) for head in net.heads]
+    layers = weights(net.trunk)
+    layers.append((np.vstack([head[0][0] for head in heads]), np.hstack([head[0][1] for head in heads])))
+    for i in range(1, len(heads[0])):
+        layers.append((block_diag(*[head[i][0] for head in heads]), np.hstack([head[i][1] for head in heads])))
+    return layers
+
+
+def input_affine(bundle):
+    '''
+    (A, c) such that the scaled net input is A @ x + c for the concatenated raw
+    inputs x: the PCA projection of each variable (identity for raw variables)
+    followed by the X scaler.
+    '''
+    blocks = []
+    offset = np.array(bundle.X_mean, dtype=np.float64)
+    j = 0
+    for name, dim in zip(bundle.xnames, bundle.xdims):
+        if name in bundle.xpca:
+            mean, components = bundle.xpca[name]
+            blocks.append(components)
+            offset[j:j + dim] += components @ mean
+        else:
+            blocks.append(np.eye(dim))
+        j += dim
+    A = block_diag(*blocks) / bundle.X_scale[:, None]
+    c = -offset / bundle.X_scale
+    return A, c
+
+
+def fold_input_layer(layers, bundle):
+    # layers with the input PCA projections and X scaler folded into the first layer
+    A, c = input_affine(bundle)
+    W, b = layers[0]
+    return [(W @ A, W @ c + b)] + list(layers[1:])
+
+
+def output_index(bundle, yname, rows=None, cols=None):
+    '''
+    Indices into raw output yname of the grid points in rows x cols (default
+    all), for a field flattened from a square grid as in plot_flux_preds.
+    '''
+    dim = bundle.yraw_dims[bundle.ynames.index(yname)]
+    if rows is None and cols is None:
+        return np.arange(dim)
+    n = int(round(np.sqrt(dim)))
+    if n * n != dim:
+        raise ValueError('%s is not a square grid (%d points)' % (yname, dim))
+    rows = np.arange(n) if rows is None else np.asarray(rows)
+    cols = np.arange(n) if cols is None else np.asarray(cols)
+    return (rows[:, None] * n + cols[None, :]).reshape(-1)
+
+
+def output_affine(bundle, yname, rows=None, cols=None):
+    '''
+    (B, d) such that raw output yname, at the grid points of output_index, is
+    B @ y + d for the scaled net output y: the Y scaler inverse followed by the
+    PCA reconstruction.
+    '''
+    k = bundle.ynames.index(yname)
+    j = int(np.sum(bundle.ydims[:k]))
+    dim = bundle.ydims[k]
+    idx = output_index(bundle, yname, rows, cols)
+    if yname in bundle.ypca:
+        mean, components = bundle.ypca[yname]
+        P, mean = components.T[idx], mean[idx]
+    else:
+        P, mean = np.eye(dim)[idx], np.zeros(len(idx))
+    B = np.zeros((len(idx), len(bundle.Y_scale)))
+    B[:, j:j + dim] = P * bundle.Y_scale[j:j + dim]
+    d = P @ bundle.Y_mean[j:j + dim] + mean
+    return B, d
+
+
+def fold_output_layer(layers, bundle, yname, rows=None, cols=None):
+    # layers with the Y de-scaling and PCA reconstruction of yname folded into the last layer
+    B, d = output_affine(bundle, yname, rows, cols)
+    W, b = layers[-1]
+    return list(layers[:-1]) + [(B @ W, B @ b + d)]
+
+
+def export_net(bundle, fold_input=True, fold_output=None, rows=None, cols=None):
+    '''
+    The net of a bundle as a plain torch MLP (heads of a MultiHeadMLP stacked, see
+    linear_layers), with the input preprocessing folded into the first layer if
+    fold_input, so that it maps the concatenated raw inputs (in the order
+    of bundle.xnames) to the scaled outputs, or with fold_output=yname directly
+    to raw output yname at the grid points in rows x cols.
+    '''
+    layers = linear_layers(bundle.net)
+    if fold_input:
+        layers = fold_input_layer(layers, bundle)
+    if fold_output is not None:
+        layers = fold_output_layer(layers, bundle, fold_output, rows, cols)
+    dims = [W.shape[0] for W, b in layers]
+    net = MLP(layers[0][0].shape[1], dims[-1], dims[:-1], nonlinearity=bundle.meta['nonlinearity'])
+    linears = [m for m in net.net if isinstance(m, nn.Linear)]
+    with torch.no_grad():
+        for m, (W, b) in zip(linears, layers):
+            m.weight.copy_(torch.from_numpy(W))
+            m.bias.copy_(torch.from_numpy(b))
+    net.eval()
+    return net
+
+
+def check_export(net, bundle, fold_input=True, fold_output=None, rows=None, cols=None, nsamples=1000, seed=0):
+    '''
+    Max deviation, relative to the output range, of a net from export_net from
+    the unfolded pipeline (bundle.encode and the original net) on random raw
+    inputs around the input PCA means.
+    '''
+    rng = np.random.default_rng(seed)
+    inputs = {}
+    for name, raw_dim in zip(bundle.xnames, bundle.xraw_dims):
+        mean = bundle.xpca[name][0] if name in bundle.xpca else 0
+        inputs[name] = mean + rng.normal(size=(nsamples, raw_dim)) * np.maximum(np.abs(mean), 1)
+    X = bundle.encode(inputs)
+    Xraw = np.hstack([inputs[name] for name in bundle.xnames])
+    with torch.no_grad():
+        ref = predict(bundle.net, torch.Tensor(X)).numpy()
+        Y = predict(net, torch.Tensor(Xraw if fold_input else X)).numpy()
+    if fold_output is not None:
+        ref = bundle.decode(ref.astype(np.float64))[fold_output][:, output_index(bundle, fold_output, rows, cols)]
+    return np.abs(Y - ref).max() / (np.abs(ref).max() + 1e-12)
+
+
+class RealtimePredictor():
+
+    def __init__(self, bundle, dtype=np.float32, fold_input=False, fold_output=None, rows=None, cols=None):
+
+        def array(a):
+            return np.ascontiguousarray(a, dtype=dtype)
+
+        self.xnames = bundle.xnames
+        self.ynames = bundle.ynames if fold_output is None else [fold_output]
+        self.nonlinearity = bundle.meta['nonlinearity'].upper()
+        if self.nonlinearity not in ['RELU', 'TANH', 'LEAKYRELU', 'ELU']:
+            raise ValueError('Unsupported nonlinearity: ' + self.nonlinearity)
+
+        # input: raw variables -> PCA coefficients -> scaled net input
+        xraw_dims = bundle.xraw_dims
+        self.x = np.zeros(sum(xraw_dims), dtype=dtype)
+        self.inputs = {}
+        i = 0
+        for name, raw_dim in zip(bundle.xnames, xraw_dims):
+            self.inputs[name] = self.x[i:i + raw_dim]
+            i += raw_dim
+
+        self.fold_input = fold_input
+        if fold_input:
+            self.z = self.x
+        else:
+            self.z = np.zeros(sum(bundle.xdims), dtype=dtype)
+            self.xblocks = []
+            offset = np.array(bundle.X_mean, dtype=np.float64)
+            i = j = 0
+            for name, raw_dim, dim in zip(bundle.xnames, xraw_dims, bundle.xdims):
+                if name in bundle.xpca:
+                    mean, components = bundle.xpca[name]
+                    offset[j:j + dim] += components @ mean
+                    self.xblocks.append((array(components), self.x[i:i + raw_dim], self.z[j:j + dim]))
+                else:
+                    self.xblocks.append((None, self.x[i:i + raw_dim], self.z[j:j + dim]))
+                i += raw_dim
+                j += dim
+            self.x_offset = array(offset)
+            self.x_invscale = array(1 / bundle.X_scale)
+
+        # net
+        layers = linear_layers(bundle.net)
+        if fold_input:
+            layers = fold_input_layer(layers, bundle)
+        if fold_output is not None:
+            layers = fold_output_layer(layers, bundle, fold_output, rows, cols)
+        self.layers = [(array(W), array(b)) for W, b in layers]
+        self.h = [np.zeros(len(b), dtype=dtype) for W, b in self.layers]
+        self.tmp = np.zeros(max(len(b) for W, b in self.layers), dtype=dtype)
+        self.mask = np.zeros(len(self.tmp), dtype=bool)
+
+        # output: scaled net output -> PCA coefficients -> raw variables
+        self.fold_output = fold_output
+        self.y = self.h[-1]
+        if fold_output is not None:
+            self.out = self.y
+            self.outputs = {fold_output: self.out}
+            self.yindex = {fold_output: output_index(bundle, fold_output, rows, cols)}
+            return
+
+        self.Y_scale = array(bundle.Y_scale)
+        self.Y_mean = array(bundle.Y_mean)
+        yraw_dims = bundle.yraw_dims
+        self.out = np.zeros(sum(yraw_dims), dtype=dtype)
+        self.outputs = {}
+        self.yindex = {}
+        self.yblocks = []
+        i = j = 0
+        for name, raw_dim, dim in zip(bundle.ynames, yraw_dims, bundle.ydims):
+            self.outputs[name] = self.out[i:i + raw_dim]
+            self.yindex[name] = np.arange(raw_dim)
+            if name in bundle.ypca:
+                mean, components = bundle.ypca[name]
+                self.yblocks.append((array(components), array(mean), self.y[j:j + dim], self.out[i:i + raw_dim]))
+            else:
+                self.yblocks.append((None, None, self.y[j:j + dim], self.out[i:i + raw_dim]))
+            i += raw_dim
+            j += dim
+
+    def activate(self, h):
+        # nonlinearity in place
+        if self.nonlinearity == 'RELU':
+            np.maximum(h, 0, out=h)
+        elif self.nonlinearity == 'TANH':
+            np.tanh(h, out=h)
+        else:
+            tmp = self.tmp[:len(h)]
+            mask = self.mask[:len(h)]
+            np.less(h, 0, out=mask)
+            if self.nonlinearity == 'ELU':
+                np.expm1(h, out=tmp)
+            else:
+                np.multiply(h, 0.01, out=tmp)
+            np.copyto(h, tmp, where=mask)
+
+    def run(self):
+        # predicts the outputs from the inputs in self.x, results in self.out
+        if not self.fold_input:
+            for components, x, z in self.xblocks:
+                if components is None:
+                    z[:] = x
+                else:
+                    np.dot(components, x, out=z)
+            z = self.z
+            z -= self.x_offset
+            z *= self.x_invscale
+
+        h = self.z
+        nlayers = len(self.layers)
+        for k in range(nlayers):
+            W, b = self.layers[k]
+            out = self.h[k]
+            np.dot(W, h, out=out)
+            out += b
+            if k < nlayers - 1:
+                self.activate(out)
+            h = out
+
+        if self.fold_output is not None:
+            return self.out
+
+        y = self.y
+        y *= self.Y_scale
+        y += self.Y_mean
+        for components, mean, y, out in self.yblocks:
+            if components is None:
+                out[:] = y
+            else:
+                np.dot(y, components, out=out)
+                out += mean
+        return self.out
+
+    def __call__(self, x):
+        # predicts from the concatenated raw inputs x, returns the (reused) output buffer
+        self.x[:] = x
+        return self.run()
+
+
+def check(predictor, bundle, nsamples=100, seed=0):
+    # max relative deviation of predictor from the bundle predictions on random inputs
+    rng = np.random.default_rng(seed)
+    err = 0.0
+    for i in range(nsamples):
+        predictor.x[:] = rng.normal(size=len(predictor.x))
+        predictor.run()
+        ref = bundle.predict({name: x[None, :] for name, x in predictor.inputs.items()})
+        for name in predictor.ynames:
+            y = ref[name][0][predictor.yindex[name]]
+            err = max(err, np.abs(predictor.outputs[name] - y).max() / (np.abs(y).max() + 1e-12))
+    return err
+
+
+def benchmark(predictor, ncalls=1000000, seed=0):
+    # latency of ncalls calls, in microseconds
+    predictor.x[:] = np.random.default_rng(seed).normal(size=len(predictor.x))
+    for i in range(1000):
+        predictor.run()
+
+    t = np.zeros(ncalls, dtype=np.int64)
+    clock = time.perf_counter_ns
+    run = predictor.run
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(ncalls):
+            t0 = clock()
+            run()
+            t[i] = clock() - t0
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    t = t / 1000
+    return {'ncalls': ncalls, 'mean_us': t.mean(), 'p50_us': np.percentile(t, 50), 'p99_us': np.percentile(t, 99),
+            'p99.9_us': np.percentile(t, 99.9), 'max_us': t.max()}
+
+
+def selftest(bundle, tol=1e-4):
+    '''
+    Checks the predictor and the exported net against the bundle with no folding,
+    the input folded, each PCA compressed output folded (all and a subset of its
+    grid) and both folded. Raises an AssertionError if an error exceeds tol.
+    '''
+    folds = [dict(fold_input=False), dict(fold_input=True)]
+    for yname in bundle.ypca:
+        folds += [dict(fold_input=False, fold_output=yname),
+                  dict(fold_input=False, fold_output=yname, rows=[0, 10, 20], cols=[5, 6]),
+                  dict(fold_input=True, fold_output=yname)]
+    for fold in folds:
+        err = check(RealtimePredictor(bundle, **fold), bundle)
+        export_err = check_export(export_net(bundle, **fold), bundle, **fold)
+        print('%s: predictor error %.1e, exported net error %.1e' % (fold, err, export_err))
+        if max(err, export_err) > tol:
+            raise AssertionError('folded predictions differ from the bundle predictions')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the realtime predictor of a model bundle.')
+    parser.add_argument('bundle_fn', nargs='?', default=None, help='model bundle (default a random-weight test bundle)')
+    parser.add_argument('--ncalls', type=int, default=1000000)
+    parser.add_argument('--fold_input', action='store_true', help='fold the input preprocessing into the first layer')
+    parser.add_argument('--fold_output', default=None, help='output to fold the postprocessing of into the last layer')
+    parser.add_argument('--rows', type=int, nargs='*', default=None, help='grid rows of the folded output (default all)')
+    parser.add_argument('--cols', type=int, nargs='*', default=None, help='grid columns of the folded output (default all)')
+    parser.add_argument('--export', default=None, help='save the state dict of the folded torch MLP to this file')
+    parser.add_argument('--tol', type=float, default=1e-4, help='max relative error vs the bundle')
+    args = parser.parse_args()
+
+    if args.bundle_fn is None:
+        print('No bundle given, testing on random-weight bundles')
+        for layout, multihead in [('pertnet', False), ('pertnet', True), ('eqnet', False)]:
+            print('%s bundle%s:' % (layout, ', multihead' if multihead else ''))
+            bundle = random_bundle(layout, multihead=multihead)
+            selftest(bundle, args.tol)
+    else:
+        bundle = load_bundle(args.bundle_fn)
+    fold = dict(fold_output=args.fold_output, rows=args.rows, cols=args.cols)
+
+    if args.export is not None:
+        net = export_net(bundle, **fold)
+        dims = [m.out_features for m in net.net if isinstance(m, nn.Linear)]
+        err = check_export(net, bundle, **fold)
+        print('Folded net: MLP(%d, %d, %s, nonlinearity=%s), max relative error vs bundle: %.1e' %
+              (net.net[1].in_features, dims[-1], dims[:-1], bundle.meta['nonlinearity'], err))
+        if err > args.tol:
+            raise AssertionError('exported net differs from the bundle predictions, not saved')
+        torch.save(net.state_dict(), args.export)
+
+    predictor = RealtimePredictor(bundle, fold_input=args.fold_input, **fold)
+    print('Inputs: %d raw, %d net, outputs: %d raw, layers: %s' % (len(predictor.x), len(predictor.z), len(predictor.out),
+          ' '.join('%dx%d' % W.shape for W, b in predictor.layers)))
+    err = check(predictor, bundle)
+    print('Max relative error vs bundle: %.1e' % err)
+    if err > args.tol:
+        raise AssertionError('predictor differs from the bundle predictions')
+
+    stats = benchmark(predictor, args.ncalls)
+    print('%d calls: mean %.1f us, p50 %.1f us, p99 %.1f us, p99.9 %.1f us, max %.1f us' %
+          (stats['ncalls'], stats['mean_us'], stats['p50_us'], stats['p99_us'], stats['p99.9_us'], stats['max_us']))
@@ -0,0 +1,77 @@
+'''
+Runs the jobs of a job_topdir made by submit_jobs.py on the local node instead
+of through sbatch, nprocs at a time. The dataset is published once in shared
+memory (see dataset_server.py) and every job attaches to it by name, so memory
+use stays flat as more jobs run concurrently. Jobs whose data settings differ
+from the first job, and fine-tuning or pretrained model jobs (which need their 
+own preprocessing), load their own data. Jobs that are complete or still queued
+or running from an earlier submission are skipped unless --force, as in
+submit_jobs.py.
+
+usage: python run_local.py <job_topdir> [--nprocs 4] [--nthreads 1] [--force]
+'''
+
+import os
+ROOT = os.environ['NN_ROOT']
+import sys
+sys.path.append(ROOT)
+from easydict import EasyDict
+import json
+import glob
+import argparse
+from eqnet.net.eqnet_utils import dataset_settings
+from eqnet.net.dataset_server import serve
+from nntools.executors import LocalExecutor, job_active
+from nntools.jobs import job_complete
+
+
+parser = argparse.ArgumentParser(description='Run the jobs of a job_topdir locally on one shared dataset.')
+parser.add_argument('job_topdir')
+parser.add_argument('--nprocs', type=int, default=4, help='number of jobs run concurrently')
+parser.add_argument('--nthreads', type=int, default=1, help='BLAS/torch threads per job')
+parser.add_argument('--force', action='store_true', help='also rerun jobs still queued or running elsewhere')
+args = parser.parse_args()
+
+jobdirs = sorted(os.path.dirname(fn) for fn in glob.glob(os.path.join(args.job_topdir, '*', 'args.json')))
+if len(jobdirs) == 0:
+    sys.exit('No jobs found in ' + args.job_topdir)
+
+todo = []
+for jobdir in jobdirs:
+    if job_complete(jobdir):
+        print('Skipping complete job %s' % jobdir)
+    elif not args.force and job_active(jobdir):
+        print('Skipping active job %s' % jobdir)
+    else:
+        todo.append(jobdir)
+print('%d of %d jobs already completed or running' % (len(jobdirs) - len(todo), len(jobdirs)))
+jobdirs = todo
+if len(jobdirs) == 0:
+    sys.exit()
+
+def load_args(jobdir):
+    with open(jobdir + '/args.json') as infile:
+        return EasyDict(json.load(infile))
+
+hp = load_args(jobdirs[0])
+name = 'eqnet_data_%d' % os.getpid()
+shared = serve(name, hp)
+executor = LocalExecutor([sys.executable, '-u', 'eqnet_batch.py'], max_workers=args.nprocs, 
+                         threads_per_job=args.nthreads)
+
+try:
+    for jobdir in jobdirs:
+        env = {}
+        job_hp = load_args(jobdir)
+        own_preprocess = job_hp.get('finetune', False) or job_hp.get('use_pretrained_model', False)
+        if dataset_settings(job_hp) == dataset_settings(hp) and not own_preprocess:
+            env['NN_SHARED_DATASET'] = name
+        executor.submit(jobdir, env=env)
+
+    status = executor.wait(poll_interval=1)
+    for job, jobdir in executor.jobs.items():
+        print('%-60s %s' % (jobdir, status[job]))
+
+finally:
+    executor.shutdown()
+    shared.unlink()
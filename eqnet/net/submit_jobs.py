@@ -1,4 +1,5 @@
 import os
+import sys
 import shutil
 from easydict import EasyDict
 import json
@@ -10,6 +11,56 @@ ROOT = os.environ['NN_ROOT']
 sbatch_fn = ROOT + 'eqnet/net/job.slurm'
 job_fn = ROOT + 'eqnet/net/eqnet_batch.py'
 job_topdir = ROOT + 'eqnet/jobs/reconstruction/jobs019a/'
+sys.path.append(ROOT)
+from nntools.asha import run_asha
+from nntools.executors import make_executor
+from nntools.packing import submit_packed
+from nntools.jobs import prepare_jobdir, ensemble_unsupported, ENSEMBLE_MEMBER_KEYS
+from nntools.bayesopt import run_bayesopt
+
+# where to run the jobs: 'sbatch' submits job.slurm from each job directory, 'local' runs 
+# them on this machine, local_max_workers at a time (None for all cores / local_threads_per_job)
+executor_backend = 'sbatch'
+local_max_workers = None
+local_threads_per_job = 1
+
+# pack_size > 1 runs pack_size jobs per allocation instead of one sbatch per job: one array 
+# job of job_pack.slurm with a task per pack, each running its jobs in parallel within the 
+# cores of the allocation (see nntools/packing.py). Locally the packs run one at a time
+pack_size = 1
+pack_sbatch_fn = ROOT + 'eqnet/net/job_pack.slurm'
+
+# train grid points that only differ in learning rate and dropout together, as 
+# one vectorized ensemble job (eqnet_ensemble_batch.py) instead of one job each. Only jobs
+# training plain MLPs with Adam at a constant lr, without checkpoints or metrics logs, are
+# grouped (checkpoint_every = log_every = 0, see ENSEMBLE_DEFAULTS in nntools/jobs.py), 
+# the others run on their own
+ensemble = False
+ensemble_sbatch_fn = ROOT + 'eqnet/net/job_ensemble.slurm'
+ensemble_job_fn = ROOT + 'eqnet/net/eqnet_ensemble_batch.py'
+
+# asynchronous successive halving instead of training every grid point for num_epochs: 
+# every config first trains asha_min_epochs, the best 1/asha_eta of each rung are promoted 
+# to asha_eta times more epochs (resuming from their checkpoint), up to num_epochs. 
+# This script then keeps running until the search is done, see nntools/asha.py
+asha = False
+asha_min_epochs = 10
+asha_eta = 3
+asha_max_concurrent = 20
+
+# model-based search instead of training every grid point: a Gaussian process of the 
+# val loss picks which grid points to train, bayesopt_num_jobs in total, with 
+# bayesopt_max_concurrent running at once (see nntools/bayesopt.py). The grid lists 
+# below are the candidates, so they can be much larger than for a full grid
+bayesopt = False
+bayesopt_num_jobs = 50
+bayesopt_num_init = 10
+bayesopt_max_concurrent = 10
+
+# initialize new jobs from the net.pth of the nearest completed job with the same layer 
+# shapes in warm_start_dirs (e.g. this job_topdir when refining a grid), see nntools/jobs.py
+warm_start = False
+warm_start_dirs = [job_topdir]
 
 
 # hyperparameter grid
@@ -54,6 +105,9 @@ settings.savemovie = False
 settings.plotmovie = False
 settings.savemodel = True
 settings.use_pretrained_model = False
+settings.checkpoint_every = 10
+settings.log_every = 100
+settings.benchmark_latency = True
 settings.root = ROOT
 settings.dataset_dir = 'eqnet/data/datasets/'
 settings.data_pca_fn = 'data_pca_019.dat'
@@ -76,16 +130,43 @@ settings.shape_control_mode = False  # predict flux (not shape parameters)
 #settings.ynames += ['psizr_pla']
 # settings.shape_control_mode = True # direct prediction of shape parameters
 
-if os.path.isdir(job_topdir):
-    shutil.rmtree(job_topdir)
-os.mkdir(job_topdir)
+# joint flux + shape prediction, one shared trunk with a flux head and a shape head
+# settings.ynames = ['psizr_pla_iv2'] + ['shape_' + x for x in ['rx_lo', 'zx_lo', 'rx_up', 'zx_up', 'rcur', 'zcur', 'gap1', 'gap2', 'a', 'b', 'kappa', 'delta', 'R0', 'rmax', 'rx_lo_filtered', 'zx_lo_filtered', 'rx_up_filtered', 'zx_up_filtered', 'islimited']]
+# settings.shape_control_mode = False
+# settings.multitask = True
+# settings.head_names = ['flux', 'shape']
+# settings.head_loss_weights = [1.0, 1.0]
+
+# jobs live in job_<hash of args>/ so a rerun keeps finished work: completed jobs 
+# (valid loss.txt and net.pth) are skipped, missing or failed ones are (re)launched.
+# Jobs still queued or running from an earlier submission are skipped unless force_resubmit
+force_resubmit = False
+os.makedirs(job_topdir, exist_ok=True)
 
 
 grid_fn = job_topdir + 'hpgrid.txt'
 with open(grid_fn, 'w') as outfile:
     json.dump(hyperparams, outfile, indent=4)
 
+def job_args(hp):
+    # combine input args
+    hp = EasyDict(hp)
+    hp.hidden_dims = [hp.h_dim for i in range(hp.num_h)]
+    return {**hp, **settings}
+
 # Launch jobs
+ensemble_groups = {}
+asha_jobdirs = []
+executor = make_executor(executor_backend, sbatch_fn, job_fn, local_max_workers, local_threads_per_job)
+pack_jobdirs = []
+nskipped = 0
+
+if bayesopt:
+    run_bayesopt(hpgrid, job_args, job_topdir, job_fn, executor, bayesopt_num_jobs, num_init=bayesopt_num_init,
+                 max_concurrent=bayesopt_max_concurrent, report_fn=job_topdir + 'bayesopt.txt',
+                 warm_start_dirs=warm_start_dirs if warm_start else None)
+    sys.exit()
+
 for ijob, hp in enumerate(hpgrid):
 
 
@@ -98,47 +179,72 @@ for ijob, hp in enumerate(hpgrid):
     with open(grid_fn, 'a') as outfile:
         json.dump(hp, outfile, indent=4)
     
-    # create job directory
-    jobdir = job_topdir + 'job' + str(ijob) + '/'
-    
-    if os.path.isdir(jobdir):
-        shutil.rmtree(jobdir)
-    os.makedirs(jobdir)
-                    
-    # combine input args
-    settings.savedir = jobdir
-    hp.hidden_dims = [hp.h_dim for i in range(hp.num_h)]
-    args = {**hp, **settings}
+    args = job_args(hp)
+
+    # create job directory, copy files and write the settings for the individual job
+    jobdir, args, skip = prepare_jobdir(job_topdir, args, job_fn, warm_start_dirs if warm_start else None,
+                                        force=force_resubmit)
+
+    with open(grid_fn, 'a') as writer:
+        writer.write('\n' + jobdir + '\n')
+
+    if skip:
+        print('Skipping %s job %s' % (skip, jobdir))
+        nskipped += 1
+        continue
+
+    if asha:
+        asha_jobdirs.append(jobdir)
+        continue
 
-    # copy files
-    args_fn = jobdir + 'args.json'
-    shutil.copy(job_fn, jobdir)
+    unsupported = ensemble_unsupported(args) if ensemble else []
+    if unsupported:
+        print('Running %s on its own, the ensemble does not support %s' % (jobdir, ', '.join(unsupported)))
 
-    # settings for the individual job
-    with open(args_fn, 'w') as outfile:
-        json.dump(args, outfile, indent=4)
+    if ensemble and not unsupported:
+        # group with the other jobs that share everything but the member keys
+        key = json.dumps({k: v for k, v in args.items() if k not in ENSEMBLE_MEMBER_KEYS}, sort_keys=True)
+        ensemble_groups.setdefault(key, []).append(jobdir)
+        continue
 
     # launch job
-    os.chdir(jobdir)
-    os.system('sbatch ' + sbatch_fn)
+    if pack_size > 1:
+        pack_jobdirs.append(jobdir)
+    else:
+        executor.submit(jobdir)
 
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
+print('%d of %d jobs already completed or running' % (nskipped, len(hpgrid)))
+
+# Launch packed jobs
+if pack_jobdirs:
+    pack_executor, _ = submit_packed(pack_jobdirs, job_fn, job_topdir + 'packs/', pack_size, executor_backend,
+                                     pack_sbatch_fn, threads_per_job=local_threads_per_job)
+
+
+# Launch ensemble jobs
+ensemble_executor = make_executor(executor_backend, ensemble_sbatch_fn, ensemble_job_fn, 
+                                  local_max_workers, local_threads_per_job)
+for iens, jobdirs in enumerate(ensemble_groups.values()):
+
+    ensdir = job_topdir + 'ensemble' + str(iens) + '/'
+    os.makedirs(ensdir, exist_ok=True)
+    shutil.copy(ensemble_job_fn, ensdir)
+
+    with open(ensdir + 'ensemble.json', 'w') as outfile:
+        json.dump({'jobdirs': jobdirs}, outfile, indent=4)
+
+    job = ensemble_executor.submit(ensdir)
+    ensemble_executor.mark_submitted(jobdirs, job)
+
+
+# Run the successive halving search, each rung of a job is one executor job
+if asha:
+    run_asha(asha_jobdirs, executor, asha_min_epochs, max(hyperparams.num_epochs),
+             eta=asha_eta, max_concurrent=asha_max_concurrent, report_fn=job_topdir + 'asha.txt')
+
+# local jobs run as child processes of this script
+if executor_backend == 'local':
+    executor.wait()
+    ensemble_executor.wait()
+    if pack_jobdirs:
+        pack_executor.wait()
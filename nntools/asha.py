@@ -0,0 +1,149 @@
+'''
+Asynchronous successive halving (ASHA) over a set of job directories in the
+args.json layout made by submit_jobs.py.
+
+Every config first trains for min_epochs. Whenever a worker slot is free, the
+best 1/eta of the configs that finished a rung (and were not promoted yet) is
+promoted to the next rung, which has eta times the epoch budget, up to
+max_epochs. If there is nothing to promote, a new config is started on the
+lowest rung. Promoted jobs resume from their checkpoint.pth with a larger
+num_epochs in args.json, so the epochs of lower rungs are not repeated, and
+configs that are not promoted are never trained further. Learning rate schedules
+span max_epochs from the first rung on (schedule_epochs in args.json), so a
+resumed job continues the same schedule.
+
+Jobs are run with an executor from nntools.executors, on SLURM or locally.
+'''
+
+import json
+import time
+import numpy as np
+from nntools.executors import COMPLETED, FAILED
+
+
+def rung_budgets(min_epochs, max_epochs, eta):
+    budgets = [min_epochs]
+    while budgets[-1] * eta < max_epochs:
+        budgets.append(budgets[-1] * eta)
+    if budgets[-1] < max_epochs:
+        budgets.append(max_epochs)
+    return budgets
+
+
+def last_val_loss(jobdir):
+    # same ranking as list_grid_results.py, last validation loss in loss.txt
+    try:
+        return float(np.loadtxt(jobdir + '/loss.txt')[1, -1])
+    except Exception:
+        return np.inf
+
+
+class ASHA():
+    '''
+    Bookkeeping of the asynchronous successive halving promotions. next_job()
+    returns the (config, rung) to run next or None if nothing can run until
+    more results are reported with report().
+    '''
+
+    def __init__(self, nconfigs, min_epochs, max_epochs, eta=3):
+        self.nconfigs = nconfigs
+        self.eta = eta
+        self.budgets = rung_budgets(min_epochs, max_epochs, eta)
+        self.results = [{} for k in self.budgets]      # per rung: config -> loss
+        self.promoted = [set() for k in self.budgets]  # per rung: configs promoted from it
+        self.next_config = 0
+
+    def next_job(self):
+
+        # promote from the highest rung possible
+        for k in reversed(range(len(self.budgets) - 1)):
+            ranked = sorted(self.results[k], key=lambda c: self.results[k][c])
+            top = ranked[:len(ranked) // self.eta]
+            for config in top:
+                if config not in self.promoted[k] and np.isfinite(self.results[k][config]):
+                    self.promoted[k].add(config)
+                    return config, k + 1
+
+        # otherwise start a new config
+        if self.next_config < self.nconfigs:
+            self.next_config += 1
+            return self.next_config - 1, 0
+
+        return None
+
+    def report(self, config, rung, loss):
+        self.results[rung][config] = loss
+
+    def rung_reached(self, config):
+        rungs = [k for k in range(len(self.budgets)) if config in self.results[k]]
+        return max(rungs) if rungs else None
+
+
+def set_num_epochs(jobdir, num_epochs, schedule_epochs=None):
+    fn = jobdir + '/args.json'
+    with open(fn) as infile:
+        args = json.load(infile)
+    args['num_epochs'] = num_epochs
+    args['schedule_epochs'] = schedule_epochs
+    args['checkpoint_every'] = max(args.get('checkpoint_every', 0), 1)
+    with open(fn, 'w') as outfile:
+        json.dump(args, outfile, indent=4)
+
+
+def run_asha(jobdirs, executor, min_epochs, max_epochs, eta=3, max_concurrent=10, poll_interval=10,
+             report_fn=None):
+    '''
+    Runs ASHA over jobdirs with executor, with at most max_concurrent jobs at 
+    once. Returns the ASHA object with all results and writes a summary table 
+    to report_fn.
+    '''
+    asha = ASHA(len(jobdirs), min_epochs, max_epochs, eta)
+    running = {}
+    print('ASHA rungs (epochs): %s' % asha.budgets)
+
+    while True:
+
+        # fill the free slots
+        while len(running) < max_concurrent:
+            job = asha.next_job()
+            if job is None:
+                break
+            config, rung = job
+            jobdir = jobdirs[config]
+            set_num_epochs(jobdir, asha.budgets[rung], max_epochs)
+            running[config] = (executor.submit(jobdir), rung)
+            print('Started %s on rung %d (%d epochs)' % (jobdir, rung, asha.budgets[rung]))
+
+        if len(running) == 0:
+            break
+
+        time.sleep(poll_interval)
+
+        # collect finished jobs
+        for config, (job, rung) in list(running.items()):
+            status = executor.status(job)
+            if status not in [COMPLETED, FAILED]:
+                continue
+            del running[config]
+            loss = last_val_loss(jobdirs[config]) if status == COMPLETED else np.inf
+            asha.report(config, rung, loss)
+            print('Finished %s on rung %d, val loss %.4e' % (jobdirs[config], rung, loss))
+
+    # summary
+    epochs = [asha.budgets[asha.rung_reached(c)] for c in range(len(jobdirs))]
+    lines = ['%-60s %6s %8s %14s' % ('job', 'rung', 'epochs', 'val loss')]
+    order = sorted(range(len(jobdirs)), key=lambda c: (-asha.rung_reached(c),
+                   asha.results[asha.rung_reached(c)][c]))
+    for c in order:
+        k = asha.rung_reached(c)
+        lines.append('%-60s %6d %8d %14.4e' % (jobdirs[c], k, asha.budgets[k], asha.results[k][c]))
+    lines.append('')
+    lines.append('Total epochs trained: %d (exhaustive grid: %d)' % (sum(epochs), max_epochs * len(jobdirs)))
+    report = '\n'.join(lines)
+    print('\n' + report)
+
+    if report_fn is not None:
+        with open(report_fn, 'w') as outfile:
+            outfile.write(report + '\n')
+
+    return asha
@@ -0,0 +1,198 @@
+'''
+Sequential model-based (Bayesian) hyperparameter search over the points of a
+grid, e.g. the ParameterGrid of submit_jobs.py, in the job directory layout of
+nntools.jobs.
+
+A Gaussian process (sklearn) is fit to the log validation loss of the configs
+trained so far, and the next config is the untried grid point with the largest
+expected improvement. The first num_init configs are drawn at random. To keep
+max_concurrent jobs running, configs are proposed while others are still
+training: the pending ones count as observed at the GP mean (kriging believer),
+so a batch of proposals spreads out instead of piling up on one point.
+
+Jobs are written with prepare_jobdir as they are proposed and run with an
+executor from nntools.executors, on SLURM or locally. Completed jobs already in
+job_topdir (e.g. from an earlier grid or search) are read back as results
+without training them again.
+'''
+
+import json
+import time
+import warnings
+import numpy as np
+from scipy.stats import norm
+from sklearn.gaussian_process import GaussianProcessRegressor
+from sklearn.gaussian_process.kernels import ConstantKernel, Matern, WhiteKernel
+from nntools.executors import COMPLETED, FAILED, RUNNING, job_active
+from nntools.jobs import prepare_jobdir, job_complete
+from nntools.asha import last_val_loss
+
+
+def encode_grid(hpgrid):
+    '''
+    Features in [0, 1] for the grid points: the keys that vary over the grid,
+    numbers on a log scale if they span more than a decade, other values one-hot.
+    An (n, 0) array if no key varies (e.g. a one-point grid).
+    '''
+    keys = [k for k in sorted(hpgrid[0]) if len(set(json.dumps(hp[k]) for hp in hpgrid)) > 1]
+    columns = []
+    for k in keys:
+        vals = [hp[k] for hp in hpgrid]
+        if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in vals):
+            v = np.asarray(vals, dtype=float)
+            if v.min() > 0 and v.max() / v.min() > 10:
+                v = np.log10(v)
+            columns.append(((v - v.min()) / (v.max() - v.min()))[:, None])
+        else:
+            vals = [json.dumps(v, sort_keys=True) for v in vals]
+            uniq = sorted(set(vals))
+            columns.append(np.asarray([[v == u for u in uniq] for v in vals], dtype=float))
+    if len(columns) == 0:
+        return np.zeros((len(hpgrid), 0)), keys
+    return np.hstack(columns), keys
+
+
+class BayesOpt():
+    '''
+    Bookkeeping of the search over the rows of the feature matrix X. ask()
+    returns the index of the next config to run, report() records its loss (inf
+    for a failed job).
+    '''
+
+    def __init__(self, X, num_init=10, xi=0.01, seed=0):
+        self.X = X
+        self.num_init = num_init
+        self.xi = xi
+        self.rng = np.random.default_rng(seed)
+        self.results = {}     # config -> loss
+        self.pending = set()
+
+    def untried(self):
+        return [i for i in range(len(self.X)) if i not in self.results and i not in self.pending]
+
+    def fit(self, idx, y, kernel=None):
+        if kernel is None:
+            kernel = ConstantKernel() * Matern(length_scale=np.ones(self.X.shape[1]), length_scale_bounds=(1e-2, 1e2),
+                                               nu=2.5) + WhiteKernel(1e-2, (1e-6, 1))
+            gp = GaussianProcessRegressor(kernel, normalize_y=True, n_restarts_optimizer=2,
+                                          random_state=int(self.rng.integers(2**31)))
+        else:
+            gp = GaussianProcessRegressor(kernel, normalize_y=True, optimizer=None)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            gp.fit(self.X[idx], y)
+        return gp
+
+    def ask(self):
+        candidates = self.untried()
+        if len(candidates) == 0:
+            return None
+
+        # random until there is something to model, or nothing varies to model
+        done = [i for i in self.results if np.isfinite(self.results[i])]
+        if len(done) < max(self.num_init, 2) or self.X.shape[1] == 0:
+            config = int(self.rng.choice(candidates))
+            self.pending.add(config)
+            return config
+
+        # model of the log loss, pending configs at the mean of the model
+        y = np.log([self.results[i] for i in done])
+        gp = self.fit(done, y)
+        pending = sorted(self.pending)
+        if pending:
+            y_pending = gp.predict(self.X[pending])
+            gp = self.fit(done + pending, np.concatenate([y, y_pending]), gp.kernel_)
+
+        # expected improvement over the best loss so far
+        mu, sigma = gp.predict(self.X[candidates], return_std=True)
+        sigma = np.maximum(sigma, 1e-9)
+        improvement = y.min() - mu - self.xi
+        z = improvement / sigma
+        ei = improvement * norm.cdf(z) + sigma * norm.pdf(z)
+
+        config = candidates[int(np.argmax(ei))]
+        self.pending.add(config)
+        return config
+
+    def report(self, config, loss):
+        self.pending.discard(config)
+        self.results[config] = loss
+
+    def best(self):
+        return min(self.results, key=lambda i: self.results[i])
+
+
+def run_bayesopt(hpgrid, make_args, job_topdir, job_fn, executor, num_jobs, num_init=10, max_concurrent=10,
+                 poll_interval=10, report_fn=None, seed=0, warm_start_dirs=None):
+    '''
+    Searches hpgrid with at most num_jobs trainings, max_concurrent at a time.
+    make_args(hp) gives the job args of a grid point (hyperparameters merged
+    with the settings). New jobs are warm-started from the nearest completed job
+    in warm_start_dirs, see nntools.jobs. Returns the BayesOpt object and the job directory per
+    config, and writes a summary table to report_fn.
+    '''
+    X, keys = encode_grid(hpgrid)
+    opt = BayesOpt(X, num_init, seed=seed)
+    jobdirs = {}
+    running = {}
+    history = []     # best loss after each training
+    ntrained = 0
+    print('Bayesian search over %d grid points (%s), %d trainings' % (len(hpgrid), ', '.join(keys), num_jobs))
+
+    while True:
+
+        # fill the free slots
+        while len(running) < max_concurrent and ntrained + len(running) < num_jobs:
+            config = opt.ask()
+            if config is None:
+                break
+            jobdir, args, skip = prepare_jobdir(job_topdir, make_args(hpgrid[config]), job_fn, warm_start_dirs)
+            jobdirs[config] = jobdir
+            if skip == 'active':
+                # submitted by an earlier run and still queued or running, followed through its files
+                running[config] = None
+                print('Waiting for %s, submitted earlier' % jobdir)
+                continue
+            if skip:
+                opt.report(config, last_val_loss(jobdir))
+                print('Found completed %s, val loss %.4e' % (jobdir, opt.results[config]))
+                continue
+            running[config] = executor.submit(jobdir)
+            print('Started %s' % jobdir)
+
+        if len(running) == 0:
+            break
+
+        time.sleep(poll_interval)
+
+        # collect finished jobs
+        for config, job in list(running.items()):
+            if job is None:
+                status = COMPLETED if job_complete(jobdirs[config]) else RUNNING if job_active(jobdirs[config]) else FAILED
+            else:
+                status = executor.status(job)
+            if status not in [COMPLETED, FAILED]:
+                continue
+            del running[config]
+            loss = last_val_loss(jobdirs[config]) if status == COMPLETED else np.inf
+            opt.report(config, loss)
+            ntrained += 1
+            history.append(opt.results[opt.best()])
+            print('Finished %s, val loss %.4e (best %.4e after %d trainings)' % (jobdirs[config], loss,
+                  history[-1], ntrained))
+
+    # summary
+    lines = ['%-60s %14s  %s' % ('job', 'val loss', ', '.join(keys))]
+    for c in sorted(opt.results, key=lambda c: opt.results[c]):
+        lines.append('%-60s %14.4e  %s' % (jobdirs[c], opt.results[c], ', '.join(str(hpgrid[c][k]) for k in keys)))
+    lines.append('')
+    lines.append('Best val loss after each training: ' + ' '.join('%.4e' % l for l in history))
+    lines.append('Trainings: %d (exhaustive grid: %d)' % (ntrained, len(hpgrid)))
+    report = '\n'.join(lines)
+    print('\n' + report)
+
+    if report_fn is not None:
+        with open(report_fn, 'w') as outfile:
+            outfile.write(report + '\n')
+
+    return opt, jobdirs
@@ -0,0 +1,216 @@
+'''
+Model bundles: a trained eqnet or pertnet net with its fitted preprocessing in
+one .npz file, for inference without the training code or the dataset (see
+eqnet/net/realtime_predictor.py and eqnet/net/prediction_server.py).
+'''
+
+import json
+import tempfile
+import numpy as np
+import torch
+from sklearn.preprocessing import StandardScaler
+from sklearn.decomposition import PCA
+from easydict import EasyDict
+from nntools.models import MLP, MultiHeadMLP
+from nntools.training import predict
+from nntools.preprocess import DataPreProcess
+
+
+# ============
+# MODEL BUNDLE
+# ============
+def pca_basis(var):
+    # (mean, components) of a PCA-compressed variable of a data dict, None for raw variables
+    if not hasattr(var, 'components_'):
+        return None
+    if getattr(var, 'whiten', False):
+        raise ValueError('Whitened PCA is not supported in model bundles')
+    return np.asarray(var.mean_, dtype=np.float64), np.asarray(var.components_, dtype=np.float64)
+
+
+def save_bundle(fn, net, preprocess, datadict, hp):
+    '''
+    Writes everything needed for inference to one .npz file: the net weights and
+    architecture, the X/Y scaler statistics, the input PCA projection and output
+    PCA basis of each variable (taken from datadict, any split of the dataset)
+    and the xnames/ynames layout. Load with load_bundle.
+    '''
+    arrays = {}
+    xdims = [preprocess.makeX(datadict, [xname]).shape[1] for xname in preprocess.xnames]
+    meta = {'version': 1, 'xnames': list(preprocess.xnames), 'ynames': list(preprocess.ynames),
+            'xdims': xdims, 'ydims': list(preprocess.ydims), 'hidden_dims': list(hp.hidden_dims),
+            'nonlinearity': hp.nonlinearity}
+
+    if isinstance(net, MultiHeadMLP):
+        meta['net'] = 'MultiHeadMLP'
+        meta['head_dims'] = list(net.head_dims)
+        meta['head_hidden_dims'] = list(hp.get('head_hidden_dims') or [])
+    else:
+        meta['net'] = 'MLP'
+
+    arrays['X_mean'] = preprocess.X_scaler.mean_
+    arrays['X_scale'] = preprocess.X_scaler.scale_
+    arrays['Y_mean'] = preprocess.Y_scaler.mean_
+    arrays['Y_scale'] = preprocess.Y_scaler.scale_
+
+    for prefix, names in [('xpca', preprocess.xnames), ('ypca', preprocess.ynames)]:
+        for name in names:
+            basis = pca_basis(datadict[name])
+            if basis is not None:
+                arrays[prefix + '_mean.' + name], arrays[prefix + '_components.' + name] = basis
+
+    for key, value in net.state_dict().items():
+        arrays['net.' + key] = value.detach().cpu().numpy()
+
+    arrays['meta'] = np.array(json.dumps(meta))
+    with open(fn, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+class ModelBundle():
+    '''
+    A trained net with its fitted preprocessing, as saved by save_bundle. 
+    predict() maps the raw input variables to the raw outputs (e.g. the 
+    flattened flux on the grid), preprocess() gives a DataPreProcess for the 
+    training and plotting utilities. xdims/ydims are the net input/output dims
+    of each variable, xraw_dims/yraw_dims their raw dims (before PCA).
+    '''
+
+    def __init__(self, arrays):
+        meta = json.loads(str(arrays['meta']))
+        self.meta = meta
+        self.xnames = meta['xnames']
+        self.ynames = meta['ynames']
+        self.xdims = meta['xdims']
+        self.ydims = meta['ydims']
+        self.X_mean, self.X_scale = arrays['X_mean'], arrays['X_scale']
+        self.Y_mean, self.Y_scale = arrays['Y_mean'], arrays['Y_scale']
+        self.xpca = {name: (arrays['xpca_mean.' + name], arrays['xpca_components.' + name]) 
+                     for name in self.xnames if 'xpca_mean.' + name in arrays}
+        self.ypca = {name: (arrays['ypca_mean.' + name], arrays['ypca_components.' + name]) 
+                     for name in self.ynames if 'ypca_mean.' + name in arrays}
+        self.xraw_dims = [len(self.xpca[name][0]) if name in self.xpca else dim 
+                          for name, dim in zip(self.xnames, self.xdims)]
+        self.yraw_dims = [len(self.ypca[name][0]) if name in self.ypca else dim 
+                          for name, dim in zip(self.ynames, self.ydims)]
+
+        in_dim = sum(self.xdims)
+        if meta['net'] == 'MultiHeadMLP':
+            self.net = MultiHeadMLP(in_dim, meta['head_dims'], meta['hidden_dims'], 
+                                    head_hidden_dims=meta['head_hidden_dims'], nonlinearity=meta['nonlinearity'])
+        else:
+            self.net = MLP(in_dim, sum(self.ydims), meta['hidden_dims'], nonlinearity=meta['nonlinearity'])
+        state = {key[4:]: torch.from_numpy(arrays[key]) for key in arrays if key.startswith('net.')}
+        self.net.load_state_dict(state)
+        self.net.eval()
+
+    def encode(self, inputs):
+        # scaled net input from a dict of raw input variables (n x raw dim each)
+        X = []
+        for name, dim in zip(self.xnames, self.xdims):
+            if name in self.xpca:
+                mean, components = self.xpca[name]
+                x = np.asarray(inputs[name], dtype=np.float64).reshape(-1, len(mean))
+                x = (x - mean) @ components.T
+            else:
+                x = np.asarray(inputs[name], dtype=np.float64).reshape(-1, dim)
+            X.append(x)
+        X = np.hstack(X)
+        return (X - self.X_mean) / self.X_scale
+
+    def decode(self, Y):
+        # dict of raw output variables from the scaled net output
+        Y = Y * self.Y_scale + self.Y_mean
+        out = {}
+        for name, y in zip(self.ynames, np.split(Y, np.cumsum(self.ydims)[:-1], axis=1)):
+            if name in self.ypca:
+                mean, components = self.ypca[name]
+                y = y @ components + mean
+            out[name] = y
+        return out
+
+    def predict(self, inputs):
+        X = torch.Tensor(self.encode(inputs))
+        Y = predict(self.net, X).numpy().astype(np.float64)
+        return self.decode(Y)
+
+    def preprocess(self):
+        preprocess = DataPreProcess.__new__(DataPreProcess)
+        preprocess.X_scaler = StandardScaler()
+        preprocess.Y_scaler = StandardScaler()
+        for scaler, mean, scale in [(preprocess.X_scaler, self.X_mean, self.X_scale), 
+                                    (preprocess.Y_scaler, self.Y_mean, self.Y_scale)]:
+            scaler.mean_ = mean
+            scaler.scale_ = scale
+            scaler.var_ = scale**2
+            scaler.n_features_in_ = len(mean)
+        
+        if self.ynames[0] in self.ypca:
+            mean, components = self.ypca[self.ynames[0]]
+            preprocess.Y_pca = PCA(n_components=components.shape[0])
+            preprocess.Y_pca.mean_ = mean
+            preprocess.Y_pca.components_ = components
+            preprocess.Y_pca.n_components_ = components.shape[0]
+            preprocess.Y_pca.n_features_in_ = components.shape[1]
+        else:
+            preprocess.Y_pca = EasyDict()
+        preprocess.Y_pca.coeff_ = None
+        preprocess.t_thresh = None
+        preprocess.xnames = self.xnames
+        preprocess.ynames = self.ynames
+        preprocess.ydims = self.ydims
+        return preprocess
+
+
+def load_bundle(fn):
+    with np.load(fn) as f:
+        return ModelBundle({key: f[key] for key in f.files})
+
+
+def random_bundle(layout='eqnet', hidden_dims=None, nonlinearity='elu', multihead=False, nsamples=200, seed=0):
+    '''
+    Bundle of a random-weight net on synthetic data, for testing inference code
+    without a trained model. The 'eqnet' layout has PCA compressed and raw 
+    inputs, a PCA compressed 65x65 flux and a raw output, the 'pertnet' layout
+    the profile and current inputs and the PCA compressed 65x65 dpsidix 
+    responses of two coils. multihead gives a MultiHeadMLP with one head per 
+    output. Goes through save_bundle and load_bundle.
+    '''
+    if hidden_dims is None:
+        hidden_dims = [64, 64]
+    rng = np.random.default_rng(seed)
+    torch.manual_seed(seed)
+
+    def pca_var(raw_dim, ncomp):
+        # PCA fit on low-rank random data, with coeff_ as in the data dicts
+        X = rng.normal(size=(nsamples, 2 * ncomp)) @ rng.normal(size=(2 * ncomp, raw_dim)) + rng.normal(size=raw_dim)
+        pca = PCA(n_components=ncomp)
+        pca.coeff_ = pca.fit_transform(X)
+        return pca
+
+    datadict = {'shot': np.zeros((nsamples, 1)), 'time': np.arange(nsamples).reshape(-1, 1) / nsamples}
+    if layout == 'eqnet':
+        datadict.update({'coil_currents': pca_var(40, 10), 'ip': rng.normal(size=(nsamples, 1)), 
+                         'bpsignals': pca_var(80, 20), 'psizr': pca_var(65 * 65, 16), 
+                         'shape': rng.normal(size=(nsamples, 3))})
+        xnames, ynames = ['coil_currents', 'ip', 'bpsignals'], ['psizr', 'shape']
+    elif layout == 'pertnet':
+        datadict.update({'coil_currents': pca_var(8, 5), 'vessel_currents': pca_var(40, 5), 
+                         'ip': rng.normal(size=(nsamples, 1)), 'pprime': pca_var(30, 5), 'ffprim': pca_var(30, 5),
+                         'dpsidix_smooth_coil1': pca_var(65 * 65, 8), 'dpsidix_smooth_coil2': pca_var(65 * 65, 8)})
+        xnames = ['coil_currents', 'vessel_currents', 'ip', 'pprime', 'ffprim']
+        ynames = ['dpsidix_smooth_coil1', 'dpsidix_smooth_coil2']
+    else:
+        raise ValueError('Unknown bundle layout %s' % layout)
+
+    hp = EasyDict(hidden_dims=hidden_dims, nonlinearity=nonlinearity)
+    preprocess = DataPreProcess(datadict, xnames, ynames)
+    in_dim = sum(preprocess.makeX(datadict, [name]).shape[1] for name in preprocess.xnames)
+    if multihead:
+        net = MultiHeadMLP(in_dim, preprocess.ydims, hidden_dims, nonlinearity=nonlinearity, p_dropout_hidden=0)
+    else:
+        net = MLP(in_dim, sum(preprocess.ydims), hidden_dims, nonlinearity=nonlinearity, p_dropout_hidden=0)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        save_bundle(tmpdir + '/model_bundle.npz', net, preprocess, datadict, hp)
+        return load_bundle(tmpdir + '/model_bundle.npz')
@@ -0,0 +1,316 @@
+'''
+Executors that run job directories made by the submit scripts, either through
+SLURM (SbatchExecutor) or as a pool of local processes (LocalExecutor), so the
+same grid runs on the cluster or on a workstation.
+
+Both have the same interface:
+    job = executor.submit(jobdir)     # returns a job id, never blocks
+    executor.status(job)              # 'PENDING', 'RUNNING', 'COMPLETED' or 'FAILED'
+    executor.wait()                   # block until all submitted jobs are done
+    executor.summary()                # number of jobs per status
+
+make_executor(backend, sbatch_fn, job_fn) gives the executor for the sbatch
+script sbatch_fn or, locally, for running job_fn (which the submit scripts copy
+into every job directory) with the python interpreter of the caller.
+
+Every submitted directory gets a submitted.json marker (executor, job id, host
+and pid of the submitting process), and job_active(jobdir) tells from it whether
+the job may still be queued or running, so that resubmitting a grid does not
+launch it twice (see prepare_jobdir in nntools/jobs.py). Jobs run inside a pack
+or an ensemble are marked with mark_submitted.
+
+Status of all jobs of a job_topdir (from the a.out/a.err and loss.txt files):
+    python -m nntools.executors <job_topdir>
+'''
+
+import os
+import sys
+import glob
+import json
+import time
+import socket
+import argparse
+import subprocess
+from abc import ABC, abstractmethod
+
+
+PENDING = 'PENDING'
+RUNNING = 'RUNNING'
+COMPLETED = 'COMPLETED'
+FAILED = 'FAILED'
+
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+SUBMITTED_FN = 'submitted.json'
+
+
+def write_submitted(jobdir, backend, job):
+    info = {'backend': backend, 'job': str(job), 'host': socket.gethostname(), 'pid': os.getpid(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    with open(os.path.join(jobdir, SUBMITTED_FN), 'w') as outfile:
+        json.dump(info, outfile, indent=4)
+
+
+def clear_submitted(jobdir):
+    # removes the marker of a local job of this process once it has finished
+    fn = os.path.join(jobdir, SUBMITTED_FN)
+    try:
+        with open(fn) as infile:
+            info = json.load(infile)
+        if info['backend'] == 'local' and info['pid'] == os.getpid() and info['host'] == socket.gethostname():
+            os.remove(fn)
+    except (OSError, ValueError, KeyError):
+        pass
+
+
+def job_active(jobdir):
+    '''
+    True if jobdir was submitted and its job may still be queued or running: the
+    SLURM job is still known to squeue, or the local process that submitted it
+    is still alive (local jobs run as its children).
+    '''
+    try:
+        with open(os.path.join(jobdir, SUBMITTED_FN)) as infile:
+            info = json.load(infile)
+    except (OSError, ValueError):
+        return False
+
+    if info.get('backend') == 'sbatch':
+        try:
+            out = subprocess.run(['squeue', '-h', '-j', info['job'], '-o', '%T'], capture_output=True, text=True)
+        except OSError:
+            return False
+        return out.returncode == 0 and out.stdout.strip() != ''
+
+    if info.get('host') != socket.gethostname():
+        return False
+    try:
+        os.kill(info['pid'], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Executor(ABC):
+
+    backend = None
+
+    def __init__(self):
+        self.jobs = {}
+
+    @abstractmethod
+    def submit(self, jobdir, env=None):
+        pass
+
+    @abstractmethod
+    def status(self, job):
+        pass
+
+    def done(self, job):
+        return self.status(job) in [COMPLETED, FAILED]
+
+    def mark_submitted(self, jobdirs, job):
+        # marks jobdirs run by job (e.g. the jobs of a pack or an ensemble) as submitted
+        for jobdir in jobdirs:
+            write_submitted(jobdir, self.backend, job)
+
+    def summary(self):
+        counts = {PENDING: 0, RUNNING: 0, COMPLETED: 0, FAILED: 0}
+        for job in self.jobs:
+            counts[self.status(job)] += 1
+        return counts
+
+    def wait(self, jobs=None, poll_interval=10, verbose=True):
+        '''
+        Blocks until the jobs (default all submitted jobs) are done, printing the
+        status counts whenever they change. Returns the final status per job.
+        '''
+        if jobs is None:
+            jobs = list(self.jobs)
+        last = None
+        while True:
+            status = {job: self.status(job) for job in jobs}
+            counts = {s: list(status.values()).count(s) for s in [PENDING, RUNNING, COMPLETED, FAILED]}
+            if verbose and counts != last:
+                print(', '.join('%s: %d' % (s, n) for s, n in counts.items()))
+                last = counts
+            if counts[PENDING] + counts[RUNNING] == 0:
+                return status
+            time.sleep(poll_interval)
+
+
+class LocalExecutor(Executor):
+    '''
+    Runs cmd in each job directory as a local process, at most max_workers at a
+    time, with the BLAS/OpenMP/torch thread pools of each job capped at
+    threads_per_job. By default max_workers fills all cores. Output goes to
+    a.out and a.err in the job directory, as with job.slurm.
+    '''
+    backend = 'local'
+
+    def __init__(self, cmd, max_workers=None, threads_per_job=1):
+        super().__init__()
+        self.cmd = cmd
+        self.threads_per_job = threads_per_job
+        if max_workers is None:
+            max_workers = max(os.cpu_count() // threads_per_job, 1)
+        self.max_workers = max_workers
+        self.queue = []
+        self.procs = {}
+        self.returncodes = {}
+
+    def submit(self, jobdir, env=None):
+        job = len(self.jobs)
+        self.jobs[job] = jobdir
+        self.queue.append((job, env))
+        write_submitted(jobdir, self.backend, job)
+        self._update()
+        return job
+
+    def _update(self):
+
+        # collect finished processes
+        for job, (proc, out, err) in list(self.procs.items()):
+            if proc.poll() is not None:
+                out.close()
+                err.close()
+                self.returncodes[job] = proc.returncode
+                del self.procs[job]
+                clear_submitted(self.jobs[job])
+
+        # start queued jobs in the free slots
+        while self.queue and len(self.procs) < self.max_workers:
+            job, extra_env = self.queue.pop(0)
+            jobdir = self.jobs[job]
+            env = dict(os.environ)
+            for key in THREAD_ENV_VARS:
+                env[key] = str(self.threads_per_job)
+            env.update(extra_env or {})
+            out = open(os.path.join(jobdir, 'a.out'), 'w')
+            err = open(os.path.join(jobdir, 'a.err'), 'w')
+            proc = subprocess.Popen(self.cmd, cwd=jobdir, env=env, stdout=out, stderr=err)
+            self.procs[job] = (proc, out, err)
+
+    def status(self, job):
+        self._update()
+        if job in self.returncodes:
+            return COMPLETED if self.returncodes[job] == 0 else FAILED
+        if job in self.procs:
+            return RUNNING
+        return PENDING
+
+    def cancel(self, job):
+        if any(j == job for j, env in self.queue):
+            clear_submitted(self.jobs[job])
+        self.queue = [(j, env) for j, env in self.queue if j != job]
+        if job in self.procs:
+            self.procs[job][0].terminate()
+
+    def shutdown(self):
+        for job, env in self.queue:
+            clear_submitted(self.jobs[job])
+        self.queue = []
+        for job in list(self.procs):
+            self.procs[job][0].terminate()
+        self._update()
+
+
+class SbatchExecutor(Executor):
+    '''
+    Submits sbatch_fn from each job directory (without changing the working
+    directory of the caller). Status is taken from squeue while the job is
+    queued or running and from sacct afterwards. If sacct has no record of a
+    job that left the queue (e.g. accounting is disabled) for max_empty_polls
+    polls, the status is taken from its job directory (see jobdir_status).
+    '''
+    backend = 'sbatch'
+
+    def __init__(self, sbatch_fn, sbatch_args=[], max_empty_polls=10):
+        super().__init__()
+        self.sbatch_fn = sbatch_fn
+        self.sbatch_args = list(sbatch_args)
+        self.max_empty_polls = max_empty_polls
+        self.final = {}
+        self.empty_polls = {}
+
+    def submit(self, jobdir, env=None):
+        run_env = dict(os.environ)
+        run_env.update(env or {})
+        out = subprocess.run(['sbatch', '--parsable'] + self.sbatch_args + [self.sbatch_fn], cwd=jobdir,
+                             env=run_env, capture_output=True, text=True, check=True)
+        job = out.stdout.strip().split(';')[0]
+        self.jobs[job] = jobdir
+        write_submitted(jobdir, self.backend, job)
+        print('Submitted batch job %s in %s' % (job, jobdir))
+        return job
+
+    def status(self, job):
+        if job in self.final:
+            return self.final[job]
+
+        # one line per task for array jobs, an error once the job is unknown to squeue
+        out = subprocess.run(['squeue', '-h', '-j', str(job), '-o', '%T'], capture_output=True, text=True)
+        state = out.stdout.strip().split('\n')[0].strip() if out.returncode == 0 else ''
+        if state in ['PENDING', 'CONFIGURING', 'REQUEUED', 'SUSPENDED']:
+            return PENDING
+        if state in ['RUNNING', 'COMPLETING']:
+            return RUNNING
+
+        # left the queue
+        out = subprocess.run(['sacct', '-n', '-X', '-j', str(job), '-o', 'State'], capture_output=True, text=True)
+        state = out.stdout.strip().split('\n')[0].strip() if out.returncode == 0 else ''
+        if state == '':
+            self.empty_polls[job] = self.empty_polls.get(job, 0) + 1
+            if self.empty_polls[job] < self.max_empty_polls:
+                return RUNNING
+            # no accounting record, the job has left the queue without a loss.txt if it is not complete
+            self.final[job] = COMPLETED if jobdir_status(self.jobs[job]) == COMPLETED else FAILED
+        elif state.startswith('COMPLETED'):
+            self.final[job] = COMPLETED
+        elif state.startswith('PENDING') or state.startswith('RUNNING'):
+            return RUNNING
+        else:
+            self.final[job] = FAILED
+        return self.final[job]
+
+    def cancel(self, job):
+        subprocess.run(['scancel', str(job)])
+
+
+def make_executor(backend, sbatch_fn, job_fn, max_workers=None, threads_per_job=1):
+    if backend == 'sbatch':
+        return SbatchExecutor(sbatch_fn)
+    elif backend == 'local':
+        return LocalExecutor([sys.executable, '-u', os.path.basename(job_fn)], max_workers=max_workers,
+                             threads_per_job=threads_per_job)
+    else:
+        raise ValueError('Unknown executor backend: ' + backend)
+
+
+def jobdir_status(jobdir):
+    # status of a job directory from its files, for jobs not tracked by an executor
+    if os.path.exists(os.path.join(jobdir, 'loss.txt')):
+        return COMPLETED
+    err = os.path.join(jobdir, 'a.err')
+    if os.path.exists(err) and 'Traceback' in open(err).read():
+        return FAILED
+    if os.path.exists(os.path.join(jobdir, 'a.out')):
+        return RUNNING
+    return PENDING
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Status of the jobs in a job_topdir.')
+    parser.add_argument('job_topdir')
+    args = parser.parse_args()
+
+    jobdirs = sorted(os.path.dirname(fn) for fn in glob.glob(os.path.join(args.job_topdir, '*', 'args.json')))
+    counts = {PENDING: 0, RUNNING: 0, COMPLETED: 0, FAILED: 0}
+    for jobdir in jobdirs:
+        status = jobdir_status(jobdir)
+        counts[status] += 1
+        print('%-60s %s' % (jobdir, status))
+    print(', '.join('%s: %d' % (s, n) for s, n in counts.items()))
@@ -0,0 +1,156 @@
+'''
+Job directories keyed by the hash of their settings, so a grid can be
+resubmitted without losing finished work.
+
+A job is identified by args_hash of its merged args (hyperparameters and
+settings, without the job paths) and lives in <job_topdir>/job_<hash>/. On
+resubmission, prepare_jobdir skips jobs that are complete (valid loss.txt and,
+if the job saves its model, net.pth) and reuses the directories of missing or
+failed jobs, keeping their checkpoint.pth so they resume where they stopped.
+Jobs that are still queued or running (see job_active in nntools/executors.py)
+are skipped as well, unless forced.
+
+With warm_start_dirs, a new job is initialized from the net.pth of the nearest
+completed job in those job_topdirs with the same layer shapes and data (same
+SHAPE_KEYS args), e.g. for a refinement grid over dropout or learning rate.
+The job it starts from is recorded in args.json as warm_start_from.
+'''
+
+import os
+import glob
+import json
+import shutil
+import hashlib
+import numpy as np
+from nntools.executors import job_active
+
+
+# args that depend on where the job lives or how it was started, not on its config
+PATH_KEYS = ['savedir', 'save_results_dir', 'load_results_dir', 'args_hash',
+             'warm_start_from', 'warm_start_args_hash', 'warm_start_val_loss']
+
+# args that may differ between the members of one vectorized ensemble (see
+# eqnet_ensemble_batch.py), all other args must match
+ENSEMBLE_MEMBER_KEYS = ['learn_rate', 'p_dropout_in', 'p_dropout_hidden', 'ijob'] + PATH_KEYS
+
+# the ensemble trains plain MLPs with Adam at a constant lr, so these args must have
+# their default values (e.g. checkpoint_every and log_every 0) in an ensemble member
+ENSEMBLE_DEFAULTS = {'optimizer': 'adam', 'lr_schedule': 'constant', 'warmup_epochs': 0, 'max_lr': None,
+                     'lr_find': False, 'multitask': False, 'multihead': False, 'checkpoint_every': 0,
+                     'log_every': 0, 'warm_start_from': None, 'target_val_loss': None, 'finetune': False,
+                     'use_pretrained_model': False}
+
+# args that fix the layer shapes of the net and the data its scalers are fit to
+SHAPE_KEYS = ['xnames', 'ynames', 'hidden_dims', 'head_hidden_dims', 'shape_control_mode', 'multitask',
+              'multihead', 'dataset_dir', 'data_pca_fn', 'traindata_fn', 'valdata_fn', 'testdata_fn']
+
+
+def args_hash(args):
+    key = {k: v for k, v in args.items() if k not in PATH_KEYS}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:12]
+
+
+# args a run may change and still resume from its checkpoint.pth: the epoch budget
+# (ASHA promotions) and the settings filled in at run time
+RESUME_KEYS = ['num_epochs', 'checkpoint_every', 'root']
+
+
+def resume_hash(args):
+    # hash of the args a checkpoint can be resumed with, max_lr comes from the lr range test with lr_find
+    exclude = RESUME_KEYS + (['max_lr'] if args.get('lr_find', False) else [])
+    return args_hash({k: v for k, v in args.items() if k not in exclude})
+
+
+def ensemble_unsupported(args):
+    # args that keep a job from training as an ensemble member, see ENSEMBLE_DEFAULTS
+    return [k for k, v in ENSEMBLE_DEFAULTS.items() if args.get(k, v) != v]
+
+
+def job_complete(jobdir, args=None):
+    '''
+    True if jobdir holds a finished job: a valid loss.txt, net.pth unless the job
+    does not save its model, and, if args is given, trained for args.num_epochs
+    (the job args.json can have fewer, e.g. a config stopped early by ASHA).
+    '''
+    try:
+        loss = np.loadtxt(os.path.join(jobdir, 'loss.txt'))
+        if loss.size == 0 or not np.isfinite(loss.reshape(-1)[-1]):
+            return False
+        with open(os.path.join(jobdir, 'args.json')) as infile:
+            job_args = json.load(infile)
+    except Exception:
+        return False
+
+    if args is not None and args.get('num_epochs') != job_args.get('num_epochs'):
+        return False
+
+    if job_args.get('savemodel', True):
+        fn = os.path.join(jobdir, 'net.pth')
+        return os.path.exists(fn) and os.path.getsize(fn) > 0
+    return True
+
+
+def list_jobdirs(job_topdir):
+    # job directories of a job_topdir, in a fixed order
+    return sorted(os.path.dirname(fn) + '/' for fn in glob.glob(os.path.join(job_topdir, 'job*', 'args.json')))
+
+
+def find_warm_start(args, job_topdirs):
+    '''
+    The completed job in job_topdirs (with a net.pth) that has the same
+    SHAPE_KEYS args as args and differs in the fewest other args, the one with
+    the lowest val loss among equals. Returns (jobdir, job args, val loss) or None.
+    '''
+    h = args_hash(args)
+    best = None
+    for job_topdir in job_topdirs:
+        for jobdir in list_jobdirs(job_topdir):
+            if not job_complete(jobdir) or not os.path.exists(jobdir + 'net.pth'):
+                continue
+            with open(jobdir + 'args.json') as infile:
+                job_args = json.load(infile)
+            if job_args.get('args_hash') == h or any(job_args.get(k) != args.get(k) for k in SHAPE_KEYS):
+                continue
+            ndiff = sum(job_args.get(k) != args.get(k) for k in set(args) | set(job_args) if k not in PATH_KEYS)
+            loss = float(np.loadtxt(jobdir + 'loss.txt')[1, -1])
+            if best is None or (ndiff, loss) < best[0]:
+                best = ((ndiff, loss), jobdir, job_args)
+    if best is None:
+        return None
+    return best[1], best[2], best[0][1]
+
+
+def prepare_jobdir(job_topdir, args, job_fn, warm_start_dirs=None, force=False):
+    '''
+    Sets up the job directory for args (without job paths) under job_topdir.
+    Returns (jobdir, args, skip), where args has the job paths filled in and
+    skip is 'complete' if the job is already complete, 'active' if it is still
+    queued or running (unless force), and False if it is to be launched.
+    With warm_start_dirs, a new job starts from the nearest compatible completed
+    job there (see find_warm_start), if any.
+    '''
+    h = args_hash(args)
+    jobdir = job_topdir + 'job_' + h + '/'
+    args = dict(args)
+    args['savedir'] = jobdir
+    args['save_results_dir'] = jobdir
+    args['args_hash'] = h
+
+    if job_complete(jobdir, args):
+        return jobdir, args, 'complete'
+    if not force and job_active(jobdir):
+        return jobdir, args, 'active'
+
+    if warm_start_dirs:
+        found = find_warm_start(args, warm_start_dirs)
+        if found is not None:
+            args['warm_start_from'] = found[0]
+            args['warm_start_args_hash'] = found[1].get('args_hash')
+            args['warm_start_val_loss'] = found[2]
+
+    os.makedirs(jobdir, exist_ok=True)
+    shutil.copy(job_fn, jobdir)
+    with open(jobdir + 'args.json', 'w') as outfile:
+        json.dump(args, outfile, indent=4)
+
+    return jobdir, args, False
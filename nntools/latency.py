@@ -0,0 +1,141 @@
+'''
+Inference cost of trained nets, next to their validation loss.
+
+With the job setting benchmark_latency (default False, set by the submit
+scripts), the batch scripts call benchmark_latency on a newly trained net (not
+for pretrained or fine-tuned models) and write the result to latency.json in the
+job directory: the parameter count and, for each batch size, percentiles of the
+wall time of one forward pass (in microseconds) on the cpu the job ran on, with
+nthreads torch threads. Other job settings: latency_batch_sizes (default
+[1, 256]) and latency_threads (default 1).
+
+Pareto front of (validation loss, latency) over the jobs of a job_topdir, e.g. to
+choose an architecture that fits the control cycle:
+    python -m nntools.latency <job_topdir> [--batch_size 1] [--stat p99_us]
+'''
+
+import os
+import json
+import time
+import argparse
+import platform
+import numpy as np
+import torch
+from nntools.jobs import list_jobdirs
+from nntools.asha import last_val_loss
+
+
+def count_params(net):
+    return int(sum(p.numel() for p in net.parameters()))
+
+
+def time_forward(net, x, nrepeat, nwarmup=10):
+    with torch.no_grad():
+        for i in range(nwarmup):
+            net(x)
+        times = np.empty(nrepeat)
+        for i in range(nrepeat):
+            t0 = time.perf_counter()
+            net(x)
+            times[i] = time.perf_counter() - t0
+    return times * 1e6
+
+
+def benchmark_latency(net, in_dim, batch_sizes=[1, 256], nrepeat=1000, min_repeat=200, nthreads=1):
+    '''
+    Latency percentiles of net (in eval mode) per batch size, in microseconds
+    per forward pass. Large batches are repeated fewer times, but at least 
+    min_repeat times so that the p99 is not just the slowest call.
+    '''
+    training = net.training
+    num_threads = torch.get_num_threads()
+    net.eval()
+    torch.set_num_threads(nthreads)
+
+    result = {'num_params': count_params(net), 'nthreads': nthreads,
+              'cpu': platform.processor() or platform.machine(), 'batch': {}}
+    try:
+        for batch_size in batch_sizes:
+            x = torch.randn(batch_size, in_dim)
+            times = time_forward(net, x, max(nrepeat // batch_size, min_repeat))
+            result['batch'][str(batch_size)] = {
+                'mean_us': float(times.mean()),
+                'p50_us': float(np.percentile(times, 50)),
+                'p90_us': float(np.percentile(times, 90)),
+                'p99_us': float(np.percentile(times, 99)),
+                'max_us': float(times.max()),
+                'per_sample_us': float(np.percentile(times, 50) / batch_size)}
+    finally:
+        torch.set_num_threads(num_threads)
+        net.train(training)
+
+    return result
+
+
+def write_latency(net, in_dim, hp):
+    # benchmark with the job settings and write latency.json to the job directory
+    result = benchmark_latency(net, in_dim, hp.get('latency_batch_sizes', [1, 256]),
+                               nthreads=hp.get('latency_threads', 1))
+    with open(hp.save_results_dir + '/latency.json', 'w') as outfile:
+        json.dump(result, outfile, indent=4)
+    for batch_size, stats in result['batch'].items():
+        print('Latency at batch size %s: p50 %.1f us, p99 %.1f us' % (batch_size, stats['p50_us'], stats['p99_us']))
+    return result
+
+
+def pareto_front(loss, latency):
+    # indices of the jobs that no other job beats in both loss and latency, by latency
+    order = np.lexsort((loss, latency))
+    front = []
+    best = np.inf
+    for i in order:
+        if loss[i] < best:
+            front.append(i)
+            best = loss[i]
+    return front
+
+
+def latency_report(job_topdir, batch_size=1, stat='p50_us'):
+    '''
+    Table of val loss, parameter count and latency of the jobs in job_topdir
+    that have a latency.json, with the Pareto-optimal jobs marked.
+    '''
+    rows = []
+    for jobdir in list_jobdirs(job_topdir):
+        try:
+            with open(jobdir + 'latency.json') as infile:
+                result = json.load(infile)
+            stats = result['batch'][str(batch_size)]
+        except (OSError, KeyError):
+            continue
+        loss = last_val_loss(jobdir)
+        if np.isfinite(loss):
+            rows.append((jobdir, loss, result['num_params'], stats[stat], stats['p99_us']))
+
+    if len(rows) == 0:
+        return 'No jobs with latency.json in ' + job_topdir
+
+    loss = np.array([r[1] for r in rows])
+    latency = np.array([r[3] for r in rows])
+    front = pareto_front(loss, latency)
+
+    lines = ['Batch size %d, latency %s' % (batch_size, stat), '']
+    lines.append('%-60s %14s %12s %12s %12s %7s' % ('job', 'val loss', 'params', stat, 'p99_us', 'pareto'))
+    for i in front + sorted(set(range(len(rows))) - set(front), key=lambda i: loss[i]):
+        jobdir, l, nparams, lat, p99 = rows[i]
+        lines.append('%-60s %14.4e %12d %12.1f %12.1f %7s' % (jobdir, l, nparams, lat, p99, '*' if i in front else ''))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Pareto front of val loss and latency of the jobs in a job_topdir.')
+    parser.add_argument('job_topdir')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--stat', default='p50_us', help='mean_us, p50_us, p90_us, p99_us or max_us')
+    args = parser.parse_args()
+
+    report = latency_report(args.job_topdir, args.batch_size, args.stat)
+    print(report)
+    with open(os.path.join(args.job_topdir, 'pareto.txt'), 'w') as outfile:
+        outfile.write(report + '\n')
@@ -0,0 +1,162 @@
+'''
+Streaming training metrics. 
+
+MetricsWriter appends one JSON record per line to a job's metrics.jsonl while 
+it trains, and MetricsReader follows the streams of many jobs at once. Each 
+record has the fields: step, epoch, time (unix time), wall (seconds since the 
+writer was opened), samples_per_s, train_loss (mean over the batches since the
+previous record), val_loss (None if not evaluated at this step) and lr.
+
+To follow all jobs of a grid from a terminal:
+    python -m nntools.metrics <job_topdir> [--interval 10]
+'''
+
+import os
+import json
+import time
+import glob
+import argparse
+
+
+class MetricsWriter():
+    '''
+    Append-only, line-buffered writer of metrics.jsonl. Every record is flushed
+    as soon as it is written, so running jobs can be followed live.
+    '''
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.file = open(fn, 'a', buffering=1)
+        self.start_time = time.time()
+        self.last_time = self.start_time
+        self.loss_sum = 0.0
+        self.nbatches = 0
+        self.nsamples = 0
+
+    def update(self, batch_size, loss):
+        # accumulate the training loss of one batch
+        self.loss_sum += loss
+        self.nbatches += 1
+        self.nsamples += batch_size
+
+    def write(self, step, epoch, lr=None, val_loss=None):
+        now = time.time()
+        record = {
+            'step': step,
+            'epoch': epoch,
+            'time': now,
+            'wall': now - self.start_time,
+            'samples_per_s': self.nsamples / max(now - self.last_time, 1e-9),
+            'train_loss': self.loss_sum / self.nbatches if self.nbatches > 0 else None,
+            'val_loss': val_loss,
+            'lr': lr,
+        }
+        self.file.write(json.dumps(record) + '\n')
+
+        self.last_time = now
+        self.loss_sum = 0.0
+        self.nbatches = 0
+        self.nsamples = 0
+
+    def close(self):
+        self.file.close()
+
+
+def read_metrics(fn):
+    # all complete records of one metrics.jsonl
+    records = []
+    with open(fn) as f:
+        for line in f:
+            if line.endswith('\n'):
+                records.append(json.loads(line))
+    return records
+
+
+class MetricsReader():
+    '''
+    Tails the metrics.jsonl files of many jobs. poll() only stats each file and 
+    reads the bytes appended since the previous poll; incomplete trailing lines
+    are kept until the rest of the line arrives.
+    '''
+
+    def __init__(self, fns=[]):
+        self.offsets = {}
+        self.partial = {}
+        self.latest = {}
+        self.latest_val_loss = {}
+        for fn in fns:
+            self.add(fn)
+
+    def add(self, fn):
+        if fn not in self.offsets:
+            self.offsets[fn] = 0
+            self.partial[fn] = b''
+            self.latest[fn] = None
+            self.latest_val_loss[fn] = None
+
+    def poll(self):
+        # returns {fn: [new records]} for the files that have new records
+        new_records = {}
+
+        for fn in self.offsets:
+            try:
+                size = os.stat(fn).st_size
+            except FileNotFoundError:
+                continue
+            if size <= self.offsets[fn]:
+                continue
+
+            with open(fn, 'rb') as f:
+                f.seek(self.offsets[fn])
+                data = self.partial[fn] + f.read(size - self.offsets[fn])
+            self.offsets[fn] = size
+
+            lines = data.split(b'\n')
+            self.partial[fn] = lines.pop()
+            records = [json.loads(line) for line in lines if line]
+            if records:
+                new_records[fn] = records
+                self.latest[fn] = records[-1]
+                for record in records:
+                    if record['val_loss'] is not None:
+                        self.latest_val_loss[fn] = record['val_loss']
+
+        return new_records
+
+    def follow(self, interval=5.0):
+        # generator of (fn, record) over all jobs, polling every interval seconds
+        while True:
+            for fn, records in self.poll().items():
+                for record in records:
+                    yield fn, record
+            time.sleep(interval)
+
+
+def watch(job_topdir, interval=10.0):
+    # print the latest record of each job under job_topdir every interval seconds
+    reader = MetricsReader()
+    while True:
+        for fn in sorted(glob.glob(os.path.join(job_topdir, '**', 'metrics.jsonl'), recursive=True)):
+            reader.add(fn)
+        reader.poll()
+
+        lines = ['%-40s %8s %6s %10s %12s %12s %10s' % 
+                 ('job', 'step', 'epoch', 'samples/s', 'train_loss', 'val_loss', 'lr')]
+        for fn, r in reader.latest.items():
+            if r is None:
+                continue
+            job = os.path.relpath(os.path.dirname(fn), job_topdir)
+            fmt = lambda x: '%.4e' % x if x is not None else '-'
+            lines.append('%-40s %8d %6d %10.0f %12s %12s %10s' % 
+                         (job, r['step'], r['epoch'], r['samples_per_s'], fmt(r['train_loss']), 
+                          fmt(reader.latest_val_loss[fn]), fmt(r['lr'])))
+        print('\n'.join(lines) + '\n', flush=True)
+        time.sleep(interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Follow the training metrics of all jobs in a directory.')
+    parser.add_argument('job_topdir')
+    parser.add_argument('--interval', type=float, default=10.0)
+    args = parser.parse_args()
+    watch(args.job_topdir, args.interval)
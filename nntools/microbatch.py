@@ -0,0 +1,122 @@
+'''
+Dynamic micro-batching of concurrent inference requests.
+
+A MicroBatcher wraps a function fn mapping a batch of inputs (n x d array) to
+outputs (n x k). Requests submitted from any thread are queued; a worker thread
+takes the first waiting request, then keeps collecting requests for at most
+max_wait_ms or until max_batch_size rows are gathered, runs fn once on all of
+them and hands each request its rows of the output. max_wait_ms is the latency
+budget a request may spend waiting for others to share its batch.
+
+stats() gives throughput and latency counters since the start (or the last
+reset), with latency percentiles over the last 10000 requests.
+'''
+
+import time
+import queue
+import threading
+import collections
+import numpy as np
+from concurrent.futures import Future
+
+
+class MicroBatcher():
+
+    def __init__(self, fn, max_batch_size=256, max_wait_ms=2.0):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.reset_stats()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, X):
+        # returns a Future with the outputs for the rows of X
+        future = Future()
+        self.queue.put((np.asarray(X), future, time.perf_counter()))
+        return future
+
+    def __call__(self, X):
+        return self.submit(X).result()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            items = [item]
+            n = len(item[0])
+            deadline = time.perf_counter() + self.max_wait
+            stop = False
+            while n < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                items.append(item)
+                n += len(item[0])
+
+            self._run_batch(items)
+            if stop:
+                return
+
+    def _run_batch(self, items):
+        t0 = time.perf_counter()
+        try:
+            Y = self.fn(np.concatenate([X for X, _, _ in items]))
+        except Exception as e:
+            for _, future, _ in items:
+                future.set_exception(e)
+            return
+        t1 = time.perf_counter()
+
+        i = 0
+        for X, future, t_submit in items:
+            future.set_result(Y[i:i + len(X)])
+            i += len(X)
+
+        with self.lock:
+            self.nbatches += 1
+            self.nrequests += len(items)
+            self.nsamples += i
+            self.compute_time += t1 - t0
+            self.batch_sizes.append(i)
+            self.latencies.extend(t1 - t_submit for _, _, t_submit in items)
+
+    def reset_stats(self):
+        with self.lock:
+            self.start_time = time.perf_counter()
+            self.nbatches = 0
+            self.nrequests = 0
+            self.nsamples = 0
+            self.compute_time = 0.0
+            self.batch_sizes = collections.deque(maxlen=10000)
+            self.latencies = collections.deque(maxlen=10000)
+
+    def stats(self):
+        with self.lock:
+            elapsed = time.perf_counter() - self.start_time
+            latencies = np.asarray(self.latencies) * 1000
+            stats = {'requests': self.nrequests, 'samples': self.nsamples, 'batches': self.nbatches,
+                     'elapsed_s': elapsed,
+                     'requests_per_s': self.nrequests / elapsed,
+                     'samples_per_s': self.nsamples / elapsed,
+                     'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+                     'compute_fraction': self.compute_time / elapsed,
+                     'queued': self.queue.qsize()}
+        for p in [50, 90, 99]:
+            stats['latency_p%d_ms' % p] = float(np.percentile(latencies, p)) if len(latencies) else None
+        stats['latency_max_ms'] = float(latencies.max()) if len(latencies) else None
+        return stats
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,123 @@
+'''
+Network modules shared by eqnet and pertnet: the MLP, the multi-head MLP with a
+shared trunk and its per-head loss. eqnet_utils and pertnet_utils import them
+from here.
+'''
+
+import torch
+import torch.nn as nn
+
+
+# ===========================
+# MULTILAYER PERCEPTRON CLASS
+# ===========================
+def get_nonlinearity(nonlinearity):
+    
+    if nonlinearity.upper() == 'RELU':
+        nonlinearity = nn.ReLU()
+    elif nonlinearity.upper() == 'TANH':
+        nonlinearity = nn.Tanh()
+    elif nonlinearity.upper() == 'LEAKYRELU':
+        nonlinearity = nn.LeakyReLU()
+    elif nonlinearity.upper() == 'ELU':
+        nonlinearity = nn.ELU()
+
+    return nonlinearity
+
+
+class MLP(nn.Module):
+    '''
+    Multilayer Perceptron.
+    '''
+
+    def __init__(self, in_dim, out_dim, hidden_dims, nonlinearity='RELU', p_dropout_in=0, p_dropout_hidden=0.2):
+        super().__init__()
+        
+        nonlinearity = get_nonlinearity(nonlinearity)
+        
+        dims = [in_dim]
+        dims.extend(hidden_dims)
+        dims.extend([out_dim])
+
+        nlayers = len(dims) - 1
+        layers = []
+
+        for i in range(nlayers):
+            if i == 0:
+                p = p_dropout_in
+            else:
+                p = p_dropout_hidden
+            layers.append(nn.Dropout(p=p))
+            layers.append(nn.Linear(dims[i], dims[i + 1]))
+            layers.append(nonlinearity)
+
+        layers.pop()
+        self.net = nn.Sequential(*layers)
+
+    def forward(self, x):
+        return self.net(x)
+
+
+# ======================================
+# MULTI-HEAD MULTILAYER PERCEPTRON CLASS
+# ======================================
+class MultiHeadMLP(nn.Module):
+    '''
+    Multilayer Perceptron with a shared trunk and one output head per group of 
+    targets (e.g. one head per dpsidix_smooth_coil in pertnet, or the flux PCA 
+    coefficients and the shape control parameters in eqnet). Head outputs are 
+    concatenated in the order of head_dims, so the net can be used anywhere an 
+    MLP predicting the stacked targets is used.
+    '''
+
+    def __init__(self, in_dim, head_dims, hidden_dims, head_hidden_dims=None, nonlinearity='RELU', 
+                 p_dropout_in=0, p_dropout_hidden=0.2):
+        super().__init__()
+
+        if head_hidden_dims is None:
+            head_hidden_dims = []
+
+        self.head_dims = list(head_dims)
+        trunk_dim = hidden_dims[-1]
+        
+        self.trunk = MLP(in_dim, trunk_dim, hidden_dims[:-1], nonlinearity=nonlinearity,
+                         p_dropout_in=p_dropout_in, p_dropout_hidden=p_dropout_hidden)
+        self.nonlinearity = get_nonlinearity(nonlinearity)
+
+        heads = []
+        for head_dim in self.head_dims:
+            heads.append(MLP(trunk_dim, head_dim, head_hidden_dims, nonlinearity=nonlinearity,
+                             p_dropout_in=p_dropout_hidden, p_dropout_hidden=p_dropout_hidden))
+        self.heads = nn.ModuleList(heads)
+
+    def forward(self, x):
+        z = self.nonlinearity(self.trunk(x))
+        return torch.cat([head(z) for head in self.heads], dim=-1)
+
+    def split(self, y):
+        return torch.split(y, self.head_dims, dim=-1)
+
+
+class MultiHeadLoss():
+    '''
+    Per-head loss for MultiHeadMLP. Each head is scored separately with loss_fcn
+    and the weighted mean over heads is returned, so targets with many PCA 
+    coefficients do not dominate targets with few, and heads can be balanced
+    with weights. The most recent per-head 
+    losses are kept in head_losses.
+    '''
+    def __init__(self, loss_fcn, head_dims, weights=None):
+        super().__init__()
+        self.loss_fcn = loss_fcn
+        self.head_dims = list(head_dims)
+        if weights is None:
+            weights = [1.0 for i in range(len(self.head_dims))]
+        self.weights = torch.Tensor(weights)
+        self.head_losses = None
+
+    def __call__(self, input, target):
+        inputs = torch.split(input, self.head_dims, dim=-1)
+        targets = torch.split(target, self.head_dims, dim=-1)
+        losses = torch.stack([self.loss_fcn(i, t) for i, t in zip(inputs, targets)])
+        self.head_losses = losses.detach()
+        return torch.sum(self.weights * losses) / torch.sum(self.weights)
@@ -0,0 +1,106 @@
+'''
+Packing of many small jobs into few allocations.
+
+submit_packed splits a list of job directories into packs of pack_size jobs and
+writes pack<i>/pack.json under pack_topdir. With the sbatch backend all packs
+are submitted as one array job of pack_sbatch_fn (array task i runs pack<i>),
+and with the local backend the packs are run with a LocalExecutor, so the
+packing can be tested without SLURM.
+
+Each pack is run by the packing worker:
+    python -m nntools.packing [--cores N]
+run from the pack directory. It runs the jobs of the pack as a local process
+pool within the core budget (--cores, default SLURM_CPUS_PER_TASK or all cores),
+threads_per_job cores per job, and writes the final status of every job to
+pack_status.json. The exit code is nonzero if any job failed.
+'''
+
+import os
+import sys
+import json
+import argparse
+from nntools.executors import LocalExecutor, SbatchExecutor, COMPLETED
+
+
+NNTOOLS_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_packs(jobdirs, job_fn, pack_topdir, pack_size, threads_per_job=1):
+    packdirs = []
+    for i, istart in enumerate(range(0, len(jobdirs), pack_size)):
+        packdir = os.path.join(pack_topdir, 'pack%d' % i)
+        os.makedirs(packdir, exist_ok=True)
+        pack = {'jobdirs': list(jobdirs[istart:istart + pack_size]),
+                'cmd': ['python', '-u', os.path.basename(job_fn)],
+                'threads_per_job': threads_per_job}
+        with open(os.path.join(packdir, 'pack.json'), 'w') as outfile:
+            json.dump(pack, outfile, indent=4)
+        packdirs.append(packdir)
+    return packdirs
+
+
+def submit_packed(jobdirs, job_fn, pack_topdir, pack_size, backend, pack_sbatch_fn=None,
+                  threads_per_job=1, cores=None, max_packs=1):
+    '''
+    Submits jobdirs in packs of pack_size jobs. Returns the executor and the
+    submitted job ids, e.g. to wait on the local packs. Locally, max_packs packs
+    run at the same time, each with a budget of cores cores.
+    '''
+    packdirs = write_packs(jobdirs, job_fn, pack_topdir, pack_size, threads_per_job)
+
+    if backend == 'sbatch':
+        executor = SbatchExecutor(pack_sbatch_fn, ['--array=0-%d' % (len(packdirs) - 1)])
+        jobs = [executor.submit(pack_topdir)]
+        executor.mark_submitted(jobdirs, jobs[0])
+
+    elif backend == 'local':
+        cmd = [sys.executable, '-u', '-m', 'nntools.packing']
+        if cores is not None:
+            cmd += ['--cores', str(cores)]
+        executor = LocalExecutor(cmd, max_workers=max_packs)
+        pythonpath = os.pathsep.join([NNTOOLS_PARENT] + [p for p in [os.environ.get('PYTHONPATH')] if p])
+        jobs = [executor.submit(packdir, env={'PYTHONPATH': pythonpath}) for packdir in packdirs]
+        for packdir, job in zip(packdirs, jobs):
+            with open(os.path.join(packdir, 'pack.json')) as infile:
+                executor.mark_submitted(json.load(infile)['jobdirs'], job)
+
+    else:
+        raise ValueError('Unknown executor backend: ' + backend)
+
+    print('Submitted %d jobs in %d packs' % (len(jobdirs), len(packdirs)))
+    return executor, jobs
+
+
+def run_pack(packdir, cores=None):
+
+    with open(os.path.join(packdir, 'pack.json')) as infile:
+        pack = json.load(infile)
+
+    if cores is None:
+        cores = int(os.environ.get('SLURM_CPUS_PER_TASK', os.cpu_count()))
+    threads_per_job = pack.get('threads_per_job', 1)
+    max_workers = max(cores // threads_per_job, 1)
+
+    cmd = [sys.executable if c == 'python' else c for c in pack['cmd']]
+    executor = LocalExecutor(cmd, max_workers=max_workers, threads_per_job=threads_per_job)
+    print('Running %d jobs, %d at a time' % (len(pack['jobdirs']), max_workers))
+
+    for jobdir in pack['jobdirs']:
+        executor.submit(jobdir)
+    status = executor.wait(poll_interval=5)
+
+    status = {executor.jobs[job]: s for job, s in status.items()}
+    with open(os.path.join(packdir, 'pack_status.json'), 'w') as outfile:
+        json.dump(status, outfile, indent=4)
+
+    return all(s == COMPLETED for s in status.values())
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Run the jobs of a pack (pack.json in the working directory).')
+    parser.add_argument('--cores', type=int, default=None, help='core budget of the pack')
+    args = parser.parse_args()
+
+    ok = run_pack(os.getcwd(), args.cores)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,240 @@
+'''
+Stage-cached pipeline runner.
+
+A pipeline is a list of Stage objects, each a command with the files it reads
+(inputs), the files it writes (outputs), the code it depends on and any extra
+config, and the files to remove before it runs (clean, e.g. the checkpoint of a
+training job, which must not be resumed by a run with other inputs or code).
+The key of a stage is a hash of its command, config and the contents
+of its inputs and code files. A stage whose key matches the one recorded in
+cache_dir on its last successful run, and whose outputs are unchanged since,
+is skipped. Because keys are taken over file contents, a stage downstream of a
+rerun stage is still skipped if its inputs came out the same.
+
+A stage runs after the stages that write its inputs (and those in its deps),
+and stages that do not depend on each other run concurrently, max_workers at a
+time. The output of each run goes to <cache_dir>/<stage>.log.
+
+Paths are relative to the root directory of the pipeline. Directories in
+inputs and code stand for all files below them. See pipeline.py in the root of
+the repository for an example, run as
+    python pipeline.py [stages] [--max_workers N] [--force stage ...] [--dry_run]
+'''
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class Stage():
+
+    def __init__(self, name, cmd, cwd='.', inputs=[], outputs=[], code=[], config=None, deps=[], env=None, clean=[]):
+        self.name = name
+        self.cmd = list(cmd)
+        self.cwd = cwd
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.code = list(code)
+        self.config = config
+        self.deps = list(deps)
+        self.env = env or {}
+        self.clean = list(clean)
+
+
+class FileHasher():
+    '''
+    Content hashes of files and directories. Hashes are remembered by path, size
+    and modification time in hash_fn, so large datasets are only read again
+    after they change.
+    '''
+
+    def __init__(self, root, hash_fn):
+        self.root = root
+        self.hash_fn = hash_fn
+        self.memo = {}
+        if os.path.exists(hash_fn):
+            with open(hash_fn) as infile:
+                self.memo = json.load(infile)
+
+    def save(self):
+        with open(self.hash_fn, 'w') as outfile:
+            json.dump(self.memo, outfile)
+
+    def hash_file(self, fn):
+        st = os.stat(fn)
+        stamp = '%d:%d' % (st.st_size, st.st_mtime_ns)
+        if fn in self.memo and self.memo[fn][0] == stamp:
+            return self.memo[fn][1]
+        h = hashlib.sha1()
+        with open(fn, 'rb') as infile:
+            for block in iter(lambda: infile.read(1 << 20), b''):
+                h.update(block)
+        self.memo[fn] = [stamp, h.hexdigest()]
+        return self.memo[fn][1]
+
+    def __call__(self, path):
+        # hash of a file or of all files below a directory, None if missing
+        fn = os.path.join(self.root, path)
+        if os.path.isfile(fn):
+            return self.hash_file(fn)
+        if os.path.isdir(fn):
+            h = hashlib.sha1()
+            for dirpath, dirnames, filenames in sorted(os.walk(fn)):
+                dirnames[:] = sorted(d for d in dirnames if d not in ['__pycache__', '.git'])
+                for name in sorted(filenames):
+                    child = os.path.join(dirpath, name)
+                    h.update((os.path.relpath(child, fn) + ':' + self.hash_file(child) + '\n').encode())
+            return h.hexdigest()
+        return None
+
+
+def stage_key(stage, hasher):
+    key = {'cmd': stage.cmd, 'cwd': stage.cwd, 'config': stage.config, 'env': stage.env,
+           'inputs': {path: hasher(path) for path in stage.inputs},
+           'code': {path: hasher(path) for path in stage.code}}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def stage_deps(stages):
+    # upstream stages of each stage: the writers of its inputs and its explicit deps
+    writers = {}
+    for stage in stages:
+        for path in stage.outputs:
+            writers[os.path.normpath(path)] = stage.name
+    deps = {}
+    for stage in stages:
+        deps[stage.name] = set(stage.deps)
+        for path in stage.inputs:
+            path = os.path.normpath(path)
+            for out, writer in writers.items():
+                if writer != stage.name and (path == out or out.startswith(path + os.sep)):
+                    deps[stage.name].add(writer)
+    return deps
+
+
+def run_stage(stage, root, log_fn):
+    env = dict(os.environ)
+    env.update(stage.env)
+    cmd = [sys.executable if c == 'python' else c for c in stage.cmd]
+    for path in stage.clean:
+        fn = os.path.join(root, path)
+        if os.path.isfile(fn):
+            os.remove(fn)
+    with open(log_fn, 'w') as log:
+        proc = subprocess.run(cmd, cwd=os.path.join(root, stage.cwd), env=env, stdout=log, stderr=subprocess.STDOUT)
+    return proc.returncode
+
+
+def run_pipeline(stages, root, cache_dir, targets=None, max_workers=None, force=[], dry_run=False):
+    '''
+    Runs the stages in targets (default all) and their upstream stages, skipping
+    cached ones. Returns the status of each stage: 'cached', 'done', 'failed',
+    'blocked' (an upstream stage failed) or, with dry_run, 'stale'.
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    by_name = {stage.name: stage for stage in stages}
+    deps = stage_deps(stages)
+    hasher = FileHasher(root, os.path.join(cache_dir, 'file_hashes.json'))
+
+    # the targets and everything upstream of them
+    todo = set()
+    queue = list(targets or by_name)
+    while queue:
+        name = queue.pop()
+        if name not in by_name:
+            raise ValueError('Unknown stage: ' + name)
+        if name not in todo:
+            todo.add(name)
+            queue.extend(deps[name])
+
+    def cached(stage, key):
+        fn = os.path.join(cache_dir, stage.name + '.json')
+        if stage.name in force or not os.path.exists(fn):
+            return False
+        with open(fn) as infile:
+            record = json.load(infile)
+        return record['key'] == key and all(hasher(path) == h for path, h in record['outputs'].items())
+
+    status = {}
+    running = {}
+    t0 = {}
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+        while len(status) < len(todo):
+
+            # start or skip the stages whose upstream stages are finished
+            progress = True
+            while progress:
+                progress = False
+                for name in sorted(todo - set(status) - set(running.values())):
+                    upstream = [status.get(d) for d in deps[name] if d in todo]
+                    if any(s in ['failed', 'blocked'] for s in upstream):
+                        status[name] = 'blocked'
+                        print('%-30s blocked' % name)
+                    elif any(s not in ['cached', 'done'] for s in upstream):
+                        continue
+                    else:
+                        stage = by_name[name]
+                        key = stage_key(stage, hasher)
+                        if cached(stage, key):
+                            status[name] = 'cached'
+                            print('%-30s cached' % name)
+                        elif dry_run:
+                            status[name] = 'stale'
+                            print('%-30s stale' % name)
+                        else:
+                            future = pool.submit(run_stage, stage, root, os.path.join(cache_dir, name + '.log'))
+                            running[future] = name
+                            t0[name] = (time.time(), key)
+                            print('%-30s started' % name)
+                    progress = True
+
+            if dry_run:
+                # downstream of a stale stage is stale too
+                for name in sorted(todo - set(status)):
+                    status[name] = 'stale'
+                    print('%-30s stale' % name)
+                break
+
+            if len(status) == len(todo):
+                break
+            if len(running) == 0:
+                raise ValueError('Cyclic stage dependencies: ' + ', '.join(sorted(todo - set(status))))
+
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                stage = by_name[name]
+                start, key = t0[name]
+                missing = [path for path in stage.outputs if hasher(path) is None]
+                if future.result() != 0 or missing:
+                    status[name] = 'failed'
+                    print('%-30s failed after %.1f s, see %s' % (name, time.time() - start,
+                          os.path.join(cache_dir, name + '.log')))
+                    continue
+                record = {'key': key, 'outputs': {path: hasher(path) for path in stage.outputs},
+                          'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+                with open(os.path.join(cache_dir, name + '.json'), 'w') as outfile:
+                    json.dump(record, outfile, indent=4)
+                status[name] = 'done'
+                print('%-30s done in %.1f s' % (name, time.time() - start))
+
+    hasher.save()
+    return status
+
+
+def main(stages, root, cache_dir):
+    # command line interface for a pipeline definition script
+    parser = argparse.ArgumentParser(description='Run the pipeline stages that are not cached.')
+    parser.add_argument('targets', nargs='*', help='stages to bring up to date (default all)')
+    parser.add_argument('--max_workers', type=int, default=None, help='stages run concurrently')
+    parser.add_argument('--force', nargs='*', default=[], help='stages to rerun even if cached')
+    parser.add_argument('--dry_run', action='store_true', help='only list which stages would run')
+    args = parser.parse_args()
+
+    status = run_pipeline(stages, root, cache_dir, args.targets or None, args.max_workers, args.force, args.dry_run)
+    sys.exit(1 if any(s in ['failed', 'blocked'] for s in status.values()) else 0)
@@ -0,0 +1,120 @@
+'''
+Preprocessing shared by eqnet and pertnet: the input and output layout of a
+data dict (xnames/ynames) and the standard scalers fit on the training data.
+eqnet_utils and pertnet_utils import it from here.
+'''
+
+import numpy as np
+import torch
+from sklearn.preprocessing import StandardScaler
+
+
+# ==================
+# DATA PREPROCESSING
+# ==================
+class DataPreProcess():
+    def __init__(self, datadict, xnames, ynames, t_thresh=None):
+        super().__init__()
+
+        X = self.makeX(datadict, xnames)
+        X_scaler = StandardScaler()
+        X_scaler.fit(X)
+
+        Y = self.makeX(datadict, ynames)
+        Y_scaler = StandardScaler()
+        Y_scaler.fit(Y)
+
+        # write to class object
+        self.X_scaler = X_scaler
+        self.Y_scaler = Y_scaler
+        self.Y_pca = datadict[ynames[0]]
+        self.t_thresh = t_thresh        
+        self.xnames = xnames
+        self.ynames = ynames
+        self.ydims = [self.makeX(datadict, [yname]).shape[1] for yname in ynames]
+
+    def makeX(self, datadict, xnames):
+
+        for i, key in enumerate(xnames):
+
+            try:
+                x = datadict[key].coeff_
+            except:
+                x = datadict[key]
+
+            if i == 0:
+                Xdata = np.copy(x)
+            else:
+                Xdata = np.hstack([Xdata, x])
+
+        return Xdata
+
+    def transform(self, datadict, randomize=True, holdback_fraction=0.0, by_shot=False):
+
+        X = self.makeX(datadict, self.xnames)
+        Y = self.makeX(datadict, self.ynames)
+
+        X = self.X_scaler.transform(X)
+        Y = self.Y_scaler.transform(Y)
+
+        time = datadict['time']
+        shot = datadict['shot']
+
+        # use only certain times
+        if self.t_thresh is not None:
+            t = datadict['time']
+            iuse = np.where(t > self.t_thresh)[0]
+            X = X[iuse, :]
+            Y = Y[iuse, :]
+            time = time[iuse]
+            shot = shot[iuse]
+        
+        # remove samples with nans
+        i = ~np.isnan(X).any(axis=1) & ~np.isnan(Y).any(axis=1)
+        X = X[i,:]
+        Y = Y[i,:]
+        time = time[i]
+        shot = shot[i]
+
+        if holdback_fraction > 0 and by_shot:
+            uniqshots = np.unique(shot)
+            sz = int( (1.0-holdback_fraction)*len(uniqshots))
+            select_shots = np.random.choice(uniqshots, sz, replace=False)
+            
+            for ishot, select_shot in enumerate(select_shots):
+                
+                k = np.where(shot == select_shot)[0]
+                if ishot==0:
+                    idx = k
+                else:
+                    idx = np.hstack((idx,k))
+            
+            X = X[idx,:]
+            Y = Y[idx,:]
+            time = time[idx]
+            shot = shot[idx]
+
+        # convert to torch data types
+        X = torch.Tensor(X)
+        Y = torch.Tensor(Y)
+
+
+        # randomize order
+        if randomize:
+            idx = torch.randperm(X.shape[0])
+            X = X[idx, :]
+            Y = Y[idx, :]
+            time = time[idx]
+            shot = shot[idx]
+
+
+        # hold back some samples
+        if holdback_fraction > 0 and not by_shot:
+            nsamples = X.shape[0]
+            nkeep = int((1.0 - holdback_fraction)*nsamples)
+            X = X[:nkeep,:]
+            Y = Y[:nkeep,:]
+            time = time[:nkeep]
+            shot = shot[:nkeep]
+
+        return X, Y, shot, time
@@ -0,0 +1,139 @@
+'''
+Numpy arrays in shared memory, so that several training processes on one node
+can use a single copy of a loaded and transformed dataset.
+
+SharedArrays.create copies a dict of arrays into multiprocessing.shared_memory
+blocks named '<name>_<key>', together with a small '<name>_spec' block holding
+the shapes and dtypes. Any process on the node can then attach to the arrays by
+name with SharedArrays.attach(name), without copying the data. Torch tensors
+from tensors() share the same memory.
+
+The creating process owns the blocks and should call unlink() when done.
+Attaching processes only call close().
+'''
+
+import json
+import numpy as np
+import torch
+from multiprocessing import shared_memory, resource_tracker
+
+
+def _open_block(name):
+    # attach to an existing block. The block must not be registered with the
+    # resource tracker of the attaching process, which would unlink it when the
+    # process exits (python < 3.13 always registers attached blocks)
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class SharedArrays():
+    '''
+    Dict-like collection of numpy arrays in shared memory. Use create() in the
+    process that owns the data and attach() in the processes using it.
+    '''
+
+    def __init__(self, name, blocks, arrays, owner):
+        self.name = name
+        self.blocks = blocks
+        self.arrays = arrays
+        self.owner = owner
+
+    @classmethod
+    def create(cls, name, arrays):
+
+        spec = {}
+        blocks = {}
+        shared = {}
+
+        for key, x in arrays.items():
+            if isinstance(x, torch.Tensor):
+                x = x.detach().numpy()
+            x = np.ascontiguousarray(x)
+
+            shm = shared_memory.SharedMemory(name=name + '_' + key, create=True, size=max(x.nbytes, 1))
+            y = np.ndarray(x.shape, dtype=x.dtype, buffer=shm.buf)
+            y[...] = x
+
+            blocks[key] = shm
+            shared[key] = y
+            spec[key] = {'shape': list(x.shape), 'dtype': x.dtype.str}
+
+        # spec block: 8 byte length followed by json
+        spec = json.dumps(spec).encode()
+        shm = shared_memory.SharedMemory(name=name + '_spec', create=True, size=len(spec) + 8)
+        shm.buf[:8] = len(spec).to_bytes(8, 'little')
+        shm.buf[8:8 + len(spec)] = spec
+        blocks['_spec'] = shm
+
+        return cls(name, blocks, shared, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+
+        shm = _open_block(name + '_spec')
+        n = int.from_bytes(bytes(shm.buf[:8]), 'little')
+        spec = json.loads(bytes(shm.buf[8:8 + n]).decode())
+        blocks = {'_spec': shm}
+        arrays = {}
+
+        for key, s in spec.items():
+            shm = _open_block(name + '_' + key)
+            blocks[key] = shm
+            arrays[key] = np.ndarray(s['shape'], dtype=np.dtype(s['dtype']), buffer=shm.buf)
+
+        return cls(name, blocks, arrays, owner=False)
+
+    def tensors(self):
+        # zero-copy torch views of the float arrays, other arrays are returned as is
+        out = {}
+        for key, x in self.arrays.items():
+            if x.dtype.kind == 'f':
+                out[key] = torch.from_numpy(x)
+            else:
+                out[key] = x
+        return out
+
+    def nbytes(self):
+        return sum(x.nbytes for x in self.arrays.values())
+
+    def keys(self):
+        return self.arrays.keys()
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    def close(self):
+        # views into the blocks must be released before the blocks can be closed
+        self.arrays = {}
+        for shm in self.blocks.values():
+            try:
+                shm.close()
+            except BufferError:
+                pass
+
+    def unlink(self):
+        self.close()
+        if self.owner:
+            for shm in self.blocks.values():
+                try:
+                    shm.unlink()
+                except FileNotFoundError:
+                    pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self.owner:
+            self.unlink()
+        else:
+            self.close()
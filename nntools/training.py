@@ -0,0 +1,532 @@
+'''
+Training infrastructure shared by eqnet and pertnet: chunked inference, the
+minibatch and full-batch training loops with resumable checkpoints and streaming
+metrics, warm starts, learning rate scaling, schedules and the range test, and
+the fine-tuning helpers (shot splits, saved preprocessing, forgetting report).
+eqnet_utils and pertnet_utils import them from here.
+'''
+
+import os
+import copy
+import random
+import pickle
+import numpy as np
+import torch
+from nntools.metrics import MetricsWriter
+from nntools.jobs import resume_hash
+
+
+# =========
+# INFERENCE
+# =========
+def predict(net, X, chunk_size=4096, out=None):
+    '''
+    Output of net (in eval mode) for all rows of X, computed under 
+    torch.inference_mode in chunks of chunk_size rows, so no autograd graph is
+    built and only one chunk of activations is alive at a time. The chunks are 
+    written into out, or into an output tensor allocated once for all rows.
+    '''
+    X = torch.as_tensor(X, dtype=torch.float32)
+    training = net.training
+    net.eval()
+    try:
+        with torch.inference_mode():
+            y = net(X[:chunk_size])
+            if out is None:
+                with torch.inference_mode(False):
+                    out = torch.empty((X.shape[0],) + tuple(y.shape[1:]), dtype=y.dtype)
+            out[:y.shape[0]] = y
+            for i in range(chunk_size, X.shape[0], chunk_size):
+                out[i:i + chunk_size] = net(X[i:i + chunk_size])
+    finally:
+        net.train(training)
+    return out
+
+
+# ========
+# TRAINING
+# ========
+def train(net, loss_fcn, optimizer, train_dataloader, val_dataloader, hp, scheduler=None):
+
+    if isinstance(optimizer, torch.optim.LBFGS):
+        return train_full_batch(net, loss_fcn, optimizer, train_dataloader, val_dataloader, hp)
+
+    training_loss = []
+    validation_loss = []
+    val_dataiter = iter(val_dataloader)
+    start_epoch = 0
+    step = 0
+
+    # periodic checkpoints, training resumes from the last one if the job is restarted
+    # with the same settings (up to num_epochs, see resume_hash in nntools/jobs.py)
+    checkpoint_fn = None
+    if hp.get('checkpoint_every', 0) > 0:
+        checkpoint_fn = hp.save_results_dir + '/checkpoint.pth'
+
+    if checkpoint_fn is not None and os.path.exists(checkpoint_fn):
+        state = load_checkpoint(checkpoint_fn, net, optimizer, scheduler, key=resume_hash(hp))
+        if state is None:
+            print('Ignoring checkpoint of a run with different settings')
+        else:
+            start_epoch, step, training_loss, validation_loss = state
+            print('Resuming from checkpoint at epoch %d' % start_epoch)
+
+    # streaming metrics, appended to metrics.jsonl every log_every steps
+    metrics = None
+    if hp.get('log_every', 0) > 0:
+        metrics = MetricsWriter(hp.save_results_dir + '/metrics.jsonl')
+
+    for epoch in range(start_epoch, hp.num_epochs):
+        for i, data in enumerate(train_dataloader):
+
+            x_batch, y_batch = data
+            y_pred = net(x_batch)
+
+            # compute loss
+            loss = loss_fcn(y_pred, y_batch)
+
+            # update parameters
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            if scheduler is not None:
+                scheduler.step()
+
+            batch_loss = loss.item()
+            new_val_loss = None
+            if metrics is not None:
+                metrics.update(x_batch.shape[0], batch_loss)
+
+            if i % hp.print_every == 0:
+
+                # save training loss
+                training_loss.append(batch_loss)
+
+                # calculate and save validation loss
+                try:
+                    x, y = next(val_dataiter)
+                except StopIteration:
+                    val_dataiter = iter(val_dataloader)
+                    x, y = next(val_dataiter)
+                
+                ypred = predict(net, x)
+                val_loss = loss_fcn(ypred, y).item()
+                validation_loss.append(val_loss)
+                new_val_loss = val_loss
+
+                print('Epoch: %d of %d, train_loss: %3e, val_loss: %3e' %
+                      (epoch + 1, hp.num_epochs, batch_loss, val_loss))
+
+            step += 1
+            
+            if metrics is not None and (step % hp.log_every == 0 or new_val_loss is not None):
+                metrics.write(step, epoch + 1, optimizer.param_groups[0]['lr'], new_val_loss)
+
+            # optionally stop once a target validation loss is reached
+            if hp.get('target_val_loss') is not None and new_val_loss is not None:
+                if new_val_loss <= hp.target_val_loss:
+                    print('Reached target validation loss.')
+                    if metrics is not None:
+                        metrics.close()
+                    return net, training_loss, validation_loss
+
+        if checkpoint_fn is not None:
+            if (epoch + 1) % hp.checkpoint_every == 0 or epoch + 1 == hp.num_epochs:
+                save_checkpoint(checkpoint_fn, net, optimizer, epoch + 1, step, training_loss, validation_loss, 
+                                scheduler, key=resume_hash(hp))
+
+    if metrics is not None:
+        metrics.close()
+
+    return net, training_loss, validation_loss
+
+
+# ===================
+# FULL-BATCH TRAINING
+# ===================
+def chunked_loss(net, loss_fcn, X, Y, chunk_size, backward=False):
+    '''
+    Mean loss over all of X, Y evaluated in chunks of chunk_size samples. With 
+    backward=True the gradients of the full mean loss are accumulated chunk by 
+    chunk, so only one chunk of activations is held in memory at a time.
+    '''
+    nsamples = X.shape[0]
+    total_loss = 0.0
+
+    for istart in range(0, nsamples, chunk_size):
+        x = X[istart:istart + chunk_size]
+        y = Y[istart:istart + chunk_size]
+        if backward:
+            loss = loss_fcn(net(x), y) * x.shape[0] / nsamples
+            loss.backward()
+        else:
+            with torch.no_grad():
+                loss = loss_fcn(net(x), y) * x.shape[0] / nsamples
+        total_loss += loss.item()
+
+    return total_loss
+
+
+def train_full_batch(net, loss_fcn, optimizer, train_dataloader, val_dataloader, hp):
+    '''
+    Full-batch training with a quasi-Newton optimizer (torch.optim.LBFGS). Each of
+    the hp.num_epochs iterations is one optimizer step on the loss over the whole
+    training tensor (chunks of hp.chunk_size samples). Dropout is switched off 
+    since L-BFGS needs a deterministic objective, and the loss is smoother with 
+    lossfun 'L2' than 'L1'. Losses are recorded every iteration.
+    '''
+    X, Y = train_dataloader.dataset.tensors
+    valX, valY = val_dataloader.dataset.tensors
+    chunk_size = hp.get('chunk_size', 10000)
+
+    training_loss = []
+    validation_loss = []
+    start_epoch = 0
+
+    checkpoint_fn = None
+    if hp.get('checkpoint_every', 0) > 0:
+        checkpoint_fn = hp.save_results_dir + '/checkpoint.pth'
+
+    if checkpoint_fn is not None and os.path.exists(checkpoint_fn):
+        state = load_checkpoint(checkpoint_fn, net, optimizer, key=resume_hash(hp))
+        if state is None:
+            print('Ignoring checkpoint of a run with different settings')
+        else:
+            start_epoch, _, training_loss, validation_loss = state
+            print('Resuming from checkpoint at iteration %d' % start_epoch)
+
+    metrics = None
+    if hp.get('log_every', 0) > 0:
+        metrics = MetricsWriter(hp.save_results_dir + '/metrics.jsonl')
+
+    def closure():
+        optimizer.zero_grad()
+        return torch.tensor(chunked_loss(net, loss_fcn, X, Y, chunk_size, backward=True))
+
+    net.eval()
+    for epoch in range(start_epoch, hp.num_epochs):
+
+        train_loss = optimizer.step(closure).item()
+        val_loss = chunked_loss(net, loss_fcn, valX, valY, chunk_size)
+        training_loss.append(train_loss)
+        validation_loss.append(val_loss)
+
+        if metrics is not None:
+            metrics.update(X.shape[0], train_loss)
+            metrics.write(epoch + 1, epoch + 1, optimizer.param_groups[0]['lr'], val_loss)
+
+        print('Iteration: %d of %d, train_loss: %3e, val_loss: %3e' %
+              (epoch + 1, hp.num_epochs, train_loss, val_loss))
+
+        if hp.get('target_val_loss') is not None and val_loss <= hp.target_val_loss:
+            print('Reached target validation loss.')
+            break
+
+        if checkpoint_fn is not None:
+            if (epoch + 1) % hp.checkpoint_every == 0 or epoch + 1 == hp.num_epochs:
+                save_checkpoint(checkpoint_fn, net, optimizer, epoch + 1, epoch + 1, training_loss, validation_loss,
+                                key=resume_hash(hp))
+
+    if metrics is not None:
+        metrics.close()
+
+    return net, training_loss, validation_loss
+
+
+def make_optimizer(net, hp):
+    '''
+    Optimizer selected by hp.optimizer: 'adam' (default, minibatch) or 'lbfgs' 
+    (full-batch L-BFGS with strong Wolfe line search, see train_full_batch).
+    '''
+    if hp.get('optimizer', 'adam') == 'lbfgs':
+        return torch.optim.LBFGS(net.parameters(), lr=hp.get('lbfgs_lr', 1.0), max_iter=hp.get('lbfgs_max_iter', 20),
+                                 history_size=hp.get('lbfgs_history_size', 100), line_search_fn='strong_wolfe')
+    else:
+        return torch.optim.Adam(net.parameters(), lr=scaled_learn_rate(hp))
+
+
+# ===========
+# CHECKPOINTS
+# ===========
+def save_checkpoint(fn, net, optimizer, epoch, step, training_loss, validation_loss, scheduler=None, key=None):
+    '''
+    Saves the model, optimizer state, RNG states, epoch/step counters and loss 
+    history, with key identifying the settings of the run (see load_checkpoint). The checkpoint is written to a temporary file which then replaces fn,
+    so a job killed while saving never leaves a corrupted checkpoint behind.
+    '''
+    # numpy state as torch/python types, so the checkpoint loads with torch.load defaults
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    np_rng_state = (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian)
+
+    checkpoint = {
+        'net': net.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'scheduler': scheduler.state_dict() if scheduler is not None else None,
+        'epoch': epoch,
+        'step': step,
+        'training_loss': training_loss,
+        'validation_loss': validation_loss,
+        'torch_rng_state': torch.get_rng_state(),
+        'numpy_rng_state': np_rng_state,
+        'python_rng_state': random.getstate(),
+        'key': key,
+    }
+
+    tmp_fn = fn + '.tmp'
+    with open(tmp_fn, 'wb') as f:
+        torch.save(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fn, fn)
+
+
+def load_checkpoint(fn, net, optimizer, scheduler=None, key=None):
+    '''
+    Restores a checkpoint saved by save_checkpoint and returns (epoch, step, 
+    training_loss, validation_loss). If key is given and the checkpoint was saved
+    with another key, nothing is restored and None is returned.
+    '''
+    checkpoint = torch.load(fn)
+    if key is not None and checkpoint.get('key') != key:
+        return None
+    net.load_state_dict(checkpoint['net'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    if scheduler is not None and checkpoint.get('scheduler') is not None:
+        scheduler.load_state_dict(checkpoint['scheduler'])
+    torch.set_rng_state(checkpoint['torch_rng_state'])
+    name, keys, pos, has_gauss, cached_gaussian = checkpoint['numpy_rng_state']
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    random.setstate(checkpoint['python_rng_state'])
+
+    return checkpoint['epoch'], checkpoint['step'], checkpoint['training_loss'], checkpoint['validation_loss']
+
+
+def warm_start(net, fn):
+    '''
+    Initializes net from the state dict in fn if all layer shapes match, 
+    otherwise leaves the random init. Returns True if net was initialized.
+    '''
+    state = torch.load(fn)
+    own = net.state_dict()
+    mismatch = [k for k in own if k not in state or state[k].shape != own[k].shape]
+    if mismatch or len(state) != len(own):
+        print('Not warm-starting from %s, layer shapes differ (%s)' % (fn, ', '.join(mismatch)))
+        return False
+    net.load_state_dict(state)
+    print('Warm-starting from ' + fn)
+    return True
+
+
+# =======================
+# LEARNING RATE SCHEDULES
+# =======================
+def scaled_learn_rate(hp):
+    '''
+    Learning rate for hp.batch_size. If hp.lr_scaling is 'linear' or 'sqrt', 
+    hp.learn_rate is taken to be tuned for hp.base_batch_size and is scaled by the
+    batch size ratio (or its square root).
+    '''
+    lr = hp.learn_rate
+    scaling = hp.get('lr_scaling', None)
+    
+    if scaling is not None:
+        ratio = hp.batch_size / hp.base_batch_size
+        if scaling == 'linear':
+            lr = lr * ratio
+        elif scaling == 'sqrt':
+            lr = lr * np.sqrt(ratio)
+        else:
+            raise ValueError('Unknown lr_scaling: ' + str(scaling))
+    
+    return lr
+
+
+def make_lr_scheduler(optimizer, hp, steps_per_epoch):
+    '''
+    Per-batch learning rate scheduler for hp.lr_schedule:
+      'constant': fixed lr, after an optional linear warmup of hp.warmup_epochs
+      'cosine':   linear warmup of hp.warmup_epochs, then cosine decay to zero
+      'onecycle': one-cycle policy peaking at hp.max_lr 
+    The peak lr is hp.max_lr if given, otherwise the optimizer lr. Returns None 
+    for a constant lr without warmup. The schedule spans hp.schedule_epochs if 
+    given (e.g. the largest ASHA rung, so it is the same for every rung), 
+    otherwise hp.num_epochs.
+    '''
+    schedule = hp.get('lr_schedule', 'constant')
+    total_steps = (hp.get('schedule_epochs') or hp.num_epochs) * steps_per_epoch
+    warmup_steps = int(hp.get('warmup_epochs', 0) * steps_per_epoch)
+    max_lr = hp.get('max_lr', None)
+
+    if max_lr is not None:
+        for group in optimizer.param_groups:
+            group['lr'] = max_lr
+
+    if schedule == 'onecycle':
+        max_lr = optimizer.param_groups[0]['lr']
+        pct_start = warmup_steps / total_steps if warmup_steps > 0 else 0.3
+        return torch.optim.lr_scheduler.OneCycleLR(optimizer, max_lr=max_lr, total_steps=total_steps, 
+                                                   pct_start=pct_start)
+
+    def warmup(step):
+        return min(1.0, (step + 1) / warmup_steps) if warmup_steps > 0 else 1.0
+
+    if schedule == 'cosine':
+        def lr_lambda(step):
+            progress = max(0, step - warmup_steps) / max(1, total_steps - warmup_steps)
+            return warmup(step) * 0.5 * (1 + np.cos(np.pi * min(1.0, progress)))
+    elif schedule == 'constant':
+        if warmup_steps == 0:
+            return None
+        lr_lambda = warmup
+    else:
+        raise ValueError('Unknown lr_schedule: ' + str(schedule))
+
+    return torch.optim.lr_scheduler.LambdaLR(optimizer, lr_lambda)
+
+
+def lr_range_test(net, loss_fcn, optimizer, train_dataloader, min_lr=1e-7, max_lr=1e-1, num_steps=200):
+    '''
+    Learning rate range test: the lr is increased exponentially from min_lr to 
+    max_lr over num_steps batches while recording the (smoothed) training loss. 
+    The net and optimizer are restored afterwards. Returns the lrs, the losses 
+    and a suggested lr, one tenth of the lr with the lowest loss.
+    '''
+    net_state = copy.deepcopy(net.state_dict())
+    optimizer_state = copy.deepcopy(optimizer.state_dict())
+
+    gamma = (max_lr / min_lr) ** (1 / (num_steps - 1))
+    lrs = []
+    losses = []
+    smoothed_loss = None
+    step = 0
+
+    while step < num_steps:
+        for x_batch, y_batch in train_dataloader:
+
+            lr = min_lr * gamma**step
+            for group in optimizer.param_groups:
+                group['lr'] = lr
+
+            loss = loss_fcn(net(x_batch), y_batch)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+            if smoothed_loss is None:
+                smoothed_loss = loss.item()
+            else:
+                smoothed_loss = 0.95 * smoothed_loss + 0.05 * loss.item()
+            lrs.append(lr)
+            losses.append(smoothed_loss)
+            step += 1
+
+            # stop once the loss diverges
+            if step == num_steps or smoothed_loss > 4 * min(losses):
+                step = num_steps
+                break
+
+    net.load_state_dict(net_state)
+    optimizer.load_state_dict(optimizer_state)
+
+    suggested_lr = lrs[int(np.argmin(losses))] / 10
+    return np.asarray(lrs), np.asarray(losses), suggested_lr
+
+
+# ===========
+# FINE-TUNING
+# ===========
+def select_samples(data_pca, idx):
+    # data dict restricted to the samples idx
+    data = copy.copy(data_pca)
+    for key in data_pca.keys():
+        if key=='time' or key=='shot':
+            data[key] = data_pca[key][idx,:]
+        else:
+            data[key] = copy.copy(data_pca[key])
+            data[key].coeff_ = data_pca[key].coeff_[idx,:]
+    return data
+
+
+def split_by_shot(data_pca, first_new_shot):
+    '''
+    Splits a data dict into the old shots (before first_new_shot), which an 
+    existing model was trained on, and the newly added shots.
+    '''
+    shots = data_pca['shot'].reshape(-1)
+    iold = np.where(shots < first_new_shot)[0]
+    inew = np.where(shots >= first_new_shot)[0]
+    return select_samples(data_pca, iold), select_samples(data_pca, inew)
+
+
+def strip_preprocess(preprocess):
+    # fitted preprocessing, without the training data coefficients held by Y_pca
+    preprocess = copy.copy(preprocess)
+    preprocess.Y_pca = copy.copy(preprocess.Y_pca)
+    preprocess.Y_pca.coeff_ = None
+    return preprocess
+
+
+def save_preprocess(preprocess, fn):
+    with open(fn, 'wb') as f:
+        pickle.dump(strip_preprocess(preprocess), f)
+
+
+def load_preprocess(fn):
+    with open(fn, 'rb') as f:
+        return pickle.load(f)
+
+
+def eval_loss(net, preprocess, data, loss_fcn, ref_preprocess=None):
+    '''
+    Loss of net over all samples of data. Predictions and targets are normalized
+    with ref_preprocess.Y_scaler, so that models with different fitted 
+    preprocessing can be compared on the same scale.
+    '''
+    X, Y, _, _ = preprocess.transform(data, randomize=False)
+    Ypred = predict(net, X).numpy()
+    
+    if ref_preprocess is not None:
+        Y = ref_preprocess.Y_scaler.transform(preprocess.Y_scaler.inverse_transform(Y.numpy()))
+        Ypred = ref_preprocess.Y_scaler.transform(preprocess.Y_scaler.inverse_transform(Ypred))
+        Y = torch.Tensor(Y)
+        Ypred = torch.Tensor(Ypred)
+    else:
+        Ypred = torch.Tensor(Ypred)
+    
+    return loss_fcn(Ypred, Y).item()
+
+
+def forgetting_report(models, old_testdata, new_testdata, loss_fcn, ref_preprocess, held_out_shots=None):
+    '''
+    Old-shot (forgetting) and new-shot test losses of models (name -> (net, 
+    preprocess)): the pretrained and the fine-tuned model, and optionally a 
+    'retrained' one. The retrained model was trained on its own split of all 
+    shots, so it is only compared on held_out_shots, the test shots of every 
+    model's job (test_shots.txt): all models are scored on those in 
+    old_test_held_out/new_test_held_out, and if there are no old ones the 
+    retrained model is left out of the old-shot comparison.
+    '''
+    report = {}
+    splits = [('old_test', old_testdata), ('new_test', new_testdata)]
+    for split, data in splits:
+        report[split] = {name: eval_loss(model, model_preprocess, data, loss_fcn, ref_preprocess)
+                         for name, (model, model_preprocess) in models.items() if name != 'retrained'}
+    report['forgetting'] = report['old_test']['finetuned'] - report['old_test']['pretrained']
+
+    if 'retrained' in models:
+        for split, data in splits:
+            idx = np.where(np.isin(data['shot'].reshape(-1), held_out_shots))[0]
+            if len(idx) == 0:
+                report[split + '_held_out'] = None
+                continue
+            data = select_samples(data, idx)
+            report[split + '_held_out'] = {name: eval_loss(model, model_preprocess, data, loss_fcn, ref_preprocess)
+                                           for name, (model, model_preprocess) in models.items()}
+            report[split + '_held_out']['nshots'] = len(np.unique(data['shot']))
+        if report['old_test_held_out'] is not None:
+            report['old_test_finetuned_minus_retrained'] = (report['old_test_held_out']['finetuned'] - 
+                                                            report['old_test_held_out']['retrained'])
+        else:
+            print('The retrained model held out none of the old test shots, it is not compared on them')
+
+    return report
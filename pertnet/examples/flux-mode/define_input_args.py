@@ -33,6 +33,30 @@ hp.num_h =  4                #  number of hidden layers
 hp.h_dim = 500               #  dimension of each hidden layer
 hp.hidden_dims = [hp.h_dim for i in range(hp.num_h)]  # dimensions of each hidden layer in list format. This is what actually gets used by NN
 
+# learning rate schedule options (defaults reproduce a fixed learning rate)
+hp.lr_schedule = 'constant'  #  lr schedule (implemented: 'constant', 'cosine', 'onecycle')
+hp.warmup_epochs = 0         #  epochs of linear lr warmup at the start of training
+hp.max_lr = None             #  peak lr of the schedule, None to use learn_rate
+hp.lr_find = False           #  run an lr range test before training and use its suggested lr as max_lr
+hp.lr_scaling = None         #  None, 'linear' or 'sqrt': scale learn_rate from base_batch_size to batch_size
+hp.base_batch_size = 50      #  batch size that learn_rate was tuned for (used with lr_scaling)
+
+# optimizer: 'adam' (minibatch) or 'lbfgs' (full-batch L-BFGS over the whole training set, 
+# num_epochs is then the number of L-BFGS steps and the lr schedule options are not used)
+hp.optimizer = 'adam'
+hp.chunk_size = 10000        #  samples per chunk when evaluating the full-batch loss (lbfgs)
+
+# fine-tuning: continue training the model saved in finetune_from (net.pth, preprocess.dat)
+# on the shots >= finetune_first_new_shot, replaying replay_ratio old samples per new sample.
+# retrain_dir optionally points to a model fully retrained on all shots, for the forgetting report
+hp.finetune = False
+hp.finetune_from = None
+hp.finetune_first_new_shot = None
+hp.finetune_epochs = 20
+hp.finetune_learn_rate = 1e-5       #  learning rate used for fine-tuning
+hp.replay_ratio = 1.0
+hp.retrain_dir = None
+
 
 ''' GENERAL JOB SETTINGS '''
 settings = EasyDict()
@@ -41,6 +65,9 @@ settings.print_every = 1000
 settings.savefigs = True
 settings.savemodel = False
 settings.use_pretrained_model = False
+settings.checkpoint_every = 10     # save a resumable checkpoint every N epochs (0 to disable)
+settings.log_every = 100          # append training metrics to metrics.jsonl every N steps (0 to disable)
+settings.benchmark_latency = True  # write latency.json of the trained net (see nntools/latency.py)
 settings.dataset_dir = '/pertnet/data/datasets/'
 settings.data_pca_fn = '/data_pca_013.dat'
 settings.load_results_dir = jobdir + '/results_cached/'
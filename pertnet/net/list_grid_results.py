@@ -1,20 +1,24 @@
 from easydict import EasyDict
 import numpy as np
 import os
+import sys
 import matplotlib.pyplot as plt
 
 ROOT = os.environ['NN_ROOT']
 job_topdir = ROOT + 'pertnet/jobs/coil2/scan1/'
+sys.path.append(ROOT)
+from nntools.jobs import list_jobdirs
+from nntools.latency import latency_report
 
 
-N = len(os.listdir(job_topdir))
+jobdirs = list_jobdirs(job_topdir)
+N = len(jobdirs)
 loss = []
 
 for i in range(N):
     try:
-        fn = job_topdir + 'job' + str(i) + '/loss.txt'
-        with open(fn, 'r') as reader:
-            loss.append(float(reader.read()))
+        fn = jobdirs[i] + 'loss.txt'
+        loss.append(np.loadtxt(fn)[1,-1])
     except:
         loss.append(np.nan)
 
@@ -24,10 +28,13 @@ idx = loss.argsort()[:10]
 best_loss = loss[idx]
 
 print('\nBest jobs:')
-print(idx)
+print([jobdirs[i] for i in idx])
 print('\nLoss of best jobs:')
 print(best_loss)
 
+# loss vs inference latency of the jobs that were benchmarked
+print('\n' + latency_report(job_topdir))
+
 plt.plot(loss)
 plt.show()
 
@@ -35,5 +42,5 @@ plt.show()
 fns = ['coeff0.png', 'loss_curve.png', 'response0.png', 'response1.png', 'response9.png']
 
 for fn in fns:
-    cmd = 'xdg-open ' + job_topdir + 'job' + str(idx[0]) + '/' + fn
+    cmd = 'xdg-open ' + jobdirs[idx[0]] + fn
     os.system(cmd)
@@ -7,6 +7,13 @@ import torch.nn as nn
 import torch
 import scipy.io as sio
 import copy
+from nntools.models import MLP, MultiHeadMLP, MultiHeadLoss
+from nntools.training import (predict, train, chunked_loss, train_full_batch, make_optimizer, save_checkpoint,
+                              load_checkpoint, warm_start, scaled_learn_rate, make_lr_scheduler, lr_range_test,
+                              select_samples, split_by_shot, strip_preprocess, save_preprocess, load_preprocess,
+                              eval_loss, forgetting_report)
+from nntools.preprocess import DataPreProcess
+from nntools.bundle import save_bundle, load_bundle
 
 # ====================
 # Train-Val-Test split
@@ -51,7 +58,6 @@ def train_val_test_split(data_pca, ftrain=0.8, fval=0.1, ftest=0.1, mix=False):
     return traindata, valdata, testdata
 
 
-
 # =====================================
 # Visualize Response Predictions
 # =====================================
@@ -63,8 +69,9 @@ def visualize_response_prediction(data, preprocess, net, loss_fcn, hp, shot, tok
     zlim = tok_data['limdata'][0][0][0,:]
 
     def inverse_transform(y):
-        y = y.detach().numpy()
+        y = y.detach().numpy().reshape(1, -1)
         y = preprocess.Y_scaler.inverse_transform(y)
+        y = y[:, :preprocess.ydims[0]]   # multi-head nets: first target only
         y = preprocess.Y_pca.inverse_transform(y)
         y = y.reshape(65, 65).T
         return y
@@ -75,7 +82,7 @@ def visualize_response_prediction(data, preprocess, net, loss_fcn, hp, shot, tok
     times = data['time'][iuse]
     X = X[iuse, :]
     Y = Y[iuse, :]
-    Ypreds = net(X)
+    Ypreds = predict(net, X)
 
     fig = plt.figure(figsize=(20, 10))
     ax = list(range(nsamples))
@@ -130,7 +137,7 @@ def plot_response_coeffs(shotlist, data, preprocess, net, hp, ncoeffs='all'):
             X, Y,_,_ = preprocess.transform(data, randomize=False)
             X = X[i, :]
             Y = Y[i, :]
-            Ypred = net(X).detach().numpy()
+            Ypred = predict(net, X).numpy()
 
             ax[ishot] = fig.add_subplot(4, int(np.ceil(nshots / 4)), ishot + 1)
             ax[ishot].plot(t, Y[:, icoeff], linestyle='dashed')
@@ -181,7 +188,7 @@ def make_shot_response_movie(data, preprocess, net, loss_fcn, hp, ishot=0):
     times = data['time'][iuse]
     X = X[iuse, :]
     Y = Y[iuse, :]
-    Ypreds = net(X)
+    Ypreds = predict(net, X)
 
     fig, ax = plt.subplots(1, 2, figsize=(6, 6))
     div = make_axes_locatable(ax[1])
@@ -225,56 +232,6 @@ def make_shot_response_movie(data, preprocess, net, loss_fcn, hp, ishot=0):
     return anim
 
 
-# ========
-# TRAINING
-# ========
-def train(net, loss_fcn, optimizer, train_dataloader, val_dataloader, hp):
-
-    training_loss = []
-    validation_loss = []
-    val_dataiter = iter(val_dataloader)
-
-    for epoch in range(hp.num_epochs):
-        for i, data in enumerate(train_dataloader):
-
-            x_batch, y_batch = data
-            y_pred = net(x_batch)
-
-            # compute loss
-            loss = loss_fcn(y_pred, y_batch)
-
-            # update parameters
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-
-            batch_loss = loss.item()
-
-            if i % hp.print_every == 0:
-
-                # save training loss
-                training_loss.append(batch_loss)
-
-                # calculate and save validation loss
-                try:
-                    x, y = val_dataiter.next()
-                except StopIteration:
-                    val_dataiter = iter(val_dataloader)
-                    x, y = val_dataiter.next()
-                
-                net.eval()
-                with torch.no_grad():
-                    ypred = net(x)
-                    val_loss = loss_fcn(ypred, y).item()
-                    validation_loss.append(val_loss)
-                net.train()
-
-                print('Epoch: %d of %d, train_loss: %3e, val_loss: %3e' %
-                      (epoch + 1, hp.num_epochs, batch_loss, val_loss))
-
-    return net, training_loss, validation_loss
-
-
 # ==============
 # LOSS FUNCTIONS
 # ==============
@@ -304,49 +261,6 @@ class PLoss():
         loss = torch.mean(e**self.p)
         return loss
 
-# ===========================
-# MULTILAYER PERCEPTRON CLASS
-# ===========================
-class MLP(nn.Module):
-    '''
-    Multilayer Perceptron.
-    '''
-
-    def __init__(self, in_dim, out_dim, hidden_dims, nonlinearity='RELU', p_dropout_in=0, p_dropout_hidden=0.2):
-        super().__init__()
-        
-        if nonlinearity.upper() == 'RELU':
-            nonlinearity = nn.ReLU()
-        elif nonlinearity.upper() == 'TANH':
-            nonlinearity = nn.Tanh()
-        elif nonlinearity.upper() == 'LEAKYRELU':
-            nonlinearity = nn.LeakyReLU()
-        elif nonlinearity.upper() == 'ELU':
-            nonlinearity = nn.ELU()
-        
-        dims = [in_dim]
-        dims.extend(hidden_dims)
-        dims.extend([out_dim])
-
-        nlayers = len(dims) - 1
-        layers = []
-
-        for i in range(nlayers):
-            if i == 0:
-                p = p_dropout_in
-            else:
-                p = p_dropout_hidden
-            layers.append(nn.Dropout(p=p))
-            layers.append(nn.Linear(dims[i], dims[i + 1]))
-            layers.append(nonlinearity)
-
-        layers.pop()
-        self.net = nn.Sequential(*layers)
-
-    def forward(self, x):
-        return self.net(x)
-
-
 '''
 # ==================
 # DATA PREPROCESSING
@@ -439,119 +353,6 @@ class DataPreProcess():
 '''
 
 
-# ==================
-# DATA PREPROCESSING
-# ==================
-class DataPreProcess():
-    def __init__(self, datadict, xnames, ynames, t_thresh=None):
-        super().__init__()
-
-        X = self.makeX(datadict, xnames)
-        X_scaler = StandardScaler()
-        X_scaler.fit(X)
-
-        Y = self.makeX(datadict, ynames)
-        Y_scaler = StandardScaler()
-        Y_scaler.fit(Y)
-
-        # write to class object
-        self.X_scaler = X_scaler
-        self.Y_scaler = Y_scaler
-        self.Y_pca = datadict[ynames[0]]
-        self.t_thresh = t_thresh        
-        self.xnames = xnames
-        self.ynames = ynames
-
-    def makeX(self, datadict, xnames):
-
-        for i, key in enumerate(xnames):
-
-            try:
-                x = datadict[key].coeff_
-            except:
-                x = datadict[key]
-
-            if i == 0:
-                Xdata = np.copy(x)
-            else:
-                Xdata = np.hstack([Xdata, x])
-
-        return Xdata
-
-    def transform(self, datadict, randomize=True, holdback_fraction=0.0, by_shot=False):
-
-        X = self.makeX(datadict, self.xnames)
-        Y = self.makeX(datadict, self.ynames)
-
-        X = self.X_scaler.transform(X)
-        Y = self.Y_scaler.transform(Y)
-
-        time = datadict['time']
-        shot = datadict['shot']
-
-        # use only certain times
-        if self.t_thresh is not None:
-            t = datadict['time']
-            iuse = np.where(t > self.t_thresh)[0]
-            X = X[iuse, :]
-            Y = Y[iuse, :]
-            time = time[iuse]
-            shot = shot[iuse]
-        
-        # remove samples with nans
-        i = ~np.isnan(X).any(axis=1) & ~np.isnan(Y).any(axis=1)
-        X = X[i,:]
-        Y = Y[i,:]
-        time = time[i]
-        shot = shot[i]
-
-        if holdback_fraction > 0 and by_shot:
-            uniqshots = np.unique(shot)
-            sz = int( (1.0-holdback_fraction)*len(uniqshots))
-            select_shots = np.random.choice(uniqshots, sz, replace=False)
-            
-            for ishot, select_shot in enumerate(select_shots):
-                
-                k = np.where(shot == select_shot)[0]
-                if ishot==0:
-                    idx = k
-                else:
-                    idx = np.hstack((idx,k))
-            
-            X = X[idx,:]
-            Y = Y[idx,:]
-            time = time[idx]
-            shot = shot[idx]
-
-        # convert to torch data types
-        X = torch.Tensor(X)
-        Y = torch.Tensor(Y)
-
-
-        # randomize order
-        if randomize:
-            idx = torch.randperm(X.shape[0])
-            X = X[idx, :]
-            Y = Y[idx, :]
-            time = time[idx]
-            shot = shot[idx]
-
-
-        # hold back some samples
-        if holdback_fraction > 0 and not by_shot:
-            nsamples = X.shape[0]
-            nkeep = int((1.0 - holdback_fraction)*nsamples)
-            X = X[:nkeep,:]
-            Y = Y[:nkeep,:]
-            time = time[:nkeep]
-            shot = shot[:nkeep]
-
-        return X, Y, shot, time
-
-
-
-
-
 # ==================
 # Growth rate calcs
 # ==================
@@ -589,7 +390,7 @@ class GrowthRate():
 def plot_response_timetraces(shotlist, net, valdata, preprocess,hp):
     
     X,Ytrue,shots,times = preprocess.transform(valdata, randomize=False, holdback_fraction=0)
-    Ypred = net(X).detach().numpy()            
+    Ypred = predict(net, X).numpy()            
     
     def readY(Y, preprocess, hp):
         Y = preprocess.Y_scaler.inverse_transform(Y)  # denormalize
@@ -637,7 +438,6 @@ def plot_response_timetraces(shotlist, net, valdata, preprocess,hp):
             plt.savefig(fn, dpi=100)
 
 
-
 # ========================
 # Save output predictions
 # ========================
@@ -645,8 +445,7 @@ def gen_output_preds(data, preprocess, net, hp):
     
 
     X, Y, shots, times = preprocess.transform(data, randomize=False, holdback_fraction=0)
-    Ypred = net(X)    
-    Ypred = Ypred.detach().numpy()
+    Ypred = predict(net, X).numpy()
     Y = Y.detach().numpy()
     X = X.detach().numpy()
 
@@ -659,6 +458,20 @@ def gen_output_preds(data, preprocess, net, hp):
     out['shots'] = shots
     out['times'] = times
 
+    # per-head outputs and losses (normalized units) of multi-head nets
+    if isinstance(net, MultiHeadMLP):
+        out['head_l1_loss'] = {}
+        out['head_l2_loss'] = {}
+        istart = 0
+        for yname, head_dim in zip(hp.ynames, net.head_dims):
+            istop = istart + head_dim
+            err = Ypred[:, istart:istop] - Y[:, istart:istop]
+            out[yname + '_coeff'] = out['Y_coeff'][:, istart:istop]
+            out[yname + '_pred_coeff'] = out['Ypred_coeff'][:, istart:istop]
+            out['head_l1_loss'][yname] = float(np.mean(np.abs(err)))
+            out['head_l2_loss'][yname] = float(np.mean(err**2))
+            istart = istop
+
     for tag in hp.xnames + hp.ynames:
 
         pca = data[tag]
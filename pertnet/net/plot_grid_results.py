@@ -1,6 +1,7 @@
 from easydict import EasyDict
 import numpy as np
 import os
+import sys
 import matplotlib.pyplot as plt
 import json
 from scipy.interpolate import griddata
@@ -8,8 +9,10 @@ from sklearn.model_selection import ParameterGrid
 
 ROOT = os.environ['NN_ROOT']
 job_topdir = ROOT + 'pertnet/jobs/standard/jobs013_coil28_a/'
+sys.path.append(ROOT)
+from nntools.jobs import list_jobdirs
 
-dirlist = os.listdir(job_topdir)
+jobdirs = list_jobdirs(job_topdir)
 loss = []
 
 # READ FROM FILES
@@ -18,13 +21,13 @@ var2plot = 'num_h'
 
 hpgrid = {}
 loss = []
-for i in range(len(dirlist)-1):
+for i in range(len(jobdirs)):
     try: 
-        args_fn = job_topdir + 'job' + str(i) + '/args.json'
+        args_fn = jobdirs[i] + 'args.json'
         with open(args_fn) as infile:
             hp = EasyDict(json.load(infile))
 
-        loss_fn = job_topdir + 'job' + str(i) + '/loss.txt'
+        loss_fn = jobdirs[i] + 'loss.txt'
         
         l = np.loadtxt(loss_fn)[1,-1]
         loss.append(l)
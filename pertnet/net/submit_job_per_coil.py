@@ -1,4 +1,5 @@
 import os
+import sys
 import shutil
 from easydict import EasyDict
 import json
@@ -11,16 +12,46 @@ ROOT = os.environ['NN_ROOT']
 sbatch_fn = ROOT + 'pertnet/net/job.slurm'
 job_fn = ROOT + 'pertnet/net/pertnet_batch.py'
 job_topdir = ROOT + 'pertnet/jobs/standard/jobs013_allcoils_f/'
+sys.path.append(ROOT)
+from nntools.executors import make_executor
+from nntools.packing import submit_packed
+from nntools.jobs import prepare_jobdir
+
+# where to run the jobs: 'sbatch' submits job.slurm from each job directory, 'local' runs 
+# them on this machine, local_max_workers at a time (None for all cores / local_threads_per_job)
+executor_backend = 'sbatch'
+local_max_workers = None
+local_threads_per_job = 1
+
+# pack_size > 1 runs pack_size jobs per allocation instead of one sbatch per job: one array 
+# job of job_pack.slurm with a task per pack, each running its jobs in parallel within the 
+# cores of the allocation (see nntools/packing.py). Locally the packs run one at a time
+pack_size = 1
+pack_sbatch_fn = ROOT + 'pertnet/net/job_pack.slurm'
 
 
 ynames = ['dpsidix_smooth_coil' + str(icoil) for icoil in range(1,55)]
 # ynames = ['dpsidix_smooth_coil1']
 ynames += ['dpsidbetap', 'dpsidli']
 
+# multihead=True trains a single net with a shared trunk and one output head per 
+# yname, instead of one job per yname (default)
+multihead = False
 
-for ii, yname in enumerate(ynames):
-    
-    jobdir = job_topdir + 'job' + str(ii) + '/'
+if multihead:
+    job_ynames = [ynames]
+else:
+    job_ynames = [[yname] for yname in ynames]
+
+
+# jobs still queued or running from an earlier submission are skipped unless force_resubmit
+force_resubmit = False
+
+executor = make_executor(executor_backend, sbatch_fn, job_fn, local_max_workers, local_threads_per_job)
+pack_jobdirs = []
+nskipped = 0
+
+for ii, ynames_ii in enumerate(job_ynames):
 
     # input args for the job
     hyperparams = EasyDict()
@@ -40,6 +71,9 @@ for ii, yname in enumerate(ynames):
     settings.savemovie = False
     settings.plotmovie = False
     settings.savemodel = True  
+    settings.checkpoint_every = 10
+    settings.log_every = 100
+    settings.benchmark_latency = True
     settings.traindata_fn = 'pertnet/data/datasets/train_013.dat'
     settings.valdata_fn = 'pertnet/data/datasets/val_013.dat'
     settings.testdata_fn = 'pertnet/data/datasets/test_013.dat'
@@ -54,27 +88,37 @@ for ii, yname in enumerate(ynames):
     settings.xnames =  ['pprime', 'ffprim', 'pres','rmaxis','zmaxis', 'psirz', 'coil_currents', 'vessel_currents', 'pcurrt', 'rcur', 'zcur', 'ip', 'qpsi', 'psimag', 'psibry', 'rbbbs', 'zbbbs', 'psizr_pla']
 
     # 3. target variables
-    settings.ynames = [yname]
+    settings.ynames = ynames_ii
+    settings.multihead = multihead
 
     # =======================
-    settings.savedir = jobdir
     hyperparams.hidden_dims = [hyperparams.h_dim for i in range(hyperparams.num_h)]
     args = {**hyperparams, **settings}
  
-    # create job directory and copy files
-    args_fn = jobdir + 'args.json'
-
-    if os.path.isdir(jobdir):
-        shutil.rmtree(jobdir)
-    os.makedirs(jobdir)
-
-    shutil.copy(job_fn, jobdir)
-
-    with open(args_fn, 'w') as outfile:
-        json.dump(args, outfile, indent=4)
+    # create job directory (job_<hash of args>/) and copy files, completed or running jobs are not rerun
+    jobdir, args, skip = prepare_jobdir(job_topdir, args, job_fn, force=force_resubmit)
+    if skip:
+        print('Skipping %s job %s' % (skip, jobdir))
+        nskipped += 1
+        continue
 
 
     # submit job
-    os.chdir(jobdir)
-    os.system('sbatch ' + sbatch_fn)
+    if pack_size > 1:
+        pack_jobdirs.append(jobdir)
+    else:
+        executor.submit(jobdir)
+
+print('%d of %d jobs already completed or running' % (nskipped, len(job_ynames)))
+
+# e.g. pack_size = 14 runs the 56 per-coil jobs as one array job of 4 tasks
+if pack_jobdirs:
+    pack_executor, _ = submit_packed(pack_jobdirs, job_fn, job_topdir + 'packs/', pack_size, executor_backend,
+                                     pack_sbatch_fn, threads_per_job=local_threads_per_job)
+
+# local jobs run as child processes of this script
+if executor_backend == 'local':
+    executor.wait()
+    if pack_jobdirs:
+        pack_executor.wait()
 
@@ -1,4 +1,5 @@
 import os
+import sys
 import shutil
 from easydict import EasyDict
 import json
@@ -11,6 +12,37 @@ ROOT = os.environ['NN_ROOT']
 sbatch_fn = ROOT + 'pertnet/net/job.slurm'
 job_fn = ROOT + 'pertnet/net/pertnet_batch.py'
 job_topdir = ROOT + 'pertnet/jobs/control/jobs013_nets_a/'
+sys.path.append(ROOT)
+from nntools.executors import make_executor
+from nntools.packing import submit_packed
+from nntools.jobs import prepare_jobdir
+from nntools.bayesopt import run_bayesopt
+
+# where to run the jobs: 'sbatch' submits job.slurm from each job directory, 'local' runs 
+# them on this machine, local_max_workers at a time (None for all cores / local_threads_per_job)
+executor_backend = 'sbatch'
+local_max_workers = None
+local_threads_per_job = 1
+
+# pack_size > 1 runs pack_size jobs per allocation instead of one sbatch per job: one array 
+# job of job_pack.slurm with a task per pack, each running its jobs in parallel within the 
+# cores of the allocation (see nntools/packing.py). Locally the packs run one at a time
+pack_size = 1
+pack_sbatch_fn = ROOT + 'pertnet/net/job_pack.slurm'
+
+# model-based search instead of training every grid point: a Gaussian process of the 
+# val loss picks which grid points to train, bayesopt_num_jobs in total, with 
+# bayesopt_max_concurrent running at once (see nntools/bayesopt.py). The grid lists 
+# below are the candidates, so they can be much larger than for a full grid
+bayesopt = False
+bayesopt_num_jobs = 50
+bayesopt_num_init = 10
+bayesopt_max_concurrent = 10
+
+# initialize new jobs from the net.pth of the nearest completed job with the same layer 
+# shapes in warm_start_dirs (e.g. this job_topdir when refining a grid), see nntools/jobs.py
+warm_start = False
+warm_start_dirs = [job_topdir]
 
 
 # hyperparameter grid settings
@@ -47,6 +79,9 @@ settings.savefigs = True
 settings.savemovie = False
 settings.plotmovie = False
 settings.savemodel = True
+settings.checkpoint_every = 10
+settings.log_every = 100
+settings.benchmark_latency = True
 settings.traindata_fn = 'pertnet/data/datasets/train_013.dat'
 settings.valdata_fn = 'pertnet/data/datasets/val_013.dat'
 settings.testdata_fn = 'pertnet/data/datasets/test_013.dat'
@@ -95,9 +130,11 @@ settings.ynames = ['gamma', 'shape_drcurdix', 'shape_dzcurdix', 'shape_drxlodix'
 #      'drxdip', 'dzxdis', 'dzxdbetap', 'dzxdli', 'dzxdip']
 
 
-if os.path.isdir(job_topdir):
-    shutil.rmtree(job_topdir)
-os.mkdir(job_topdir)
+# jobs live in job_<hash of args>/ so a rerun keeps finished work: completed jobs 
+# (valid loss.txt and net.pth) are skipped, missing or failed ones are (re)launched.
+# Jobs still queued or running from an earlier submission are skipped unless force_resubmit
+force_resubmit = False
+os.makedirs(job_topdir, exist_ok=True)
 
 grid_fn = job_topdir + 'hpgrid.txt'
 # open(grid_fn, 'w').close()
@@ -105,7 +142,23 @@ with open(grid_fn, 'w') as outfile:
     json.dump(hyperparams, outfile, indent=4)
     json.dump(settings, outfile, indent=4)
 
+def job_args(hp):
+    # combine input args
+    hp = EasyDict(hp)
+    hp.hidden_dims = [hp.h_dim for i in range(hp.num_h)]
+    return {**hp, **settings}
+
 # Launch jobs
+executor = make_executor(executor_backend, sbatch_fn, job_fn, local_max_workers, local_threads_per_job)
+pack_jobdirs = []
+nskipped = 0
+
+if bayesopt:
+    run_bayesopt(hpgrid, job_args, job_topdir, job_fn, executor, bayesopt_num_jobs, num_init=bayesopt_num_init,
+                 max_concurrent=bayesopt_max_concurrent, report_fn=job_topdir + 'bayesopt.txt',
+                 warm_start_dirs=warm_start_dirs if warm_start else None)
+    sys.exit()
+
 for ijob, hp in enumerate(hpgrid):
 
     hp = EasyDict(hp)
@@ -117,28 +170,38 @@ for ijob, hp in enumerate(hpgrid):
     with open(grid_fn, 'a') as outfile:
         json.dump(hp, outfile, indent=4)
     
-    # create job directory
-    jobdir = job_topdir + 'job' + str(ijob) + '/'
-    
-    if os.path.isdir(jobdir):
-        shutil.rmtree(jobdir)
-    os.makedirs(jobdir)
-                
-    # combine input args
-    settings.savedir = jobdir
-    hp.hidden_dims = [hp.h_dim for i in range(hp.num_h)]
-    args = {**hp, **settings}
+    args = job_args(hp)
 
-    # copy files
-    args_fn = jobdir + 'args.json'
-    shutil.copy(job_fn, jobdir)
+    # create job directory, copy files and write the job args
+    jobdir, args, skip = prepare_jobdir(job_topdir, args, job_fn, warm_start_dirs if warm_start else None,
+                                        force=force_resubmit)
+
+    with open(grid_fn, 'a') as writer:
+        writer.write('\n' + jobdir + '\n')
 
-    with open(args_fn, 'w') as outfile:
-        json.dump(args, outfile, indent=4)
+    if skip:
+        print('Skipping %s job %s' % (skip, jobdir))
+        nskipped += 1
+        continue
 
     # launch job
-    os.chdir(jobdir)
-    os.system('sbatch ' + sbatch_fn)
+    if pack_size > 1:
+        pack_jobdirs.append(jobdir)
+    else:
+        executor.submit(jobdir)
+
+print('%d of %d jobs already completed or running' % (nskipped, len(hpgrid)))
+
+# Launch packed jobs
+if pack_jobdirs:
+    pack_executor, _ = submit_packed(pack_jobdirs, job_fn, job_topdir + 'packs/', pack_size, executor_backend,
+                                     pack_sbatch_fn, threads_per_job=local_threads_per_job)
+
+# local jobs run as child processes of this script
+if executor_backend == 'local':
+    executor.wait()
+    if pack_jobdirs:
+        pack_executor.wait()
 
     
     
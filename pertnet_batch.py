@@ -11,12 +11,17 @@ import torch.nn as nn
 import matplotlib.pyplot as plt
 import shutil
 import json
+import copy
 from torch.utils.data import TensorDataset, DataLoader
+from nntools.latency import write_latency
 import scipy.io as sio
 from pertnet.data.data_utils import load_data
 from pertnet.net.pertnet_utils import (plot_response_coeffs, gen_output_preds, 
                             plot_loss_curve, train, MLP, DataPreProcess, visualize_response_prediction, 
-                            plot_response_timetraces, train_val_test_split)
+                            plot_response_timetraces, train_val_test_split, MultiHeadMLP, MultiHeadLoss,
+                            make_optimizer, make_lr_scheduler, lr_range_test, 
+                            split_by_shot, save_preprocess, load_preprocess, forgetting_report, warm_start,
+                            save_bundle)
 
 print('Loading parameters...')
 
@@ -28,14 +33,40 @@ with open(fn) as infile:
 # load data
 print('Loading data...')
 data_pca = load_data(ROOT + hp.dataset_dir + hp.data_pca_fn)
-traindata, valdata, testdata = train_val_test_split(data_pca, ftrain=0.8, fval=0.1, mix=True)
+if hp.get('finetune', False):
+
+    # fine-tune an existing model on the new shots plus a replay sample of the 
+    # old shots, keeping the preprocessing fitted for the existing model
+    print('Preparing fine-tuning data...')
+    preprocess = load_preprocess(hp.finetune_from + '/preprocess.dat')
+    olddata, newdata = split_by_shot(data_pca, hp.finetune_first_new_shot)
+    old_traindata, old_valdata, old_testdata = train_val_test_split(olddata, ftrain=0.8, fval=0.1, mix=True)
+    traindata, valdata, testdata = train_val_test_split(newdata, ftrain=0.8, fval=0.1, mix=True)
+
+    trainX, trainY,_,_ = preprocess.transform(traindata, randomize=True)
+    replayX, replayY,_,_ = preprocess.transform(old_traindata, randomize=True)
+    nreplay = min(int(hp.replay_ratio * trainX.shape[0]), replayX.shape[0])
+    trainX = torch.cat([trainX, replayX[:nreplay]])
+    trainY = torch.cat([trainY, replayY[:nreplay]])
+
+    valX, valY,_,_ = preprocess.transform(valdata, randomize=True)
+    old_valX, old_valY,_,_ = preprocess.transform(old_valdata, randomize=True)
+    valX = torch.cat([valX, old_valX])
+    valY = torch.cat([valY, old_valY])
+
+    hp.num_epochs = hp.finetune_epochs
+    hp.learn_rate = hp.finetune_learn_rate
+    test_shots = np.concatenate([old_testdata['shot'].reshape(-1), testdata['shot'].reshape(-1)])
 
+else:
+    traindata, valdata, testdata = train_val_test_split(data_pca, ftrain=0.8, fval=0.1, mix=True)
+    test_shots = testdata['shot'].reshape(-1)
 
-# process data (normalize, randomize, etc)
-print('Normalizing data...')
-preprocess = DataPreProcess(traindata, hp.xnames, hp.ynames, t_thresh=None)
-trainX, trainY,_,_ = preprocess.transform(traindata, randomize=True, holdback_fraction=0, by_shot=True)
-valX, valY,_,_ = preprocess.transform(valdata, randomize=True, holdback_fraction=0)
+    # process data (normalize, randomize, etc)
+    print('Normalizing data...')
+    preprocess = DataPreProcess(traindata, hp.xnames, hp.ynames, t_thresh=None)
+    trainX, trainY,_,_ = preprocess.transform(traindata, randomize=True, holdback_fraction=0, by_shot=True)
+    valX, valY,_,_ = preprocess.transform(valdata, randomize=True, holdback_fraction=0)
 
 
 # dataloaders
@@ -47,15 +78,42 @@ val_dataloader = DataLoader(val_dataset, batch_size=len(val_dataset), shuffle=Tr
 # initialize NN
 in_dim = trainX.shape[1]
 out_dim = trainY.shape[1]
-net = MLP(in_dim, out_dim, hp.hidden_dims, nonlinearity=hp.nonlinearity,
-          p_dropout_in=hp.p_dropout_in, p_dropout_hidden=hp.p_dropout_hidden)
 
 if hp.lossfun=='L1':
     loss_fcn = torch.nn.L1Loss()
 else: 
     loss_fcn = torch.nn.MSELoss()
 
-optimizer = torch.optim.Adam(net.parameters(), lr=hp.learn_rate)
+if hp.get('multihead', False):
+    # one shared trunk, one output head per target in hp.ynames
+    net = MultiHeadMLP(in_dim, preprocess.ydims, hp.hidden_dims, head_hidden_dims=hp.get('head_hidden_dims', []),
+                       nonlinearity=hp.nonlinearity, p_dropout_in=hp.p_dropout_in, p_dropout_hidden=hp.p_dropout_hidden)
+    loss_fcn = MultiHeadLoss(loss_fcn, preprocess.ydims)
+else:
+    net = MLP(in_dim, out_dim, hp.hidden_dims, nonlinearity=hp.nonlinearity,
+              p_dropout_in=hp.p_dropout_in, p_dropout_hidden=hp.p_dropout_hidden)
+
+if hp.get('finetune', False):
+    net.load_state_dict(torch.load(hp.finetune_from + '/net.pth'))
+    pretrained_net = copy.deepcopy(net).eval()
+elif hp.get('warm_start_from') is not None:
+    # init from the nearest completed job of the grid, see nntools/jobs.py
+    warm_start(net, hp.warm_start_from + '/net.pth')
+
+# adam, or full-batch lbfgs
+optimizer = make_optimizer(net, hp)
+scheduler = None
+
+if hp.get('optimizer', 'adam') == 'adam':
+
+    # learning rate range test, the suggested lr is used as the (peak) lr
+    if hp.get('lr_find', False) and not hp.use_pretrained_model:
+        print('Running learning rate range test...')
+        lrs, lr_losses, hp.max_lr = lr_range_test(net, loss_fcn, optimizer, train_dataloader)
+        np.savetxt(hp.save_results_dir + '/lr_find.txt', (lrs, lr_losses))
+        print('Suggested learning rate: %3e' % hp.max_lr)
+
+    scheduler = make_lr_scheduler(optimizer, hp, len(train_dataloader))
 
 if hp.use_pretrained_model:
     pth = hp.load_results_dir + '/net.pth'
@@ -65,7 +123,7 @@ else:
     # train
     print('Training...')
     net, training_loss, validation_loss = train(
-        net, loss_fcn, optimizer, train_dataloader, val_dataloader, hp)
+        net, loss_fcn, optimizer, train_dataloader, val_dataloader, hp, scheduler=scheduler)
     print('Training complete.')
 
     net.eval()
@@ -79,15 +137,54 @@ else:
         print('Saving model...')
         pth = hp.save_results_dir + '/net.pth'
         torch.save(net.state_dict(), pth)
+        save_preprocess(preprocess, hp.save_results_dir + '/preprocess.dat')
+        np.savetxt(hp.save_results_dir + '/test_shots.txt', np.unique(test_shots), fmt='%d')
+        save_bundle(hp.save_results_dir + '/model_bundle.npz', net, preprocess, traindata, hp)
 
     plot_loss_curve(training_loss, validation_loss, hp)
 
+# inference latency of the newly trained net on this cpu, see nntools/latency.py
+if hp.get('benchmark_latency', False) and not hp.use_pretrained_model and not hp.get('finetune', False):
+    print('Benchmarking latency...')
+    write_latency(net, in_dim, hp)
+
+# compare old-shot (forgetting) and new-shot losses of the pretrained, fine-tuned
+# and optionally a fully retrained model, on a common normalization
+if hp.get('finetune', False) and not hp.use_pretrained_model:
+    print('Evaluating forgetting...')
+    models = {'pretrained': (pretrained_net, preprocess), 'finetuned': (net, preprocess)}
+
+    # a retrained model is only compared on the shots held out by every model
+    held_out_shots = None
+    if hp.get('retrain_dir') is not None:
+        if os.path.exists(hp.retrain_dir + '/test_shots.txt'):
+            retrain_net = copy.deepcopy(net)
+            retrain_net.load_state_dict(torch.load(hp.retrain_dir + '/net.pth'))
+            models['retrained'] = (retrain_net, load_preprocess(hp.retrain_dir + '/preprocess.dat'))
+            held_out_shots = np.intersect1d(test_shots, np.loadtxt(hp.retrain_dir + '/test_shots.txt'))
+            if os.path.exists(hp.finetune_from + '/test_shots.txt'):
+                held_out_shots = np.intersect1d(held_out_shots, np.loadtxt(hp.finetune_from + '/test_shots.txt'))
+        else:
+            print('No test_shots.txt in retrain_dir, the retrained model is not compared')
+
+    report = forgetting_report(models, old_testdata, testdata, loss_fcn, preprocess, held_out_shots)
+    
+    print(json.dumps(report, indent=4))
+    with open(hp.save_results_dir + '/finetune_report.json', 'w') as outfile:
+        json.dump(report, outfile, indent=4)
+
 # save predictions
 out = {}
 out['test'] = gen_output_preds(testdata, preprocess, net, hp)
 out['val']  = gen_output_preds(valdata, preprocess, net, hp)
 sio.savemat(hp.save_results_dir + '/out.mat', {'out':out})
 
+if hp.get('multihead', False):
+    key = 'head_l1_loss' if hp.lossfun=='L1' else 'head_l2_loss'
+    head_loss = {'val': out['val'][key], 'test': out['test'][key]}
+    with open(hp.save_results_dir + '/head_loss.json', 'w') as outfile:
+        json.dump(head_loss, outfile, indent=4)
+
 # plot & visualize results
 print('Making figures...')
 
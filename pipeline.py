@@ -0,0 +1,52 @@
+'''
+Pipeline from the datasets to trained example models and their figures, with
+stage caching (see nntools/pipeline.py). Stages whose inputs, settings and code
+did not change since their last run are skipped, and the three examples are
+trained concurrently.
+
+usage: python pipeline.py [stages] [--max_workers N] [--force stage ...] [--dry_run]
+'''
+
+import os
+ROOT = os.environ['NN_ROOT']
+import sys
+sys.path.append(ROOT)
+from nntools.pipeline import Stage, main
+
+cache_dir = ROOT + '.pipeline/'
+
+eqnet_code = ['eqnet/net/eqnet_utils.py', 'eqnet/data/data_utils.py', 'nntools']
+pertnet_code = ['pertnet/net/pertnet_utils.py', 'pertnet/data/data_utils.py', 'nntools']
+
+stages = []
+
+# raw data to datasets. preprocess_eqdata3.py needs the raw data in data/rawdata/data_by_var/,
+# the examples below use the prebuilt data_pca files instead
+# stages.append(Stage('eqnet_preprocess', ['python', 'preprocess_eqdata3.py'], cwd='eqnet/data',
+#                     inputs=['data/rawdata/data_by_var'],
+#                     outputs=['eqnet/data/datasets/' + fn for fn in ['train_016.dat', 'val_016.dat', 'test_016.dat']],
+#                     code=['eqnet/data/preprocess_eqdata3.py', 'eqnet/data/mds_utils.py']))
+
+# settings (args.json), then training, predictions and figures, for each example
+examples = [
+    ('eqnet_example001', 'eqnet/examples/example001', 'eqnet_batch.py', 'eqnet/data/datasets/data_pca_017.dat', eqnet_code),
+    ('pertnet_control', 'pertnet/examples/control-mode', 'pertnet_batch.py', 'pertnet/data/datasets/data_pca_013.dat', pertnet_code),
+    ('pertnet_flux', 'pertnet/examples/flux-mode', 'pertnet_batch.py', 'pertnet/data/datasets/data_pca_013.dat', pertnet_code),
+]
+
+for name, jobdir, job_fn, dataset_fn, code in examples:
+
+    stages.append(Stage(name + '_args', ['python', 'define_input_args.py'], cwd=jobdir,
+                        outputs=[jobdir + '/args.json'],
+                        code=[jobdir + '/define_input_args.py']))
+
+    stages.append(Stage(name + '_train', ['python', '-u', job_fn], cwd=jobdir,
+                        inputs=[jobdir + '/args.json', dataset_fn],
+                        outputs=[jobdir + '/results/loss.txt', jobdir + '/results/out.mat'],
+                        code=[jobdir + '/' + job_fn] + code,
+                        env={'MPLBACKEND': 'agg'},
+                        clean=[jobdir + '/results/checkpoint.pth']))
+
+
+if __name__ == '__main__':
+    main(stages, ROOT, cache_dir)